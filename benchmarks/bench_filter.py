@@ -0,0 +1,70 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+
+from qiime2 import Artifact
+from qiime2.plugins import phylogenomics
+
+from .common import SCALES, cache_root, write_reads, write_reference
+
+
+class Bowtie2Build:
+    timeout = 1800
+    number = 1
+    repeat = 3
+
+    def setup_cache(self):
+        return write_reference(cache_root())
+
+    def setup(self, reference_fp):
+        self.reference = Artifact.load(reference_fp)
+
+    def time_bowtie2_build(self, reference_fp):
+        phylogenomics.methods.bowtie2_build(self.reference)
+
+
+class _Filter:
+    params = ([*SCALES], [1, 4])
+    param_names = ['scale', 'n_threads']
+    timeout = 3600
+    number = 1
+    repeat = 3
+
+    # asv shares the result of setup_cache between the classes that inherit
+    # its definition, so each layout defines its own, calling this
+    def _write_data(self, paired):
+        root = cache_root()
+        reference = Artifact.load(write_reference(root))
+        database, = phylogenomics.methods.bowtie2_build(reference)
+        database_fp = database.save(os.path.join(root, 'host-index.qza'))
+        reads = {scale: write_reads(root, scale, paired) for scale in SCALES}
+        return database_fp, reads
+
+    def setup(self, data, scale, n_threads):
+        database_fp, reads = data
+        self.database = Artifact.load(database_fp)
+        self.reads = Artifact.load(reads[scale])
+
+
+class FilterSingle(_Filter):
+    def setup_cache(self):
+        return self._write_data(paired=False)
+
+    def time_filter_single(self, data, scale, n_threads):
+        phylogenomics.methods.filter_single(
+            self.reads, self.database, n_threads=n_threads)
+
+
+class FilterPaired(_Filter):
+    def setup_cache(self):
+        return self._write_data(paired=True)
+
+    def time_filter_paired(self, data, scale, n_threads):
+        phylogenomics.methods.filter_paired(
+            self.reads, self.database, n_threads=n_threads)
@@ -0,0 +1,114 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""The plugin's own overhead, with stand-ins for the external tools.
+
+The actions are called directly, rather than through the QIIME 2
+framework, on small samples, so that what is measured is the per-sample
+glue: temporary files, gzip round-trips, copies and subprocesses.
+"""
+
+import contextlib
+import os
+import time
+
+from qiime2 import Artifact
+from q2_types.feature_data import DNAFASTAFormat
+from q2_types.per_sample_sequences import (
+    SingleLanePerSampleSingleEndFastqDirFmt,
+    SingleLanePerSamplePairedEndFastqDirFmt,
+)
+
+from q2_phylogenomics._filter import (
+    bowtie2_build, filter_single, filter_paired)
+from q2_phylogenomics._prinseq import prinseq_single, prinseq_paired
+
+from .common import cache_root, import_reads, write_reference
+from .overhead import ScratchMonitor, standin_tools
+from .standins import RATE_VARIABLE
+
+
+N_READS = 200
+N_SAMPLES = [1, 8, 32]
+LAYOUTS = ['single', 'paired']
+
+
+class _Overhead:
+    # subclasses define run(layout, *params), which calls the action
+    timeout = 600
+
+    def setup_cache(self):
+        root = cache_root()
+        reads = {(n_samples, layout): import_reads(
+                     root, 'overhead-%d-%s' % (n_samples, layout), n_samples,
+                     N_READS, layout == 'paired')
+                 for n_samples in N_SAMPLES for layout in LAYOUTS}
+        return write_reference(root), reads
+
+    def setup(self, data, n_samples, layout, *params):
+        reference_fp, reads = data
+        self._stack = contextlib.ExitStack()
+        # standin_tools sets the stand-ins' rate variable from its argument,
+        # so a rate given in the environment has to be passed through
+        rate = os.environ.get(RATE_VARIABLE)
+        self._stack.enter_context(standin_tools(
+            None if rate is None else float(rate)))
+        view_type = (SingleLanePerSamplePairedEndFastqDirFmt
+                     if layout == 'paired'
+                     else SingleLanePerSampleSingleEndFastqDirFmt)
+        self.reads = Artifact.load(reads[n_samples, layout]).view(view_type)
+        self.reference = Artifact.load(reference_fp).view(DNAFASTAFormat)
+
+    def teardown(self, *args):
+        self._stack.close()
+
+    def time_action(self, data, n_samples, layout, *params):
+        self.run(layout, *params)
+
+    def track_seconds_per_sample(self, data, n_samples, layout, *params):
+        start = time.monotonic()
+        self.run(layout, *params)
+        return (time.monotonic() - start) / n_samples
+
+    track_seconds_per_sample.unit = 'seconds'
+
+    def track_peak_scratch_bytes(self, data, n_samples, layout, *params):
+        with ScratchMonitor() as monitor:
+            self.run(layout, *params)
+        return monitor.peak_bytes
+
+    track_peak_scratch_bytes.unit = 'bytes'
+
+    def track_scratch_bytes_written(self, data, n_samples, layout, *params):
+        with ScratchMonitor() as monitor:
+            self.run(layout, *params)
+        return monitor.written_bytes
+
+    track_scratch_bytes_written.unit = 'bytes'
+
+
+class FilterOverhead(_Overhead):
+    params = (N_SAMPLES, LAYOUTS, [1, 8])
+    param_names = ['n_samples', 'layout', 'batch_size']
+
+    def setup(self, data, n_samples, layout, batch_size):
+        super().setup(data, n_samples, layout, batch_size)
+        self.database = bowtie2_build(self.reference)
+
+    def run(self, layout, batch_size):
+        action = filter_paired if layout == 'paired' else filter_single
+        action(self.reads, self.database, batch_size=batch_size)
+
+
+class PrinseqOverhead(_Overhead):
+    params = (N_SAMPLES, LAYOUTS, [False, True])
+    param_names = ['n_samples', 'layout', 'stream']
+
+    def run(self, layout, stream):
+        action = prinseq_paired if layout == 'paired' else prinseq_single
+        action(self.reads, stream=stream)
@@ -0,0 +1,47 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2 import Artifact
+from qiime2.plugins import phylogenomics
+
+from .common import SCALES, cache_root, write_reads
+from .synthetic import QUALITY_PROFILES
+
+
+class _Prinseq:
+    params = ([*SCALES], [*QUALITY_PROFILES], ['prinseq', 'native'])
+    param_names = ['scale', 'quality', 'backend']
+    timeout = 3600
+    number = 1
+    repeat = 3
+
+    # asv shares the result of setup_cache between the classes that inherit
+    # its definition, so each layout defines its own, calling this
+    def _write_data(self, paired):
+        root = cache_root()
+        return {(scale, quality): write_reads(root, scale, paired, quality)
+                for scale in SCALES for quality in QUALITY_PROFILES}
+
+    def setup(self, reads, scale, quality, backend):
+        self.reads = Artifact.load(reads[scale, quality])
+
+
+class PrinseqSingle(_Prinseq):
+    def setup_cache(self):
+        return self._write_data(paired=False)
+
+    def time_prinseq_single(self, reads, scale, quality, backend):
+        phylogenomics.methods.prinseq_single(self.reads, backend=backend)
+
+
+class PrinseqPaired(_Prinseq):
+    def setup_cache(self):
+        return self._write_data(paired=True)
+
+    def time_prinseq_paired(self, reads, scale, quality, backend):
+        phylogenomics.methods.prinseq_paired(self.reads, backend=backend)
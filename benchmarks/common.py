@@ -0,0 +1,75 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+
+import numpy as np
+from qiime2 import Artifact
+
+from .synthetic import random_genome, write_fasta, write_samples
+
+
+SEED = 42
+READ_LENGTH = 150
+HOST_LENGTH = 500000
+OTHER_LENGTH = 2000000
+HOST_FRACTION = 0.1
+QUALITY = 'declining'
+
+# number of samples and reads per sample
+SCALES = {
+    'small': (2, 1000),
+    'medium': (4, 10000),
+    'large': (8, 100000),
+}
+
+
+def genomes(seed=SEED):
+    rng = np.random.default_rng(seed)
+    return random_genome(rng, HOST_LENGTH), random_genome(rng, OTHER_LENGTH)
+
+
+def write_reference(root, seed=SEED):
+    """Save the host genome as a FeatureData[Sequence] artifact."""
+    host, _ = genomes(seed)
+    fasta_fp = os.path.join(root, 'host.fasta')
+    write_fasta(fasta_fp, {'host': host})
+    reference = Artifact.import_data('FeatureData[Sequence]', fasta_fp)
+    return reference.save(os.path.join(root, 'host.qza'))
+
+
+def write_reads(root, scale, paired, quality=QUALITY,
+                host_fraction=HOST_FRACTION, seed=SEED):
+    """Save simulated reads at ``scale`` as a SampleData artifact."""
+    n_samples, n_reads = SCALES[scale]
+    layout = 'paired' if paired else 'single'
+    return import_reads(root, '%s-%s-%s' % (scale, layout, quality),
+                        n_samples, n_reads, paired, quality, host_fraction,
+                        seed)
+
+
+def import_reads(root, name, n_samples, n_reads, paired, quality=QUALITY,
+                 host_fraction=HOST_FRACTION, seed=SEED):
+    """Save simulated reads as a SampleData artifact named ``name``."""
+    host, other = genomes(seed)
+    reads_dir = write_samples(
+        os.path.join(root, name), n_samples, n_reads, READ_LENGTH, host,
+        other, host_fraction, quality, paired, seed)
+    semantic_type = ('SampleData[PairedEndSequencesWithQuality]' if paired
+                     else 'SampleData[SequencesWithQuality]')
+    reads = Artifact.import_data(semantic_type, reads_dir,
+                                 'CasavaOneEightSingleLanePerSampleDirFmt')
+    return reads.save(os.path.join(root, name + '.qza'))
+
+
+def cache_root():
+    # asv runs setup_cache in a fresh directory that is kept for the whole
+    # run, so relative paths are stable between setup_cache and benchmarks
+    root = os.path.abspath('data')
+    os.makedirs(root, exist_ok=True)
+    return root
@@ -0,0 +1,124 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Helpers for measuring the plugin's own overhead.
+
+standin_tools puts the stand-ins from benchmarks.standins on the PATH in
+place of the real tools, and ScratchMonitor measures how much is written to
+the temporary directory while the plugin runs.
+"""
+
+import contextlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+
+from .standins import RATE_VARIABLE, TOOLS
+
+
+_WRAPPER = '#!/bin/sh\nexec "%s" "%s" %s "$@"\n'
+
+
+@contextlib.contextmanager
+def standin_tools(reads_per_second=None):
+    """Run the stand-in tools instead of the real ones within the block.
+
+    With ``reads_per_second``, bowtie2 and prinseq-lite.pl are throttled to
+    that rate; otherwise they pass reads through as fast as they can.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'standins.py')
+    bin_dir = tempfile.mkdtemp(prefix='q2-standins-')
+    for tool in TOOLS:
+        fp = os.path.join(bin_dir, tool)
+        with open(fp, 'w') as fh:
+            fh.write(_WRAPPER % (sys.executable, script, tool))
+        os.chmod(fp, 0o755)
+
+    environ = {'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+               RATE_VARIABLE: None if reads_per_second is None
+               else str(reads_per_second)}
+    previous = {name: os.environ.get(name) for name in environ}
+    _update_environ(environ)
+    try:
+        yield bin_dir
+    finally:
+        _update_environ(previous)
+        shutil.rmtree(bin_dir)
+
+
+def _update_environ(values):
+    for name, value in values.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+class ScratchMonitor:
+    """Track the files written to a fresh temporary directory.
+
+    Within the with block, the temporary directory of this process and its
+    children is a new, empty directory, whose regular files are sampled
+    every ``interval`` seconds from a separate thread. ``peak_bytes`` is the
+    largest total size seen at once, and ``written_bytes`` the sum of the
+    largest size seen of each file. Both are lower bounds, as files that
+    grow and are removed between samples are missed; outputs of the
+    actions, which are also written to the temporary directory, are
+    included.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._sizes = {}
+        self._done = threading.Event()
+
+    @property
+    def written_bytes(self):
+        return sum(self._sizes.values())
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='q2-scratch-')
+        self._previous = tempfile.tempdir, os.environ.get('TMPDIR')
+        tempfile.tempdir = self.path
+        os.environ['TMPDIR'] = self.path
+        self._sampler = threading.Thread(target=self._sample_until_done)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._sampler.join()
+        self._sample()
+        tempfile.tempdir, tmpdir = self._previous
+        _update_environ({'TMPDIR': tmpdir})
+        shutil.rmtree(self.path)
+
+    def _sample_until_done(self):
+        while not self._done.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                fp = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(fp)
+                except FileNotFoundError:
+                    continue
+                # FIFOs hold no data on disk
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                total += st.st_size
+                self._sizes[fp] = max(self._sizes.get(fp, 0), st.st_size)
+        self.peak_bytes = max(self.peak_bytes, total)
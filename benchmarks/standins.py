@@ -0,0 +1,282 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Fast stand-ins for bowtie2, bowtie2-build, samtools and prinseq-lite.pl.
+
+They accept the command lines that the plugin runs and produce output in
+the same formats, but do no real work: a read "aligns" to the host if its
+name contains ``host``, as in the reads from benchmarks.synthetic, and
+prinseq-lite.pl keeps every read. With the tools out of the way, timing the
+plugin's actions measures its own overhead.
+
+By default the stand-ins pass reads through as fast as they can. If
+STANDIN_READS_PER_SECOND is set, bowtie2 and prinseq-lite.pl take at least
+as long as a tool processing that many reads per second would, to model a
+fixed tool cost.
+
+Run as ``python standins.py TOOL ARGS...``; see standin_tools in
+benchmarks.overhead for putting them on the PATH.
+"""
+
+import gzip
+import os
+import sys
+import time
+
+
+TOOLS = ['bowtie2', 'bowtie2-build', 'samtools', 'prinseq-lite.pl']
+RATE_VARIABLE = 'STANDIN_READS_PER_SECOND'
+
+# SAM flags
+_PAIRED = 0x1
+_PROPER_PAIR = 0x2
+_UNMAPPED = 0x4
+_MATE_UNMAPPED = 0x8
+_READ1 = 0x40
+_READ2 = 0x80
+_SECONDARY = 0x100
+_SUPPLEMENTARY = 0x800
+
+# options of the stand-ins that take a value; all others are flags
+_VALUE_OPTIONS = {
+    'bowtie2': {'-p', '--rfg', '-x', '-U', '-1', '-2', '-S', '--un', '--al',
+                '--un-gz', '--al-gz', '--interleaved'},
+    'bowtie2-build': {'--threads'},
+    'samtools': {'-F', '-f', '-1', '-2', '-0', '-s', '-o', '-@'},
+}
+
+
+def parse_args(args, value_options):
+    """Split ``args`` into a dict of options and a list of positionals.
+
+    Every option of prinseq-lite.pl takes a value, so ``value_options`` of
+    None means all options do.
+    """
+    options, positionals = {}, []
+    args = iter(args)
+    for arg in args:
+        if arg.startswith('-') and arg != '-':
+            if value_options is None or arg in value_options:
+                options[arg] = next(args)
+            else:
+                options[arg] = True
+        else:
+            positionals.append(arg)
+    return options, positionals
+
+
+def open_input(fp):
+    fh = sys.stdin.buffer if fp == '-' else open(fp, 'rb')
+    if fh.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.open(fh, 'rb')
+    return fh
+
+
+def open_output(fp):
+    if fp is None:
+        return None
+    if fp in ('-', '/dev/stdout'):
+        return sys.stdout.buffer
+    if fp.endswith('.gz'):
+        return gzip.open(fp, 'wb', compresslevel=1)
+    return open(fp, 'wb')
+
+
+def close_output(fh):
+    if fh is None:
+        return
+    if fh is sys.stdout.buffer:
+        fh.flush()
+    else:
+        fh.close()
+
+
+def iter_fastq(fh):
+    return zip(*[fh] * 4)
+
+
+def throttle(start, n_reads):
+    rate = os.environ.get(RATE_VARIABLE)
+    if rate:
+        time.sleep(max(0, n_reads / float(rate) - (time.monotonic() - start)))
+
+
+def _is_host(header):
+    return b'host' in header
+
+
+def _sam_name(header):
+    name = header[1:].split()[0]
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+
+def _sam_record(header, seq, qual, flag):
+    ref, pos, mapq, cigar = (b'*', b'0', b'0', b'*') if flag & _UNMAPPED \
+        else (b'host', b'1', b'42', b'%dM' % (len(seq) - 1))
+    return b'\t'.join([_sam_name(header), b'%d' % flag, ref, pos, mapq,
+                       cigar, b'*', b'0', b'0', seq.rstrip(),
+                       qual.rstrip()]) + b'\n'
+
+
+def _percent(count, total):
+    return '%d (%.2f%%)' % (count, 100 * count / total if total else 0)
+
+
+def bowtie2(args):
+    start = time.monotonic()
+    options, _ = parse_args(args, _VALUE_OPTIONS['bowtie2'])
+    sam = open_output(options.get('-S', '-'))
+    n_reads = n_aligned = 0
+    if '-U' in options:
+        un = open_output(options.get('--un', options.get('--un-gz')))
+        al = open_output(options.get('--al', options.get('--al-gz')))
+        for record in iter_fastq(open_input(options['-U'])):
+            aligned = _is_host(record[0])
+            n_reads += 1
+            n_aligned += aligned
+            sam.write(_sam_record(record[0], record[1], record[3],
+                                  0 if aligned else _UNMAPPED))
+            writer = al if aligned else un
+            if writer is not None:
+                writer.writelines(record)
+        close_output(un)
+        close_output(al)
+        kind, qualifier = 'unpaired', ''
+    else:
+        if '--interleaved' in options:
+            records = iter_fastq(open_input(options['--interleaved']))
+            pairs = zip(records, records)
+        else:
+            pairs = zip(iter_fastq(open_input(options['-1'])),
+                        iter_fastq(open_input(options['-2'])))
+        for mate1, mate2 in pairs:
+            aligned = _is_host(mate1[0]) or _is_host(mate2[0])
+            n_reads += 1
+            n_aligned += aligned
+            flag = _PAIRED | (_PROPER_PAIR if aligned
+                              else _UNMAPPED | _MATE_UNMAPPED)
+            sam.write(_sam_record(mate1[0], mate1[1], mate1[3],
+                                  flag | _READ1))
+            sam.write(_sam_record(mate2[0], mate2[1], mate2[3],
+                                  flag | _READ2))
+        kind, qualifier = 'paired', 'concordantly '
+    close_output(sam)
+    throttle(start, n_reads)
+
+    sys.stderr.write(
+        '%d reads; of these:\n'
+        '  %s were %s; of these:\n'
+        '    %s aligned %s0 times\n'
+        '    %s aligned %sexactly 1 time\n'
+        '    %s aligned %s>1 times\n'
+        '%.2f%% overall alignment rate\n' % (
+            n_reads, _percent(n_reads, n_reads), kind,
+            _percent(n_reads - n_aligned, n_reads), qualifier,
+            _percent(n_aligned, n_reads), qualifier,
+            _percent(0, n_reads), qualifier,
+            100 * n_aligned / n_reads if n_reads else 0))
+
+
+def bowtie2_build(args):
+    if '--version' in args:
+        print('bowtie2-build-s version 0.0.0 (stand-in)')
+        return
+    _, (reference, prefix) = parse_args(args, _VALUE_OPTIONS['bowtie2-build'])
+    with open(reference, 'rb') as fh:
+        sequences = fh.read()
+    for suffix in ('.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2',
+                   '.rev.2.bt2'):
+        with open(prefix + suffix, 'wb') as fh:
+            fh.write(sequences)
+
+
+def samtools(args):
+    command, args = args[0], args[1:]
+    options, positionals = parse_args(args, _VALUE_OPTIONS['samtools'])
+    records = open_input(positionals[-1])
+    if command == 'view':
+        _samtools_view(records, options)
+    elif command == 'fastq':
+        _samtools_fastq(records, options)
+    else:
+        raise ValueError('samtools %s has no stand-in.' % command)
+
+
+def _samtools_view(records, options):
+    required = int(options.get('-f', 0))
+    excluded = int(options.get('-F', 0))
+    out = sys.stdout.buffer
+    for line in records:
+        if line.startswith(b'@'):
+            out.write(line)
+            continue
+        flag = int(line.split(b'\t', 2)[1])
+        if flag & required == required and not flag & excluded:
+            out.write(line)
+    out.flush()
+
+
+def _samtools_fastq(records, options):
+    writers = {_READ1: open_output(options.get('-1', '-')),
+               _READ2: open_output(options.get('-2', '-')),
+               0: open_output(options.get('-0', '-'))}
+    suffix = '-n' not in options or '-N' in options
+    n_reads = 0
+    for line in records:
+        if line.startswith(b'@'):
+            continue
+        name, flag, *_, seq, qual = line.rstrip(b'\n').split(b'\t')[:11]
+        flag = int(flag)
+        if flag & (_SECONDARY | _SUPPLEMENTARY):
+            continue
+        mate = flag & (_READ1 | _READ2)
+        if suffix and mate:
+            name += b'/1' if mate == _READ1 else b'/2'
+        writers[mate].write(b'@%s\n%s\n+\n%s\n' % (name, seq, qual))
+        n_reads += 1
+    for fh in set(writers.values()):
+        close_output(fh)
+    sys.stderr.write('[M::bam2fq_mainloop] discarded 0 singletons\n'
+                     '[M::bam2fq_mainloop] processed %d reads\n' % n_reads)
+
+
+def prinseq(args):
+    start = time.monotonic()
+    options, _ = parse_args(args, None)
+    out_good = options['-out_good']
+    inputs = [options['-fastq']]
+    if '-fastq2' in options:
+        inputs.append(options['-fastq2'])
+        outputs = [out_good + '_1.fastq', out_good + '_2.fastq']
+    else:
+        outputs = [out_good + '.fastq']
+    n_reads = 0
+    for input_fp, output_fp in zip(inputs, outputs):
+        with open_input(input_fp) as src, open(output_fp, 'wb') as dst:
+            for record in iter_fastq(src):
+                dst.writelines(record)
+                n_reads += 1
+    throttle(start, n_reads // len(inputs))
+
+
+_MAINS = {
+    'bowtie2': bowtie2,
+    'bowtie2-build': bowtie2_build,
+    'samtools': samtools,
+    'prinseq-lite.pl': prinseq,
+}
+
+
+def main(argv):
+    _MAINS[argv[1]](argv[2:])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,120 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Seeded generators of synthetic references and demultiplexed reads.
+
+Everything is derived from a numpy Generator, so the same seed always
+produces byte-identical files, and benchmark results are comparable across
+commits.
+"""
+
+import gzip
+import os
+
+import numpy as np
+
+
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+_COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+PHRED_OFFSET = 33
+
+# mean Phred score at the 5' and 3' ends of reads, interpolated in between
+QUALITY_PROFILES = {
+    'high': (38, 36),
+    'declining': (36, 12),
+    'low': (20, 8),
+}
+_QUALITY_SD = 4
+
+
+def random_genome(rng, length):
+    return _BASES[rng.integers(0, 4, size=length)].tobytes()
+
+
+def write_fasta(fp, genomes, line_width=80):
+    with open(fp, 'w') as fh:
+        for name, genome in genomes.items():
+            fh.write('>%s\n' % name)
+            for i in range(0, len(genome), line_width):
+                fh.write(genome[i:i + line_width].decode() + '\n')
+
+
+def simulate_reads(rng, n_reads, read_length, host, other,
+                   host_fraction=0.1, quality='declining', paired=False,
+                   insert_size=None):
+    """Simulate reads as lists of (name, sequence, quality) byte strings.
+
+    A ``host_fraction`` of the reads (or pairs) are drawn from ``host`` and
+    the rest from ``other``, on random strands. Base qualities follow one
+    of QUALITY_PROFILES, and every base is substituted with the error
+    probability its quality implies. Returns one list of reads for
+    single-end data and two, forward and reverse, for paired-end data.
+    """
+    if insert_size is None:
+        insert_size = 3 * read_length
+    span = insert_size if paired else read_length
+    is_host = rng.random(n_reads) < host_fraction
+    fragments = []
+    for from_host in is_host:
+        genome = host if from_host else other
+        start = rng.integers(0, len(genome) - span + 1)
+        fragment = genome[start:start + span]
+        if rng.random() < 0.5:
+            fragment = fragment.translate(_COMPLEMENT)[::-1]
+        fragments.append(fragment)
+
+    mates = [[f[:read_length] for f in fragments]]
+    if paired:
+        mates.append([f[-read_length:].translate(_COMPLEMENT)[::-1]
+                      for f in fragments])
+    return [_sequence_reads(rng, seqs, quality, is_host) for seqs in mates]
+
+
+def _sequence_reads(rng, seqs, quality, is_host):
+    n_reads, read_length = len(seqs), len(seqs[0])
+    start, end = QUALITY_PROFILES[quality]
+    means = np.linspace(start, end, read_length)
+    quals = np.clip(np.rint(rng.normal(means, _QUALITY_SD,
+                                       (n_reads, read_length))), 2, 41)
+    error = rng.random((n_reads, read_length)) < 10 ** (-quals / 10)
+    bases = np.frombuffer(b''.join(seqs), dtype=np.uint8).reshape(
+        n_reads, read_length).copy()
+    bases[error] = _BASES[rng.integers(0, 4, size=error.sum())]
+    quals = (quals + PHRED_OFFSET).astype(np.uint8)
+    return [(b'read%d%s' % (i, b'-host' if host else b''),
+             bases[i].tobytes(), quals[i].tobytes())
+            for i, host in enumerate(is_host)]
+
+
+def write_fastq_gz(fp, reads, mate=None):
+    suffix = b'' if mate is None else b'/%d' % mate
+    # a fixed mtime keeps the files byte-identical between runs
+    with gzip.GzipFile(fp, 'wb', compresslevel=1, mtime=0) as fh:
+        for name, seq, qual in reads:
+            fh.write(b'@%s%s\n%s\n+\n%s\n' % (name, suffix, seq, qual))
+
+
+def write_samples(out_dir, n_samples, n_reads, read_length, host, other,
+                  host_fraction=0.1, quality='declining', paired=False,
+                  seed=0):
+    """Write simulated samples in the Casava 1.8 layout.
+
+    Returns the directory, which can be imported as a
+    CasavaOneEightSingleLanePerSampleDirFmt.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(n_samples):
+        mates = simulate_reads(rng, n_reads, read_length, host, other,
+                               host_fraction, quality, paired)
+        for direction, reads in enumerate(mates, start=1):
+            fp = os.path.join(
+                out_dir, 'sample%d_S%d_L001_R%d_001.fastq.gz' % (
+                    i, i + 1, direction))
+            write_fastq_gz(fp, reads, direction if paired else None)
+    return out_dir
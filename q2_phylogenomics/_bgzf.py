@@ -0,0 +1,192 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import gzip
+import itertools
+import struct
+import zlib
+
+
+# BGZF (as written by bgzip and samtools) is gzip made of members of at most
+# 64 KiB, each recording its own compressed size in a "BC" extra field, so a
+# reader can find every member without decompressing the ones before it.
+# Data is compressed in blocks of at most BLOCK_DATA_SIZE bytes so that each
+# member stays within 64 KiB even if the data does not compress.
+BLOCK_DATA_SIZE = 0xff00
+_HEADER = struct.Struct('<4BI2BH2BHH')
+_FOOTER = struct.Struct('<II')
+_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b00'
+                     '03000000000000000000')
+
+# extension of the record index written alongside a BGZF FASTQ file
+INDEX_EXT = '.fqi'
+
+
+class BgzfWriter:
+    """Write BGZF, compressing blocks in up to ``threads`` threads.
+
+    Data written is expected to be FASTQ. Blocks are cut at record
+    boundaries where possible, so that most blocks start with a record.
+    """
+
+    def __init__(self, fp, level=6, threads=1):
+        self._fh = open(fp, 'wb')
+        self._level = level
+        self._buf = bytearray()
+        # number of lines in the data written so far, modulo 4
+        self._line = 0
+        self._pool = None
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        if threads > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def write(self, data):
+        self._buf += data
+        while len(self._buf) >= BLOCK_DATA_SIZE:
+            self._write_block(self._cut())
+        return len(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _cut(self):
+        # the longest prefix of at most BLOCK_DATA_SIZE bytes that ends a
+        # record, or BLOCK_DATA_SIZE bytes if no record ends within it
+        end = BLOCK_DATA_SIZE
+        n_lines = self._buf.count(b'\n', 0, end)
+        extra = (self._line + n_lines) % 4
+        if n_lines > extra:
+            for _ in range(extra + 1):
+                end = self._buf.rfind(b'\n', 0, end)
+            end += 1
+            n_lines -= extra
+        self._line = (self._line + n_lines) % 4
+        block = bytes(self._buf[:end])
+        del self._buf[:end]
+        return block
+
+    def _write_block(self, data):
+        if self._pool is None:
+            self._fh.write(_compress_block(data, self._level))
+            return
+        self._pending.append(
+            self._pool.submit(_compress_block, data, self._level))
+        while len(self._pending) >= self._max_pending:
+            self._fh.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._fh.closed:
+            return
+        try:
+            if self._buf:
+                self._write_block(bytes(self._buf))
+                self._buf.clear()
+            while self._pending:
+                self._fh.write(self._pending.popleft().result())
+            self._fh.write(_EOF)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _compress_block(data, level):
+    # zlib releases the GIL while compressing, so blocks compress in parallel
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = _HEADER.size + len(deflated) + _FOOTER.size
+    header = _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'),
+                          ord('C'), 2, size - 1)
+    return b''.join((header, deflated,
+                     _FOOTER.pack(zlib.crc32(data), len(data))))
+
+
+def _iter_blocks(fh):
+    # (offset, uncompressed data) of every block of a BGZF file
+    offset = 0
+    while True:
+        header = fh.read(_HEADER.size)
+        if not header:
+            return
+        fields = _HEADER.unpack(header)
+        if (fields[:4] != (0x1f, 0x8b, 8, 4) or
+                fields[7:11] != (6, ord('B'), ord('C'), 2)):
+            raise ValueError('%s is not BGZF compressed.' % fh.name)
+        size = fields[-1] + 1
+        body = fh.read(size - _HEADER.size)
+        yield offset, zlib.decompress(body[:-_FOOTER.size], -15)
+        offset += size
+
+
+def write_index(fp, index_fp=None):
+    """Write a record index of a BGZF FASTQ file.
+
+    The index lists, for every block in which a record starts, the number
+    of the first record starting in it and its virtual offset: the offset
+    of the block in the file shifted left by 16 bits, plus the offset of
+    the record within the block's data. It is written to ``fp`` with
+    INDEX_EXT appended, unless ``index_fp`` is given.
+    """
+    if index_fp is None:
+        index_fp = fp + INDEX_EXT
+    record = 0
+    # number of complete lines read so far, modulo 4, and whether the data
+    # read so far ends with a complete line
+    line = 0
+    at_line_start = True
+    with open(fp, 'rb') as fh, open(index_fp, 'w') as index:
+        for offset, data in _iter_blocks(fh):
+            if not data:
+                continue
+            # the first record in this block starts after the line that
+            # completes the last record of the previous one
+            skip = (4 - line) % 4 if at_line_start else 4 - line
+            start = 0
+            for _ in range(skip):
+                start = data.find(b'\n', start) + 1
+                if not start:
+                    break
+            if (start or not skip) and start < len(data):
+                first = record + (skip > 0)
+                index.write('%d\t%d\n' % (first, offset << 16 | start))
+            n_lines = data.count(b'\n')
+            record += (line + n_lines) // 4
+            line = (line + n_lines) % 4
+            at_line_start = data.endswith(b'\n')
+
+
+def read_index(index_fp):
+    """Read a record index as a list of (record, virtual offset) pairs."""
+    with open(index_fp) as fh:
+        return [tuple(int(field) for field in line.split('\t'))
+                for line in fh]
+
+
+def iter_records(fp, virtual_offset, n_records=None):
+    """Yield FASTQ records of a BGZF file starting at a virtual offset.
+
+    Records are yielded as tuples of their four lines, until ``n_records``
+    have been read or the file ends. Together with the index, this allows
+    independent parts of the file to be read in parallel.
+    """
+    with open(fp, 'rb') as raw:
+        raw.seek(virtual_offset >> 16)
+        with gzip.GzipFile(fileobj=raw) as fh:
+            fh.read(virtual_offset & 0xffff)
+            records = zip(*[fh] * 4)
+            yield from itertools.islice(records, n_records)
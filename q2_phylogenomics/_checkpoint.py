@@ -0,0 +1,106 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import shutil
+import urllib.parse
+
+from ._util import _link_or_copy
+
+
+_MARKER = 'complete.json'
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class Checkpoint:
+    """Per-sample results persisted outside of the output artifact.
+
+    Each completed sample gets a directory holding its output files and a
+    completion marker, written last, that records the parameters and
+    inputs the outputs were produced from, a checksum of every input and
+    output and the sample's stats. A sample is only restored if all of
+    these still match, so a run restarted with different settings or inputs
+    redoes it.
+    """
+
+    def __init__(self, root, params):
+        self.root = str(root)
+        self.params = json.loads(json.dumps(params, sort_keys=True))
+        os.makedirs(self.root, exist_ok=True)
+
+    def _sample_dir(self, sample_id):
+        return os.path.join(self.root,
+                            urllib.parse.quote(str(sample_id), safe=''))
+
+    def restore(self, sample_id, input_fps, output_fps):
+        """Link a completed sample's outputs into place and return its stats.
+
+        Returns None, leaving the outputs untouched, if the sample has no
+        valid checkpoint.
+        """
+        sample_dir = self._sample_dir(sample_id)
+        try:
+            with open(os.path.join(sample_dir, _MARKER)) as fh:
+                marker = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        if (marker.get('params') != self.params or
+                marker.get('inputs') != _describe_files(input_fps)):
+            return None
+        names = [os.path.basename(fp) for fp in output_fps]
+        if sorted(names) != sorted(marker.get('outputs', {})):
+            return None
+        for name in names:
+            fp = os.path.join(sample_dir, name)
+            if (not os.path.exists(fp) or
+                    _checksum(fp) != marker['outputs'][name]):
+                return None
+
+        for name, fp in zip(names, output_fps):
+            _link_or_copy(os.path.join(sample_dir, name), fp)
+        return marker['stats']
+
+    def save(self, sample_id, input_fps, output_fps, stats):
+        sample_dir = self._sample_dir(sample_id)
+        # drop any stale or partial checkpoint before writing the new one
+        shutil.rmtree(sample_dir, ignore_errors=True)
+        os.makedirs(sample_dir)
+
+        outputs = {}
+        for fp in output_fps:
+            name = os.path.basename(fp)
+            _link_or_copy(fp, os.path.join(sample_dir, name))
+            outputs[name] = _checksum(fp)
+
+        marker = {'params': self.params,
+                  'inputs': _describe_files(input_fps),
+                  'outputs': outputs,
+                  'stats': stats}
+        marker_fp = os.path.join(sample_dir, _MARKER)
+        with open(marker_fp + '.tmp', 'w') as fh:
+            json.dump(marker, fh)
+        os.rename(marker_fp + '.tmp', marker_fp)
+
+
+def _describe_files(fps):
+    # input files live in a new temporary location on every run (and get a
+    # new mtime), so they are identified by name, size and content rather
+    # than by path
+    return [[os.path.basename(fp), os.path.getsize(fp), _checksum(fp)]
+            for fp in fps]
+
+
+def _checksum(fp):
+    digest = hashlib.md5()
+    with open(fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,74 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import io
+import shutil
+
+from ._bgzf import BgzfWriter
+
+# python-isal reads and writes the same gzip format several times faster
+# than zlib, and from version 1.4 can compress across multiple threads. It
+# is required by the conda package, but optional otherwise.
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+
+# zlib compression level (1-9) of the .fastq.gz files written by the plugin.
+# Level 9, gzip's default, is rarely worth its cost on reads.
+COMPRESS_LEVEL = 6
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def open_gzip(fp, mode='rb', level=COMPRESS_LEVEL, threads=1, bgzf=False):
+    """Open a gzipped file in binary mode with the fastest available codec.
+
+    ``level`` is a zlib compression level, which is scaled to isal's levels
+    (0-3) when isal is used. With more than one of ``threads``, blocks of
+    the file are compressed in that many threads, which requires isal 1.4
+    or later; otherwise a single thread is used. With ``bgzf``, files
+    opened for writing are written in BGZF, with zlib, in any number of
+    threads.
+    """
+    if mode not in ('rb', 'wb', 'ab'):
+        raise ValueError('Gzipped files are opened in binary mode, not %r.'
+                         % mode)
+    if bgzf and mode == 'wb':
+        return BgzfWriter(fp, level, threads)
+    if igzip is not None:
+        if mode == 'rb':
+            return igzip.open(fp, mode)
+        isal_level = min(level // 3, 3)
+        if threads > 1 and igzip_threaded is not None:
+            return igzip_threaded.open(fp, mode, compresslevel=isal_level,
+                                       threads=threads)
+        return igzip.open(fp, mode, compresslevel=isal_level)
+
+    fh = gzip.open(fp, mode, compresslevel=level)
+    if mode == 'rb':
+        return io.BufferedReader(fh, BUFFER_SIZE)
+    return io.BufferedWriter(fh, BUFFER_SIZE)
+
+
+def compress(input_fp, output_fp, level=COMPRESS_LEVEL, threads=1,
+             bgzf=False):
+    with open(input_fp, 'rb') as src, \
+            open_gzip(output_fp, 'wb', level, threads, bgzf) as dst:
+        shutil.copyfileobj(src, dst, BUFFER_SIZE)
+
+
+def decompress(input_fp, output_fp):
+    with open_gzip(input_fp, 'rb') as src, open(output_fp, 'wb') as dst:
+        shutil.copyfileobj(src, dst, BUFFER_SIZE)
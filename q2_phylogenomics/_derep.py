@@ -0,0 +1,398 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from ._codec import open_gzip
+from ._native import iter_blocks, _BASE_CODES
+
+
+# sequences are hashed as polynomials in _HASH_BASE over their base codes,
+# which makes the hash of any prefix or suffix of a read cheap to derive
+_HASH_BASE = np.uint64(0x9e3779b97f4a7c15)
+_LENGTH_MULTIPLIER = np.uint64(0xd6e8feb86659fd93)
+_PAIR_MULTIPLIER = np.uint64(0xff51afd7ed558ccd)
+_COMPLEMENT = np.array([3, 2, 1, 0, 4], dtype=np.int16)
+
+# hashes are bucketed into 2 ** _PARTITION_BITS partitions by their top bits
+_PARTITION_BITS = 8
+_PARTITION_SHIFT = np.uint64(64 - _PARTITION_BITS)
+_ENTRY = np.dtype([('key', '<u8'), ('idx', '<i8'), ('rc', '?')])
+
+# the forward mates of pairs are marked in a table of 2 ** _MATE_FILTER_BITS
+# flags, indexed by the top bits of their hashes
+_MATE_FILTER_BITS = 24
+_MATE_FILTER_SHIFT = np.uint64(64 - _MATE_FILTER_BITS)
+
+
+def _inverse(a):
+    # inverse of an odd number modulo 2 ** 64, by Newton's iteration: an odd
+    # number is its own inverse modulo 2 ** 3, and each step doubles the
+    # number of low bits that are correct
+    inverse = a
+    for _ in range(5):
+        inverse = inverse * (2 - a * inverse) % 2 ** 64
+    return inverse
+
+
+_HASH_BASE_INVERSE = np.uint64(_inverse(int(_HASH_BASE)))
+
+
+def _powers(base, n):
+    powers = np.ones(n, dtype=np.uint64)
+    if n > 1:
+        powers[1:] = np.cumprod(np.full(n - 1, base, dtype=np.uint64))
+    return powers
+
+
+def _mix(hashes, lengths):
+    # fold the sequence length into its hash and scramble the result so
+    # that the top bits used for partitioning are well distributed
+    h = hashes ^ (lengths.astype(np.uint64) * _LENGTH_MULTIPLIER)
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def _key(mate_hashes):
+    # a read's hash, or that of a pair from the hashes of its two mates
+    if len(mate_hashes) == 1:
+        return mate_hashes[0]
+    forward, reverse = mate_hashes
+    return _mix(forward * _PAIR_MULTIPLIER + reverse,
+                np.zeros(len(forward), dtype=np.uint64))
+
+
+def _prefix_sums(codes, lengths):
+    # column k holds the (unmixed) hash of each read's first k bases
+    width = codes.shape[1]
+    in_read = np.arange(width)[None, :] < lengths[:, None]
+    weighted = np.where(in_read, (codes.astype(np.uint64) + np.uint64(1)) *
+                        _powers(_HASH_BASE, width), np.uint64(0))
+    sums = np.zeros((len(lengths), width + 1), dtype=np.uint64)
+    np.cumsum(weighted, axis=1, out=sums[:, 1:])
+    return sums
+
+
+def _reverse_complement(codes, lengths):
+    positions = lengths[:, None] - 1 - np.arange(codes.shape[1])[None, :]
+    rows = np.arange(len(lengths))[:, None]
+    return _COMPLEMENT[codes[rows, np.maximum(positions, 0)]]
+
+
+class _BlockHashes:
+    """Hashes of the reads in a block and of their prefixes and suffixes.
+
+    Each base is given one of five codes (A, C, G, T, and a fifth for
+    anything else, such as N), and each sequence is identified by a 64-bit
+    hash of its length and of the polynomial in _HASH_BASE whose
+    coefficients are its codes.
+    """
+
+    def __init__(self, block):
+        self.lengths = block.lengths
+        self._rows = np.arange(len(self.lengths))
+        self._codes = _BASE_CODES[block._lines(1)]
+        self._sums = _prefix_sums(self._codes, self.lengths)
+
+    def full(self):
+        return _mix(self._sums[self._rows, self.lengths], self.lengths)
+
+    def reverse_complement(self):
+        codes = _reverse_complement(self._codes, self.lengths)
+        sums = _prefix_sums(codes, self.lengths)
+        return _mix(sums[self._rows, self.lengths], self.lengths)
+
+    def prefixes(self, rows, length):
+        """Hashes of the first ``length`` bases of the reads in ``rows``."""
+        return _mix(self._sums[rows, length], np.full(rows.sum(), length))
+
+    def suffixes(self, rows, length):
+        """Hashes of the last ``length`` bases of the reads in ``rows``."""
+        ends = self.lengths[rows]
+        starts = ends - length
+        inverse = _powers(_HASH_BASE_INVERSE, self._sums.shape[1])
+        hashes = ((self._sums[rows, ends] - self._sums[rows, starts]) *
+                  inverse[starts])
+        return _mix(hashes, np.full(rows.sum(), length))
+
+
+class _SpillingTable:
+    """(hash, read index) entries bucketed into partitions by hash.
+
+    Entries are held in memory until they take up more than ``max_bytes``,
+    at which point every partition's entries are appended to its file in
+    ``work_dir``.
+    """
+
+    def __init__(self, work_dir, max_bytes):
+        self.work_dir = work_dir
+        self.max_bytes = max_bytes
+        self._buffers = [[] for _ in range(2 ** _PARTITION_BITS)]
+        self._buffered = 0
+        self._spilled = [0] * 2 ** _PARTITION_BITS
+
+    def _fp(self, partition):
+        return os.path.join(self.work_dir, 'partition-%03d' % partition)
+
+    def add(self, keys, idx, rc=False):
+        entries = np.empty(len(keys), dtype=_ENTRY)
+        entries['key'] = keys
+        entries['idx'] = idx
+        entries['rc'] = rc
+        entries = entries[np.argsort(keys >> _PARTITION_SHIFT, kind='stable')]
+        bounds = np.searchsorted(entries['key'] >> _PARTITION_SHIFT,
+                                 np.arange(2 ** _PARTITION_BITS + 1,
+                                           dtype=np.uint64))
+        for partition, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            if end > start:
+                self._buffers[partition].append(entries[start:end])
+        self._buffered += entries.nbytes
+        if self._buffered > self.max_bytes:
+            self._spill()
+
+    def _spill(self):
+        for partition, buffers in enumerate(self._buffers):
+            if buffers:
+                with open(self._fp(partition), 'ab') as fh:
+                    for entries in buffers:
+                        entries.tofile(fh)
+                        self._spilled[partition] += entries.nbytes
+            buffers.clear()
+        self._buffered = 0
+
+    def size(self, partition):
+        return self._spilled[partition] + sum(
+            entries.nbytes for entries in self._buffers[partition])
+
+    def load(self, partition):
+        parts = list(self._buffers[partition])
+        if self._spilled[partition]:
+            parts.insert(0, np.fromfile(self._fp(partition), dtype=_ENTRY))
+        if not parts:
+            return np.empty(0, dtype=_ENTRY)
+        return np.concatenate(parts)
+
+
+class _Targets:
+    """Sorted distinct hashes of some table entries, marked as they are hit.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.keys, self._inverse = np.unique(entries['key'],
+                                             return_inverse=True)
+        self.hits = np.zeros(len(self.keys), dtype=bool)
+
+    def hit(self, queries):
+        if not len(self.keys) or not len(queries):
+            return
+        pos = np.minimum(np.searchsorted(self.keys, queries),
+                         len(self.keys) - 1)
+        self.hits[pos[self.keys[pos] == queries]] = True
+
+    def hit_idx(self):
+        return self.entries['idx'][self.hits[self._inverse]]
+
+
+def _derep_types(derep):
+    types = set(derep)
+    # 5' and 3' duplicates include exact ones, and reverse complement 5'/3'
+    # duplicates include reverse complement exact ones, as in prinseq-lite
+    if types & {'2', '3'}:
+        types.add('1')
+    if '5' in types:
+        types.add('4')
+    return types
+
+
+def _duplicates(fps, types, max_bytes, work_dir):
+    """Flag the reads in uncompressed FASTQ files that are duplicates.
+
+    ``fps`` holds a single file of reads, or the two files of the mates of
+    paired-end reads. Pairs are compared as a whole: a pair is only a
+    duplicate of another if each of its mates is the same duplicate type of
+    the corresponding mate in that pair.
+    """
+    work_dir = tempfile.mkdtemp(prefix='derep-', dir=work_dir)
+    try:
+        return _find_duplicates(fps, types, max_bytes, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def _iter_block_hashes(fps):
+    # the hashes of each block of reads, one _BlockHashes per mate
+    fhs = [open(fp, 'rb') for fp in fps]
+    try:
+        for blocks in zip(*[iter_blocks(fh) for fh in fhs]):
+            yield [_BlockHashes(block) for block in blocks]
+    finally:
+        for fh in fhs:
+            fh.close()
+
+
+def _find_duplicates(fps, types, max_bytes, work_dir):
+    table = _SpillingTable(work_dir, max_bytes)
+    # the distinct lengths of the reads, as tuples of the mates' lengths
+    lengths = set()
+    mate_filter = (np.zeros(2 ** _MATE_FILTER_BITS, dtype=bool)
+                   if len(fps) == 2 else None)
+    n_reads = 0
+    for hashes in _iter_block_hashes(fps):
+        n_block = len(hashes[0].lengths)
+        idx = np.arange(n_reads, n_reads + n_block)
+        full = [h.full() for h in hashes]
+        table.add(_key(full), idx)
+        if '4' in types:
+            rc = [h.reverse_complement() for h in hashes]
+            table.add(_key(rc), idx, rc=True)
+        if mate_filter is not None:
+            mate_filter[full[0] >> _MATE_FILTER_SHIFT] = True
+            if '4' in types:
+                mate_filter[rc[0] >> _MATE_FILTER_SHIFT] = True
+        lengths.update(map(tuple, np.unique(
+            np.stack([h.lengths for h in hashes], axis=1), axis=0).tolist()))
+        n_reads += n_block
+
+    duplicate = np.zeros(n_reads, dtype=bool)
+    partitions = [p for p in range(2 ** _PARTITION_BITS) if table.size(p)]
+    while partitions:
+        # load as many partitions as fit in memory at once
+        group, group_bytes = [], 0
+        while partitions and (not group or group_bytes +
+                              table.size(partitions[0]) <= max_bytes):
+            group_bytes += table.size(partitions[0])
+            group.append(partitions.pop(0))
+        entries = np.sort(np.concatenate([table.load(p) for p in group]),
+                          order=['key', 'idx'])
+        forward, reverse = entries[~entries['rc']], entries[entries['rc']]
+
+        # the first read with a sequence is the one kept among its exact or
+        # reverse complement duplicates
+        first = np.ones(len(forward), dtype=bool)
+        first[1:] = forward['key'][1:] != forward['key'][:-1]
+        if '1' in types:
+            duplicate[forward['idx'][~first]] = True
+        if '4' in types and len(forward):
+            keys, first_idx = forward['key'][first], forward['idx'][first]
+            pos = np.minimum(np.searchsorted(keys, reverse['key']),
+                             len(keys) - 1)
+            found = ((keys[pos] == reverse['key']) &
+                     (first_idx[pos] < reverse['idx']))
+            duplicate[reverse['idx'][found]] = True
+
+        if types & {'2', '3', '5'}:
+            _flag_contained(fps, types, lengths, mate_filter, group,
+                            forward, reverse, duplicate)
+    return duplicate
+
+
+def _flag_contained(fps, types, lengths, mate_filter, group, forward,
+                    reverse, duplicate):
+    # flag the reads in a group of partitions whose sequence (or its reverse
+    # complement) is found at the 5' or 3' end of a longer read, by passing
+    # over the files and looking up the hashes of every read's ends of the
+    # lengths that reads have
+    in_group = np.zeros(2 ** _PARTITION_BITS, dtype=bool)
+    in_group[group] = True
+    targets = _Targets(forward)
+    rc_targets = _Targets(reverse)
+    for hashes in _iter_block_hashes(fps):
+        for prefixes, suffixes in _end_keys(hashes, lengths, mate_filter):
+            prefixes = prefixes[in_group[prefixes >> _PARTITION_SHIFT]]
+            suffixes = suffixes[in_group[suffixes >> _PARTITION_SHIFT]]
+            if '2' in types:
+                targets.hit(prefixes)
+            if '3' in types:
+                targets.hit(suffixes)
+            if '5' in types:
+                rc_targets.hit(prefixes)
+                rc_targets.hit(suffixes)
+    duplicate[targets.hit_idx()] = True
+    duplicate[rc_targets.hit_idx()] = True
+
+
+def _end_keys(hashes, lengths, mate_filter):
+    # the keys of the 5' and 3' ends of the reads in a block that are longer
+    # than each of ``lengths``. The ends of a pair are those of its mates,
+    # so pairs are looked up for every combination of mate lengths that
+    # pairs have; each mate must be at least as long as the one looked up,
+    # and one of them longer. Only pairs whose forward mate's end is marked
+    # in ``mate_filter`` can be found, so only those go on to be looked up.
+    if len(hashes) == 1:
+        read, = hashes
+        for length, in lengths:
+            rows = read.lengths > length
+            if rows.any():
+                yield read.prefixes(rows, length), read.suffixes(rows, length)
+        return
+
+    forward, reverse = hashes
+    reverse_lengths = collections.defaultdict(list)
+    for forward_length, reverse_length in lengths:
+        reverse_lengths[forward_length].append(reverse_length)
+    for forward_length, reverse_lengths in reverse_lengths.items():
+        covers = forward.lengths >= forward_length
+        if not covers.any():
+            continue
+        ends = []
+        for end in (forward.prefixes, forward.suffixes):
+            forward_ends = np.zeros(len(covers), dtype=np.uint64)
+            forward_ends[covers] = end(covers, forward_length)
+            ends.append((forward_ends, covers & mate_filter[
+                forward_ends >> _MATE_FILTER_SHIFT]))
+        for reverse_length in reverse_lengths:
+            longer = ((forward.lengths > forward_length) |
+                      (reverse.lengths > reverse_length))
+            longer &= reverse.lengths >= reverse_length
+            yield tuple(
+                _key([forward_ends[candidates & longer],
+                      end(candidates & longer, reverse_length)])
+                for end, (forward_ends, candidates) in zip(
+                    (reverse.prefixes, reverse.suffixes), ends))
+
+
+def dereplicate(in_fps, out_fps, derep, max_bytes, work_dir, threads=1,
+                bgzf=False, compressed=True):
+    """Remove duplicate reads from uncompressed FASTQ files into gzipped ones.
+
+    ``derep`` holds prinseq-lite's duplicate types: 1 (exact), 2 (5'), 3
+    (3'), 4 (reverse complement exact) and 5 (reverse complement 5'/3').
+    The first of a set of exact or reverse complement duplicates is kept,
+    and reads found at the 5' or 3' end of a longer read are removed. The
+    read hashes are held in at most about ``max_bytes`` of memory, beyond
+    which they are spilled to ``work_dir``. Paired-end reads are
+    dereplicated as pairs (see _duplicates).
+    ``threads`` and ``bgzf`` are passed on to open_gzip for the outputs,
+    which are left uncompressed if not ``compressed``.
+    """
+    types = _derep_types(derep)
+    keep = (~_duplicates(in_fps, types, max_bytes, work_dir) if types
+            else None)
+
+    in_fhs = [open(fp, 'rb') for fp in in_fps]
+    out_fhs = [open_gzip(fp, 'wb', threads=threads, bgzf=bgzf) if compressed
+               else open(fp, 'wb') for fp in out_fps]
+    try:
+        offset = 0
+        for blocks in zip(*[iter_blocks(fh) for fh in in_fhs]):
+            n_reads = len(blocks[0].records)
+            block_keep = (np.ones(n_reads, dtype=bool) if keep is None
+                          else keep[offset:offset + n_reads])
+            for block, out_fh in zip(blocks, out_fhs):
+                block.write(out_fh, block_keep)
+            offset += n_reads
+    finally:
+        for fh in in_fhs + out_fhs:
+            fh.close()
@@ -6,8 +6,11 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import contextlib
 import os
+import re
 import shutil
+import subprocess
 import tempfile
 import pandas as pd
 
@@ -19,7 +22,13 @@ from q2_types.per_sample_sequences import (
     SingleLanePerSamplePairedEndFastqDirFmt,
 )
 
-from ._util import run_command
+from ._codec import open_gzip
+from ._util import (
+    run_command, run_pipeline, run_in_parallel, write_bgzf_indexes)
+from ._index_cache import IndexCache
+from ._checkpoint import Checkpoint, _describe_files
+from ._profile import Profile
+from ._scratch import cascade_scratch_bytes, plan_jobs, sample_cost
 
 
 # samtools flags
@@ -35,123 +44,657 @@ REMOVE_SECONDARY_ALIGNMENTS = '256'
 REMOVE_SECONDARY_OR_UNMAPPED_SINGLE = '260'
 REMOVE_SECONDARY_OR_UNMAPPED_PAIRED = '268'
 
+# SAM flag bits, for alignments parsed here
+SAM_UNMAPPED = 4
+SAM_REVERSE = 16
+SAM_FIRST_MATE = 64
+# secondary or supplementary
+NOT_PRIMARY = 256 | 2048
+
+# complements the bases of reverse-strand alignments, as bowtie2 only
+# writes ACGTN
+_COMPLEMENT = bytes.maketrans(b'ACGTN', b'TGCAN')
+
 _filter_defaults = {
     'n_threads': 1,
+    'n_jobs': 1,
     'mode': 'local',
     'sensitivity': 'sensitive',
     'exclude_seqs': True,
     'ref_gap_open_penalty': 5,
     'ref_gap_ext_penalty': 3,
+    'memory_map_index': False,
+    'batch_size': 1,
+    'checkpoint_dir': None,
+    'bgzf_index_dir': None,
+    'profile_fp': None,
+    'scratch_dir': None,
+}
+
+_STATS_COLUMNS = ['input', 'aligned 0 times', 'aligned exactly 1 time',
+                  'aligned >1 times', 'retained']
+
+_BOWTIE2_SUMMARY_PATTERNS = {
+    'input': r'^(\d+) reads; of these:$',
+    'aligned 0 times': r'^\s*(\d+) \(\S+\) aligned (?:concordantly )?0 times$',
+    'aligned exactly 1 time':
+        r'^\s*(\d+) \(\S+\) aligned (?:concordantly )?exactly 1 time$',
+    'aligned >1 times':
+        r'^\s*(\d+) \(\S+\) aligned (?:concordantly )?>1 times$',
+}
+
+# samtools fastq reports the number of records it has written
+_SAMTOOLS_FASTQ_PATTERN = r'processed (\d+) reads'
+
+# separates the tag carried by a read between shards from its name
+_SAMPLE_TAG_SEP = b':'
+
+_WARM_CHUNK_SIZE = 16 * 1024 * 1024
+
+_cache_defaults = {
+    # gigabytes
+    'cache_size_limit': 100,
 }
 
 
 def bowtie2_build(sequences: DNAFASTAFormat,
-                  n_threads: str = 1) -> Bowtie2IndexDirFmt:
+                  n_threads: str = 1,
+                  cache_dir: str = None,
+                  cache_size_limit: int = _cache_defaults[
+                      'cache_size_limit']) -> Bowtie2IndexDirFmt:
     database = Bowtie2IndexDirFmt()
+
+    if cache_dir is not None:
+        cache = IndexCache(cache_dir, cache_size_limit * 1024 ** 3)
+        key = cache.key(str(sequences), _bowtie2_build_params())
+        if cache.fetch(key, str(database.path)):
+            print('Reusing cached bowtie2 index %s.' % key)
+            return database
+
     build_cmd = ['bowtie2-build', '--threads', str(n_threads),
                  str(sequences), str(database.path / 'db')]
     run_command(build_cmd)
+
+    if cache_dir is not None:
+        cache.store(key, str(database.path))
     return database
 
 
+def _bowtie2_build_params():
+    # everything other than the input sequences that determines the index
+    # contents; n_threads does not change the output
+    version = subprocess.run(['bowtie2-build', '--version'],
+                             stdout=subprocess.PIPE, check=True,
+                             universal_newlines=True).stdout
+    return {'bowtie2-build': version.splitlines()[0]}
+
+
 def filter_single(
         demultiplexed_sequences: SingleLanePerSampleSingleEndFastqDirFmt,
         database: Bowtie2IndexDirFmt,
         n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs'],
         mode: str = _filter_defaults['mode'],
         sensitivity: str = _filter_defaults['sensitivity'],
         ref_gap_open_penalty: str = _filter_defaults['ref_gap_open_penalty'],
         ref_gap_ext_penalty: str = _filter_defaults['ref_gap_ext_penalty'],
-        exclude_seqs: bool = _filter_defaults['exclude_seqs']) -> \
-            CasavaOneEightSingleLanePerSampleDirFmt:
-    filtered_seqs = CasavaOneEightSingleLanePerSampleDirFmt()
+        exclude_seqs: bool = _filter_defaults['exclude_seqs'],
+        memory_map_index: bool = _filter_defaults['memory_map_index'],
+        batch_size: int = _filter_defaults['batch_size'],
+        checkpoint_dir: str = _filter_defaults['checkpoint_dir'],
+        bgzf_index_dir: str = _filter_defaults['bgzf_index_dir'],
+        profile_fp: str = _filter_defaults['profile_fp']) -> \
+            (CasavaOneEightSingleLanePerSampleDirFmt, pd.DataFrame):
     df = demultiplexed_sequences.manifest.view(pd.DataFrame)
-    for _, fwd in df.itertuples():
-        _bowtie2_filter(fwd, None, filtered_seqs, database, n_threads, mode,
-                        sensitivity, ref_gap_open_penalty, ref_gap_ext_penalty,
-                        exclude_seqs)
-    return filtered_seqs
+    samples = [(sample_id, fwd, None) for sample_id, fwd in df.itertuples()]
+    return _filter_samples(samples, database.path,
+                           [str(database.path / database.get_basename())],
+                           n_threads, n_jobs, mode, sensitivity,
+                           ref_gap_open_penalty, ref_gap_ext_penalty,
+                           exclude_seqs, memory_map_index, batch_size,
+                           checkpoint_dir, bgzf_index_dir, profile_fp)
 
 
 def filter_paired(
         demultiplexed_sequences: SingleLanePerSamplePairedEndFastqDirFmt,
         database: Bowtie2IndexDirFmt,
         n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs'],
         mode: str = _filter_defaults['mode'],
         sensitivity: str = _filter_defaults['sensitivity'],
         ref_gap_open_penalty: str = _filter_defaults['ref_gap_open_penalty'],
         ref_gap_ext_penalty: str = _filter_defaults['ref_gap_ext_penalty'],
-        exclude_seqs: bool = _filter_defaults['exclude_seqs']) -> \
-            CasavaOneEightSingleLanePerSampleDirFmt:
-    filtered_seqs = CasavaOneEightSingleLanePerSampleDirFmt()
+        exclude_seqs: bool = _filter_defaults['exclude_seqs'],
+        memory_map_index: bool = _filter_defaults['memory_map_index'],
+        batch_size: int = _filter_defaults['batch_size'],
+        checkpoint_dir: str = _filter_defaults['checkpoint_dir'],
+        bgzf_index_dir: str = _filter_defaults['bgzf_index_dir'],
+        profile_fp: str = _filter_defaults['profile_fp']) -> \
+            (CasavaOneEightSingleLanePerSampleDirFmt, pd.DataFrame):
     df = demultiplexed_sequences.manifest.view(pd.DataFrame)
-    for _, fwd, rev in df.itertuples():
-        _bowtie2_filter(fwd, rev, filtered_seqs, database, n_threads, mode,
-                        sensitivity, ref_gap_open_penalty, ref_gap_ext_penalty,
-                        exclude_seqs)
-    return filtered_seqs
+    samples = list(df.itertuples())
+    return _filter_samples(samples, database.path,
+                           [str(database.path / database.get_basename())],
+                           n_threads, n_jobs, mode, sensitivity,
+                           ref_gap_open_penalty, ref_gap_ext_penalty,
+                           exclude_seqs, memory_map_index, batch_size,
+                           checkpoint_dir, bgzf_index_dir, profile_fp)
 
 
-def _bowtie2_filter(f_read, r_read, outdir, database, n_threads, mode,
+def _filter_samples(samples, database_dir, indexes, n_threads, n_jobs, mode,
                     sensitivity, ref_gap_open_penalty, ref_gap_ext_penalty,
-                    exclude_seqs):
+                    exclude_seqs, memory_map_index, batch_size,
+                    checkpoint_dir, bgzf_index_dir=None, profile_fp=None,
+                    scratch_dir=None):
+    """Filter samples against one index, or a cascade of index shards.
+
+    ``indexes`` are bowtie2 index prefixes within ``database_dir``. With
+    more than one, each sample is aligned to the shards in turn (see
+    _bowtie2_filter_cascade) and batching is not available. With a
+    ``bgzf_index_dir``, the outputs are written in BGZF and indexed there.
+    With a ``profile_fp``, the resources used by every command run for each
+    sample (or batch of samples) are written there as a table. Shards
+    write temporary files to ``scratch_dir``, and fewer samples are
+    filtered concurrently if those of n_jobs samples would not fit there.
+    """
+    bgzf = bgzf_index_dir is not None
+    filtered_seqs = CasavaOneEightSingleLanePerSampleDirFmt()
+    stats = {}
+    profile = Profile()
+
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(checkpoint_dir, {
+            'action': 'filter',
+            'mode': mode,
+            'sensitivity': sensitivity,
+            'ref_gap_open_penalty': ref_gap_open_penalty,
+            'ref_gap_ext_penalty': ref_gap_ext_penalty,
+            'exclude_seqs': exclude_seqs,
+            'bgzf': bgzf,
+            'database': _describe_files(sorted(database_dir.iterdir()))})
+        remaining = []
+        for sample in samples:
+            restored = checkpoint.restore(
+                sample[0], _input_fps(sample),
+                _output_fps(filtered_seqs, sample))
+            if restored is None:
+                remaining.append(sample)
+            else:
+                print('Restored sample %s from checkpoint.' % sample[0])
+                stats[sample[0]] = restored
+    else:
+        remaining = samples
+
+    def filter_batch(batch, *args, n_threads):
+        outputs = [_output_fps(filtered_seqs, sample) for sample in batch]
+        log = []
+        if len(indexes) == 1:
+            batch_stats = _bowtie2_filter_batch(batch, outputs, indexes[0],
+                                                n_threads, *args, log=log)
+        else:
+            batch_stats = [_bowtie2_filter_cascade(
+                batch[0], outputs[0], indexes, n_threads, *args, log=log,
+                scratch_dir=scratch_dir)]
+        profile.add_commands(
+            ','.join(str(sample[0]) for sample in batch), log,
+            [fp for sample in batch for fp in _input_fps(sample)],
+            [fp for sample_outputs in outputs for fp in sample_outputs])
+        if checkpoint is not None:
+            for sample, sample_outputs, sample_stats in zip(
+                    batch, outputs, batch_stats):
+                checkpoint.save(sample[0], _input_fps(sample),
+                                sample_outputs, sample_stats)
+        return batch_stats
+
+    if len(indexes) > 1:
+        n_jobs = plan_jobs(
+            [cascade_scratch_bytes(_input_fps(sample), exclude_seqs)
+             for sample in remaining], n_jobs, scratch_dir)
+    jobs = []
+    for i in range(0, len(remaining), batch_size):
+        jobs.append((remaining[i:i + batch_size], mode, sensitivity,
+                     ref_gap_open_penalty, ref_gap_ext_penalty, exclude_seqs,
+                     memory_map_index, bgzf))
+    costs = [sample_cost(fp for sample in batch for fp in _input_fps(sample))
+             for batch, *_ in jobs]
+    if memory_map_index and jobs:
+        _warm_index(database_dir)
+    names = ['Sample%s %s' % ('s' if len(batch) > 1 else '',
+                              ', '.join(str(sample[0]) for sample in batch))
+             for batch, *_ in jobs]
+    for (batch, *_), batch_stats in zip(jobs, run_in_parallel(
+            filter_batch, jobs, n_jobs, costs=costs, n_threads=n_threads,
+            names=names)):
+        for sample, sample_stats in zip(batch, batch_stats):
+            stats[sample[0]] = sample_stats
+    if bgzf:
+        write_bgzf_indexes(
+            [fp for sample in samples
+             for fp in _output_fps(filtered_seqs, sample)],
+            bgzf_index_dir, n_jobs)
+    if profile_fp is not None:
+        profile.write(profile_fp)
+
+    stats = pd.DataFrame(
+        [stats[sample[0]] for sample in samples],
+        index=pd.Index([sample[0] for sample in samples], name='sample-id'),
+        columns=_STATS_COLUMNS)
+    return filtered_seqs, stats
+
+
+def _split_threads(n_threads, n_jobs):
+    # every concurrent sample gets an equal share of the thread budget, with
+    # bowtie2 and the samtools helpers in its pipeline drawing on that share
+    return max(1, n_threads // n_jobs)
+
+
+def _warm_index(database_dir):
+    # Read the index once so that its pages are in the page cache before the
+    # first alignment starts. With --mm, every bowtie2 process then maps
+    # those same pages rather than each loading a private copy.
+    for fp in database_dir.iterdir():
+        with open(str(fp), 'rb') as fh:
+            while fh.read(_WARM_CHUNK_SIZE):
+                pass
+
+
+def _parse_bowtie2_summary(summary):
+    # e.g.
+    # 10000 reads; of these:
+    #   10000 (100.00%) were paired; of these:
+    #     650 (6.50%) aligned concordantly 0 times
+    #     8823 (88.23%) aligned concordantly exactly 1 time
+    #     527 (5.27%) aligned concordantly >1 times
+    #   ...
+    # for single-end reads the counts are "aligned 0 times" etc.; the first
+    # match is always the one for pairs, not for their individual mates.
+    counts = {}
+    for column, pattern in _BOWTIE2_SUMMARY_PATTERNS.items():
+        match = re.search(pattern, summary, flags=re.MULTILINE)
+        counts[column] = int(match.group(1)) if match else 0
+    return counts
+
+
+def _bowtie2_cmd(index, n_threads, mode, sensitivity, ref_gap_open_penalty,
+                 ref_gap_ext_penalty, memory_map_index):
     if mode == 'local':
         mode = '--{0}-{1}'.format(sensitivity, mode)
     else:
         mode = '--' + sensitivity
     rfg_setting = '{0},{1}'.format(ref_gap_open_penalty, ref_gap_ext_penalty)
 
-    with tempfile.NamedTemporaryFile() as sam_f:
-        samfile_output_path = sam_f.name
-        with tempfile.NamedTemporaryFile() as bam_f:
-            bamfile_output_path = bam_f.name
-
-            # align to reference with bowtie
-            bowtie_cmd = ['bowtie2', '-p', str(n_threads), mode,
-                          '--rfg', rfg_setting,
-                          '-x', str(database.path / database.get_basename())]
-            if r_read is not None:
-                bowtie_cmd += ['-1', f_read, '-2', r_read]
+    bowtie_cmd = ['bowtie2', '-p', str(n_threads), mode,
+                  '--rfg', rfg_setting, '-x', index]
+    if memory_map_index:
+        bowtie_cmd += ['--mm']
+    return bowtie_cmd
+
+
+def _sam_filter_cmd(exclude_seqs):
+    # Filter alignments with samtools, passing uncompressed BAM downstream.
+    # Both flag sets are symmetric between mates, so a pair is either kept
+    # or dropped as a whole and the surviving mates stay adjacent.
+    if exclude_seqs:
+        sam_flags = ['-F', REMOVE_SECONDARY_ALIGNMENTS,
+                     '-f', KEEP_UNMAPPED_PAIRED]
+    else:
+        sam_flags = ['-F', REMOVE_SECONDARY_OR_UNMAPPED_PAIRED]
+    return ['samtools', 'view', '-u', *sam_flags, '-']
+
+
+def _output_fp(outdir, read):
+    return str(outdir.path / os.path.basename(read)) + '.fastq.gz'
+
+
+def _input_fps(sample):
+    _, f_read, r_read = sample
+    return [f_read] if r_read is None else [f_read, r_read]
+
+
+def _output_fps(outdir, sample):
+    return [_output_fp(outdir, read) for read in _input_fps(sample)]
+
+
+def _bowtie2_filter_single(f_read, output, index, n_threads, mode,
+                           sensitivity, ref_gap_open_penalty,
+                           ref_gap_ext_penalty, exclude_seqs,
+                           memory_map_index=False, unaligned=None,
+                           bgzf=False, log=None):
+    """Filter one single-end sample, writing the kept reads to ``output``.
+
+    When keeping aligned reads, the reads that did not align are written to
+    ``unaligned``, if given, for the next shard of a sharded index.
+    """
+    bowtie_cmd = _bowtie2_cmd(index, n_threads, mode, sensitivity,
+                              ref_gap_open_penalty, ref_gap_ext_penalty,
+                              memory_map_index)
+    # bowtie2 sorts single-end reads into aligned/unaligned itself, which
+    # is exactly what the samtools flags would select, so the alignments
+    # can be discarded and the kept reads written straight to the output.
+    bowtie_cmd += ['-U', f_read, '-S', '/dev/null']
+    kept_writer = '--un-gz' if exclude_seqs else '--al-gz'
+    if unaligned is not None:
+        bowtie_cmd += ['--un-gz', unaligned]
+    if bgzf:
+        # bowtie2 only writes plain gzip, so it writes the kept reads
+        # uncompressed to stdout, to be compressed here
+        bowtie_cmd += [kept_writer[:-3], '/dev/stdout']
+
+        def consume(fh):
+            with open_gzip(output, 'wb', threads=n_threads,
+                           bgzf=True) as out_fh:
+                shutil.copyfileobj(fh, out_fh)
+
+        summary, = run_pipeline([bowtie_cmd], consume=consume,
+                                capture_stderr=True, log=log)
+    else:
+        bowtie_cmd += [kept_writer, output]
+        summary = run_command(bowtie_cmd, capture_stderr=True, log=log)
+
+    stats = _parse_bowtie2_summary(summary)
+    if exclude_seqs:
+        stats['retained'] = stats['aligned 0 times']
+    else:
+        stats['retained'] = (stats['aligned exactly 1 time'] +
+                             stats['aligned >1 times'])
+    return stats
+
+
+def _bowtie2_filter(f_read, r_read, outputs, index, n_threads, mode,
+                    sensitivity, ref_gap_open_penalty, ref_gap_ext_penalty,
+                    exclude_seqs, memory_map_index=False, bgzf=False,
+                    log=None):
+    """Filter one sample, writing the kept reads to ``outputs``.
+
+    With ``bgzf``, the kept reads are written in BGZF. The resources used
+    by each command are appended to ``log``, if given.
+    """
+    if r_read is None:
+        return _bowtie2_filter_single(
+            f_read, outputs[0], index, n_threads, mode, sensitivity,
+            ref_gap_open_penalty, ref_gap_ext_penalty, exclude_seqs,
+            memory_map_index, bgzf=bgzf, log=log)
+
+    bowtie_cmd = _bowtie2_cmd(index, n_threads, mode, sensitivity,
+                              ref_gap_open_penalty, ref_gap_ext_penalty,
+                              memory_map_index)
+    # bowtie2's concordant-pair writers do not match the samtools flag
+    # semantics for pairs (e.g., a pair with one aligned mate is written to
+    # --un-conc), so paired reads are filtered from the alignments instead.
+    # Align to reference, streaming SAM to stdout. bowtie2 always emits the
+    # two mates of a pair as adjacent records; --reorder additionally keeps
+    # pairs in input order so output is deterministic across thread counts.
+    bowtie_cmd += ['--reorder', '-1', f_read, '-2', r_read]
+
+    # Convert to FASTQ with samtools, which pairs adjacent mates itself, so
+    # no name-sort is needed. samtools writes .gz outputs in BGZF, so they
+    # need no special handling for bgzf.
+    # -s /dev/null excludes singletons
+    # -0 /dev/null excludes supplementary and secondary reads
+    # -n keeps samtools from altering header IDs!
+    convert_cmd = ['samtools', 'fastq', '-1', outputs[0], '-2', outputs[1],
+                   '-0', '/dev/null', '-s', '/dev/null', '-n', '-']
+
+    summary, _, convert_log = run_pipeline(
+        [bowtie_cmd, _sam_filter_cmd(exclude_seqs), convert_cmd],
+        capture_stderr=True, log=log)
+
+    stats = _parse_bowtie2_summary(summary)
+    match = re.search(_SAMTOOLS_FASTQ_PATTERN, convert_log)
+    # samtools counts mates, not pairs
+    stats['retained'] = int(match.group(1)) // 2 if match else 0
+    return stats
+
+
+def _bowtie2_filter_cascade(sample, outputs, indexes, n_threads, mode,
+                            sensitivity, ref_gap_open_penalty,
+                            ref_gap_ext_penalty, exclude_seqs,
+                            memory_map_index=False, bgzf=False, log=None,
+                            scratch_dir=None):
+    """Filter one sample against each shard of a sharded index in turn.
+
+    Only the reads that did not align to a shard are aligned to the next
+    one. When excluding aligned reads, the reads left over after the last
+    shard are the output; otherwise the output is the concatenation of the
+    reads that aligned to each shard. Either way the same reads are kept
+    as when aligning to the unsharded reference. Aligned pairs are kept by
+    _bowtie2_keep_pairs_cascade, as their mates may align to different
+    shards.
+
+    As with batches, only the input and retained counts are reported.
+    Concatenated BGZF files are themselves valid BGZF, so ``bgzf`` is simply
+    passed on for each shard.
+    """
+    reads = _input_fps(sample)
+    stats = {'retained': 0}
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as temp_dir:
+        if not exclude_seqs and len(reads) == 2:
+            return _bowtie2_keep_pairs_cascade(
+                reads, outputs, indexes, temp_dir, n_threads, mode,
+                sensitivity, ref_gap_open_penalty, ref_gap_ext_penalty,
+                memory_map_index, bgzf, log)
+        for i, index in enumerate(indexes):
+            last = i == len(indexes) - 1
+            # the reads passed on to the next shard
+            unaligned = None if last else [
+                os.path.join(temp_dir, '%d-%s' % (i, os.path.basename(fp)))
+                for fp in reads]
+            if exclude_seqs:
+                kept = outputs if last else unaligned
+                f_read, r_read = (reads if len(reads) == 2
+                                  else (reads[0], None))
+                shard_stats = _bowtie2_filter(
+                    f_read, r_read, kept, index, n_threads, mode,
+                    sensitivity, ref_gap_open_penalty, ref_gap_ext_penalty,
+                    exclude_seqs, memory_map_index, bgzf=bgzf, log=log)
             else:
-                bowtie_cmd += ['-U', f_read]
-            bowtie_cmd += ['-S', samfile_output_path]
-            run_command(bowtie_cmd)
+                # single-end, as pairs were handed off above
+                kept = [os.path.join(temp_dir, 'aligned-%d-%s' % (
+                    i, os.path.basename(reads[0])))]
+                shard_stats = _bowtie2_filter_single(
+                    reads[0], kept[0], index, n_threads, mode, sensitivity,
+                    ref_gap_open_penalty, ref_gap_ext_penalty, exclude_seqs,
+                    memory_map_index, None if last else unaligned[0],
+                    bgzf, log)
+            if i == 0:
+                stats['input'] = shard_stats['input']
 
-            # Filter alignment and convert to BAM with samtools
             if exclude_seqs:
-                sam_flags = ['-F', REMOVE_SECONDARY_ALIGNMENTS,
-                             '-f', KEEP_UNMAPPED_SINGLE]
-                if r_read is not None:
-                    sam_flags[-1] = KEEP_UNMAPPED_PAIRED
+                stats['retained'] = shard_stats['retained']
+            else:
+                stats['retained'] += shard_stats['retained']
+                # gzip members can simply be concatenated
+                for kept_fp, output_fp in zip(kept, outputs):
+                    with open(kept_fp, 'rb') as src, \
+                            open(output_fp, 'ab') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(kept_fp)
+
+            if i > 0:
+                # the previous shard's leftovers are no longer needed
+                for fp in reads:
+                    os.remove(fp)
+            reads = unaligned
+    return stats
+
+
+def _bowtie2_keep_pairs_cascade(reads, outputs, indexes, temp_dir,
+                                n_threads, mode, sensitivity,
+                                ref_gap_open_penalty, ref_gap_ext_penalty,
+                                memory_map_index=False, bgzf=False,
+                                log=None):
+    """Keep the pairs both of whose mates align to some shard.
+
+    As for an unsharded index (see _sam_filter_cmd), a pair is kept once
+    both of its mates have aligned, even if they did so to different
+    shards. The mates that have aligned so far are carried to the next
+    shard in a tag prepended to the read names, and stripped
+    again when a pair is written out. bowtie2 --reorder emits the primary
+    alignments of each pair in input order, so they are matched up with the
+    reads that were aligned as they stream out of it.
+    """
+    stats = {'retained': 0}
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(open_gzip(
+            fp, 'wb', threads=n_threads, bgzf=bgzf)) for fp in outputs]
+        for i, index in enumerate(indexes):
+            last = i == len(indexes) - 1
+            # the pairs passed on to the next shard
+            unaligned = None if last else [
+                os.path.join(temp_dir, '%d-%s' % (i, os.path.basename(fp)))
+                for fp in reads]
+
+            def consume(fh):
+                with contextlib.ExitStack() as files:
+                    pairs = zip(*[_iter_fastq(files.enter_context(
+                        open_gzip(fp, 'rb'))) for fp in reads])
+                    passed = None if last else [files.enter_context(
+                        open_gzip(fp, 'wb')) for fp in unaligned]
+                    alignments = (line for line in fh
+                                  if not line.startswith(b'@') and not
+                                  int(line.split(b'\t', 2)[1]) & NOT_PRIMARY)
+                    for pair, mates in zip(pairs, zip(*[alignments] * 2)):
+                        aligned = 0
+                        if i > 0:
+                            tags, pair = zip(*map(_untag_record, pair))
+                            aligned = int(tags[0])
+                        for mate in mates:
+                            flag = int(mate.split(b'\t', 2)[1])
+                            if not flag & SAM_UNMAPPED:
+                                aligned |= 1 if flag & SAM_FIRST_MATE else 2
+                        if aligned == 3:
+                            for writer, record in zip(writers, pair):
+                                writer.writelines(record)
+                            stats['retained'] += 1
+                        elif not last:
+                            tag = b'%d%s' % (aligned, _SAMPLE_TAG_SEP)
+                            for writer, record in zip(passed, pair):
+                                writer.writelines(_tag_record(record, tag))
+
+            bowtie_cmd = _bowtie2_cmd(index, n_threads, mode, sensitivity,
+                                      ref_gap_open_penalty,
+                                      ref_gap_ext_penalty, memory_map_index)
+            bowtie_cmd += ['--reorder', '-1', reads[0], '-2', reads[1]]
+            summary, = run_pipeline([bowtie_cmd], consume=consume,
+                                    capture_stderr=True, log=log)
+            if i == 0:
+                stats['input'] = _parse_bowtie2_summary(summary)['input']
             else:
-                sam_flags = ['-F', REMOVE_SECONDARY_OR_UNMAPPED_SINGLE]
-                if r_read is not None:
-                    sam_flags[-1] = REMOVE_SECONDARY_OR_UNMAPPED_PAIRED
-            samtools_command = ['samtools', 'view', '-b', samfile_output_path,
-                                '-o', bamfile_output_path, *sam_flags,
-                                '-@', str(n_threads - 1)]
-            run_command(samtools_command)
-            # sort BAM file by read name so pairs are ordered
-            if r_read is not None:
-                with tempfile.NamedTemporaryFile() as sort_f:
-                    bamfile_sorted_output_path = sort_f.name
-                    sort_command = [
-                        'samtools', 'sort', '-n', '-@', str(n_threads - 1),
-                        '-o', bamfile_sorted_output_path, bamfile_output_path]
-                    run_command(sort_command)
-                    shutil.copyfile(
-                        bamfile_sorted_output_path, bamfile_output_path)
-
-            # Convert to FASTQ with samtools
-            fwd = str(outdir.path / os.path.basename(f_read)) + '.fastq.gz'
-            _reads = ['-1', fwd]
-            if r_read is not None:
-                rev = str(outdir.path / os.path.basename(r_read)) + '.fastq.gz'
-                _reads += ['-2', rev]
-            # -s /dev/null excludes singletons
-            # -0 /dev/null excludes supplementary and secondary reads
-            # -n keeps samtools from altering header IDs!
-            convert_command = [
-                'samtools', 'fastq', *_reads, '-0', '/dev/null',
-                '-s', '/dev/null', '-n', bamfile_output_path]
-            run_command(convert_command)
+                # the previous shard's leftovers are no longer needed
+                for fp in reads:
+                    os.remove(fp)
+            reads = unaligned
+    return stats
+
+
+def _bowtie2_filter_batch(samples, outputs, index, n_threads, mode,
+                          sensitivity, ref_gap_open_penalty,
+                          ref_gap_ext_penalty, exclude_seqs,
+                          memory_map_index=False, bgzf=False, log=None):
+    """Filter several samples with a single bowtie2 run.
+
+    The reads of the samples are streamed into bowtie2 one sample after
+    another, so the index is only loaded once per batch. bowtie2 --reorder
+    emits their primary alignments in the same order, so these are split
+    back into samples by counting them off against each sample's reads as
+    they stream out of it. The reads are passed to bowtie2 unchanged, as
+    bowtie2 seeds its choice between equally good alignments from the read
+    name, so the same reads are kept as when filtering each sample on its
+    own.
+
+    Returns a dict of filtering stats for each sample. bowtie2 only reports
+    alignment counts for the batch as a whole, so for batches of more than
+    one sample only the input and retained counts, which are tallied while
+    streaming, are known.
+    """
+    if len(samples) == 1:
+        _, f_read, r_read = samples[0]
+        return [_bowtie2_filter(f_read, r_read, outputs[0], index, n_threads,
+                                mode, sensitivity, ref_gap_open_penalty,
+                                ref_gap_ext_penalty, exclude_seqs,
+                                memory_map_index, bgzf=bgzf, log=log)]
+
+    bowtie_cmd = _bowtie2_cmd(index, n_threads, mode, sensitivity,
+                              ref_gap_open_penalty, ref_gap_ext_penalty,
+                              memory_map_index)
+    paired = samples[0][2] is not None
+    stats = [{'input': 0, 'retained': 0} for _ in samples]
+
+    def feed(fh):
+        for sample in samples:
+            with contextlib.ExitStack() as stack:
+                reads = [stack.enter_context(open_gzip(fp, 'rb'))
+                         for fp in _input_fps(sample)]
+                if not paired:
+                    shutil.copyfileobj(reads[0], fh)
+                    continue
+                # interleave mates, as expected by bowtie2 --interleaved
+                for records in zip(*map(_iter_fastq, reads)):
+                    for record in records:
+                        fh.writelines(record)
+
+    with contextlib.ExitStack() as stack:
+        writers = [[stack.enter_context(open_gzip(fp, 'wb', bgzf=bgzf))
+                    for fp in sample_outputs]
+                   for sample_outputs in outputs]
+
+        def consume(fh):
+            alignments = (line for line in fh
+                          if not line.startswith(b'@') and not
+                          int(line.split(b'\t', 2)[1]) & NOT_PRIMARY)
+            # the alignments of each read (or pair)
+            alignments = zip(*[alignments] * (2 if paired else 1))
+            for (_, f_read, _), sample_stats, sample_writers in zip(
+                    samples, stats, writers):
+                with open_gzip(f_read, 'rb') as f_fh:
+                    # zip draws the read first, so no alignment is drawn
+                    # once the sample's reads run out
+                    for record, mates in zip(_iter_fastq(f_fh), alignments):
+                        sample_stats['input'] += 1
+                        unmapped = [int(mate.split(b'\t', 2)[1]) &
+                                    SAM_UNMAPPED for mate in mates]
+                        if not (all(unmapped) if exclude_seqs
+                                else not any(unmapped)):
+                            continue
+                        sample_stats['retained'] += 1
+                        # as written by bowtie2 --al/--un for single-end
+                        # reads, and by samtools fastq for pairs
+                        records = (map(_sam_to_fastq, mates) if paired
+                                   else [record])
+                        for writer, kept in zip(sample_writers, records):
+                            writer.writelines(kept)
+
+        # the flags checked in consume select the same reads as
+        # _sam_filter_cmd and bowtie2's --al/--un writers
+        if paired:
+            bowtie_cmd += ['--reorder', '--interleaved', '-']
+        else:
+            bowtie_cmd += ['--reorder', '-U', '-']
+        run_pipeline([bowtie_cmd], feed=feed, consume=consume, log=log)
+        return stats
+
+
+def _iter_fastq(fh):
+    return zip(*[fh] * 4)
+
+
+def _sam_to_fastq(alignment):
+    # the read of an alignment, as written by samtools fastq -n
+    name, flag, *_, seq, qual = alignment.split(b'\t', 11)[:11]
+    seq, qual = seq.rstrip(b'\n'), qual.rstrip(b'\n')
+    if int(flag) & SAM_REVERSE:
+        seq, qual = seq[::-1].translate(_COMPLEMENT), qual[::-1]
+    return (b'@' + name + b'\n', seq + b'\n', b'+\n', qual + b'\n')
+
+
+def _tag_record(record, tag):
+    header, *rest = record
+    return (b'@' + tag + header[1:], *rest)
+
+
+def _untag_record(record):
+    # the tag and the record without it
+    header, *rest = record
+    tag, name = header[1:].split(_SAMPLE_TAG_SEP, 1)
+    return tag, (b'@' + name, *rest)
@@ -0,0 +1,57 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import re
+
+import qiime2
+import qiime2.plugin.model as model
+from qiime2.plugin import ValidationError
+from q2_types.bowtie2 import Bowtie2IndexFileFormat
+
+
+class Bowtie2StatsFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        try:
+            md = qiime2.Metadata.load(str(self))
+        except qiime2.metadata.MetadataFileError as md_exc:
+            raise ValidationError(md_exc) from md_exc
+
+        if md.column_count == 0:
+            raise ValidationError('Format must contain at least 1 column')
+
+        filtered_md = md.filter_columns(column_type='numeric')
+        if filtered_md.column_count != md.column_count:
+            raise ValidationError('Must only contain numeric values.')
+
+
+Bowtie2StatsDirFmt = model.SingleFileDirectoryFormat(
+    'Bowtie2StatsDirFmt', 'stats.tsv', Bowtie2StatsFormat)
+
+
+class Bowtie2ShardedIndexDirFmt(model.DirectoryFormat):
+    """A bowtie2 index split into shards named shard-0, shard-1, etc."""
+    idx = model.FileCollection(r'shard-\d+\.(rev\.)?\d\.bt2l?',
+                               format=Bowtie2IndexFileFormat)
+
+    def get_basenames(self):
+        shards = {int(re.match(r'shard-(\d+)\.', fp.name).group(1))
+                  for fp in self.path.iterdir()}
+        return ['shard-%d' % shard for shard in sorted(shards)]
+
+    def _validate_(self, level):
+        suffixes = collections.defaultdict(set)
+        for fp in self.path.iterdir():
+            basename, suffix = fp.name.split('.', 1)
+            suffixes[basename].add(suffix.rsplit('.', 1)[0])
+        for basename, found in suffixes.items():
+            missing = {'1', '2', '3', '4', 'rev.1', 'rev.2'} - found
+            if missing:
+                raise ValidationError(
+                    'Index shard %s is missing files: %s'
+                    % (basename, ', '.join(sorted(missing))))
@@ -0,0 +1,97 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from ._util import _link_or_copy
+
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class IndexCache:
+    """A content-addressed, size-bounded on-disk cache of built indexes.
+
+    Each entry is a directory named by the hash of the reference sequences
+    and the parameters the index was built with. Entries are evicted least
+    recently used first once the cache grows past ``max_bytes``. Files are
+    hard-linked in and out of the cache where the filesystem allows it and
+    copied otherwise.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, sequences_fp, params):
+        digest = hashlib.sha256()
+        with open(sequences_fp, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(_HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def fetch(self, key, dest_dir):
+        """Populate ``dest_dir`` from the cache, returning True on a hit."""
+        entry = os.path.join(self.root, key)
+        try:
+            names = os.listdir(entry)
+            for name in names:
+                _link_or_copy(os.path.join(entry, name),
+                              os.path.join(dest_dir, name))
+            # mark as recently used for eviction purposes
+            os.utime(entry)
+        except FileNotFoundError:
+            # not cached, or evicted by a concurrent build while linking
+            for name in os.listdir(dest_dir):
+                os.remove(os.path.join(dest_dir, name))
+            return False
+        return True
+
+    def store(self, key, src_dir):
+        entry = os.path.join(self.root, key)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        for name in os.listdir(src_dir):
+            _link_or_copy(os.path.join(src_dir, name),
+                          os.path.join(staging, name))
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another process stored the same index first
+            shutil.rmtree(staging)
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = _dir_size(path)
+            entries.append((os.stat(path).st_mtime, name, size))
+            total += size
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= size
+
+
+def _dir_size(path):
+    return sum(os.stat(os.path.join(path, name)).st_size
+               for name in os.listdir(path))
@@ -0,0 +1,334 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import io
+import itertools
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from ._codec import open_gzip
+
+
+# number of reads (or read pairs) trimmed and filtered at a time
+BLOCK_SIZE = 65536
+
+PHRED_OFFSET = 33
+
+# low-complexity scores are computed over windows of DUST_WINDOW bases
+# starting every DUST_STEP bases, as in prinseq-lite
+DUST_WINDOW = 64
+DUST_STEP = 32
+WORD_SIZE = 3
+# a window of a single repeated base has a raw DUST score of 31
+_DUST_SCALE = 100 / 31
+# number of windows scored at a time, to bound memory use on long reads
+_WINDOW_CHUNK_SIZE = 65536
+
+# A, C, G and T are coded 0-3 and everything else (e.g. N) 4, so each
+# trinucleotide gets a code below _N_WORDS
+_BASE_CODES = np.full(256, 4, dtype=np.int16)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    _BASE_CODES[list(_bases)] = _code
+_N_WORDS = 5 ** WORD_SIZE
+
+
+class ReadBlock:
+    """A block of FASTQ records with their qualities as a padded matrix.
+
+    ``quals`` holds one row of Phred scores per read, padded with zeros past
+    the end of the read, and ``lengths`` holds the (possibly trimmed) length
+    of each read.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.lengths = np.array([len(record[1].rstrip(b'\r\n'))
+                                 for record in records], dtype=np.int64)
+        self.quals = np.where(self._in_read(), self._lines(3).astype(
+            np.int64) - PHRED_OFFSET, 0)
+
+    def _in_read(self):
+        width = int(self.lengths.max()) if self.records else 0
+        return np.arange(width)[None, :] < self.lengths[:, None]
+
+    def _lines(self, line):
+        # gather one line of every record into a single buffer and index it
+        # by the offset at which each read's line starts
+        buf = np.frombuffer(b''.join(record[line] for record in self.records),
+                            dtype=np.uint8)
+        starts = np.zeros(len(self.records), dtype=np.int64)
+        np.cumsum([len(record[line]) for record in self.records[:-1]],
+                  out=starts[1:])
+        width = int(self.lengths.max()) if self.records else 0
+        idx = starts[:, None] + np.arange(width)[None, :]
+        return buf[np.minimum(idx, max(len(buf) - 1, 0))]
+
+    def words(self):
+        """Trinucleotide codes of each (possibly trimmed) read.
+
+        Positions that do not start a full trinucleotide within the read
+        hold ``_N_WORDS``.
+        """
+        codes = _BASE_CODES[self._lines(1)]
+        words = np.full(codes.shape, _N_WORDS, dtype=np.int16)
+        width = codes.shape[1] - WORD_SIZE + 1
+        if width > 0:
+            words[:, :width] = 0
+            for offset in range(WORD_SIZE):
+                words[:, :width] = (words[:, :width] * 5 +
+                                    codes[:, offset:offset + width])
+        in_word = (np.arange(codes.shape[1])[None, :] <=
+                   self.lengths[:, None] - WORD_SIZE)
+        words[~in_word] = _N_WORDS
+        return words
+
+    def write(self, fh, keep):
+        for record, length in zip(itertools.compress(self.records, keep),
+                                  self.lengths[keep]):
+            header, seq, plus, qual = record
+            fh.writelines((header, seq[:length], b'\n', plus,
+                           qual[:length], b'\n'))
+
+
+def iter_blocks(fh, block_size=BLOCK_SIZE):
+    records = zip(*[fh] * 4)
+    while True:
+        block = list(itertools.islice(records, block_size))
+        if not block:
+            return
+        yield ReadBlock(block)
+
+
+def trim_qual_right(block, threshold, qual_type, window):
+    """Trim reads from the 3' end by quality, as prinseq-lite does.
+
+    A window of ``window`` bases (or the whole read, if shorter) is slid
+    from the 3' end towards the 5' end one base at a time, and bases are
+    trimmed until the ``qual_type`` (min, mean, max or sum) of the quality
+    scores in the window is no longer below ``threshold``. The bases of the
+    first window that passes are kept; if no window passes, the read is
+    trimmed entirely.
+    """
+    windows = np.minimum(block.lengths, window)
+    trimmed = np.zeros_like(block.lengths)
+    # all reads at least as long as the window share a single pass
+    for size in np.unique(windows):
+        rows = windows == size
+        if size == 0:
+            continue
+        scores = _window_scores(block.quals[rows], size, qual_type)
+        starts = np.arange(scores.shape[1])
+        fits = starts[None, :] + size <= block.lengths[rows][:, None]
+        passing = (scores >= threshold) & fits
+        last = scores.shape[1] - 1 - np.argmax(passing[:, ::-1], axis=1)
+        trimmed[rows] = np.where(passing.any(axis=1), last + size, 0)
+    block.lengths = trimmed
+
+
+def _window_scores(quals, size, qual_type):
+    # scores of every window of the given size, indexed by window start
+    if qual_type in ('sum', 'mean'):
+        sums = np.cumsum(quals, axis=1)
+        sums = np.concatenate(
+            [np.zeros((len(quals), 1), dtype=sums.dtype), sums], axis=1)
+        scores = sums[:, size:] - sums[:, :-size]
+        return scores / size if qual_type == 'mean' else scores
+    # a read-only view of every window, without copying the qualities
+    rows, cols = quals.strides
+    windows = as_strided(
+        quals, shape=(len(quals), quals.shape[1] - size + 1, size),
+        strides=(rows, cols, cols), writeable=False)
+    return windows.min(axis=2) if qual_type == 'min' else windows.max(axis=2)
+
+
+def min_len_mask(block, min_len):
+    return block.lengths >= min_len
+
+
+def min_qual_mean_mask(block, min_qual_mean):
+    # qualities past each read's (trimmed) end are not part of its mean
+    in_read = np.arange(block.quals.shape[1])[None, :] < \
+        block.lengths[:, None]
+    sums = (block.quals * in_read).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / block.lengths
+    return np.nan_to_num(means, nan=0.0) >= min_qual_mean
+
+
+def _windows(lengths):
+    # (read, start, size) of the windows each read is scored over: reads of
+    # up to DUST_WINDOW bases are a single window, longer reads are covered
+    # by windows of DUST_WINDOW bases starting every DUST_STEP bases, up to
+    # the last, which runs to the end of the read and so is from
+    # DUST_STEP + 1 to DUST_WINDOW bases long
+    steps = np.where(lengths > DUST_WINDOW,
+                     (lengths - DUST_WINDOW) // DUST_STEP + 1, 0)
+    rest = lengths - steps * DUST_STEP
+    short_rest = (steps > 0) & (rest <= DUST_STEP)
+    steps = steps - short_rest
+    rest = rest + short_rest * DUST_STEP
+
+    reads = np.repeat(np.arange(len(lengths)), steps + 1)
+    first = np.repeat(np.cumsum(steps + 1) - (steps + 1), steps + 1)
+    index = np.arange(len(reads)) - first
+    sizes = np.where(index < steps[reads], DUST_WINDOW, rest[reads])
+    return reads, index * DUST_STEP, sizes
+
+
+def _word_runs(words, reads, starts, sizes):
+    # sort each window's trinucleotides so that identical ones form runs;
+    # returns the sorted words, each word's 0-based position within its run,
+    # whether it ends its run, and the number of words per window
+    n_words = np.maximum(sizes - WORD_SIZE + 1, 0)
+    positions = np.arange(DUST_WINDOW - WORD_SIZE + 1)[None, :]
+    idx = np.minimum(starts[:, None] + positions, words.shape[1] - 1)
+    window_words = np.where(positions < n_words[:, None],
+                            words[reads[:, None], idx], _N_WORDS)
+    window_words.sort(axis=1)
+
+    new_run = np.ones(window_words.shape, dtype=bool)
+    new_run[:, 1:] = window_words[:, 1:] != window_words[:, :-1]
+    run_start = np.maximum.accumulate(
+        np.where(new_run, positions, 0), axis=1)
+    ends_run = np.ones(window_words.shape, dtype=bool)
+    ends_run[:, :-1] = new_run[:, 1:]
+    valid = window_words < _N_WORDS
+    return positions - run_start, ends_run & valid, valid, n_words
+
+
+def low_complexity_scores(block, method):
+    """Score the sequence complexity of each read in a block, from 0 to 100.
+
+    ``dust`` scores count the repeated trinucleotides in each window (higher
+    is less complex) and ``entropy`` scores are the Shannon entropy of the
+    trinucleotide frequencies in each window, relative to the highest
+    possible (lower is less complex). A read's score is the mean over its
+    windows.
+    """
+    lengths = block.lengths
+    scores = np.zeros(len(lengths))
+    if not len(lengths) or lengths.max() < WORD_SIZE:
+        return scores
+    words = block.words()
+    reads, starts, sizes = _windows(lengths)
+    window_scores = np.zeros(len(reads))
+    for chunk in range(0, len(reads), _WINDOW_CHUNK_SIZE):
+        sl = slice(chunk, chunk + _WINDOW_CHUNK_SIZE)
+        in_run, ends_run, valid, n_words = _word_runs(
+            words, reads[sl], starts[sl], sizes[sl])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if method == 'dust':
+                # a word repeated c times contributes c * (c - 1) / 2 pairs
+                pairs = (in_run * valid).sum(axis=1)
+                chunk_scores = pairs / (n_words - 1) * _DUST_SCALE
+            else:
+                freqs = np.where(ends_run, in_run + 1, 1) / \
+                    n_words[:, None]
+                entropy = -(freqs * np.log(freqs) * ends_run).sum(axis=1)
+                max_entropy = np.log(np.minimum(n_words, 4 ** WORD_SIZE))
+                chunk_scores = entropy / max_entropy * 100
+        window_scores[sl] = np.where(n_words > 1, chunk_scores, 0)
+    counts = np.bincount(reads, minlength=len(lengths))
+    return np.bincount(reads, weights=window_scores,
+                       minlength=len(lengths)) / counts
+
+
+def low_complexity_mask(block, method, threshold):
+    scores = low_complexity_scores(block, method)
+    if method == 'dust':
+        return scores <= threshold
+    return scores >= threshold
+
+
+def trim_and_filter(f_read, r_read, f_out, r_out, trim_qual_right_threshold,
+                    trim_qual_type, trim_qual_window, min_qual_mean, min_len,
+                    lc_method=None, lc_threshold=None, n_workers=1):
+    """Quality-trim and filter gzipped FASTQ reads into uncompressed FASTQ.
+
+    Reads are trimmed from the 3' end, then removed if shorter than
+    ``min_len``, if their mean quality is below ``min_qual_mean`` or, if
+    ``lc_method`` is given, if they are of low complexity. For paired-end
+    reads, a pair is only kept if both mates are.
+
+    With more than one of ``n_workers``, blocks of reads are trimmed and
+    filtered in that many processes, and written out in their original
+    order, so the output does not depend on ``n_workers``.
+    """
+    inputs = [f_read] if r_read is None else [f_read, r_read]
+    outputs = [f_out] if r_read is None else [f_out, r_out]
+    params = (trim_qual_right_threshold, trim_qual_type, trim_qual_window,
+              min_qual_mean, min_len, lc_method, lc_threshold)
+    in_fhs = [open_gzip(fp, 'rb') for fp in inputs]
+    out_fhs = [open(fp, 'wb') for fp in outputs]
+    try:
+        chunks = zip(*[_iter_records(fh, BLOCK_SIZE) for fh in in_fhs])
+        if n_workers == 1:
+            results = (_trim_and_filter_chunk(chunk, *params)
+                       for chunk in chunks)
+            _write_chunks(results, out_fhs)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+                _write_chunks(_map_ordered(pool, _trim_and_filter_chunk,
+                                           chunks, params, 2 * n_workers),
+                              out_fhs)
+    finally:
+        for fh in in_fhs + out_fhs:
+            fh.close()
+
+
+def _iter_records(fh, block_size=BLOCK_SIZE):
+    # record-aligned chunks of raw FASTQ records, cheap to send to workers
+    records = zip(*[fh] * 4)
+    while True:
+        chunk = list(itertools.islice(records, block_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _map_ordered(pool, func, chunks, params, max_pending):
+    # like pool.map, but without reading further ahead than max_pending
+    # chunks, so memory use stays bounded on large inputs
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.submit(func, chunk, *params))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _write_chunks(results, out_fhs):
+    for result in results:
+        for data, out_fh in zip(result, out_fhs):
+            out_fh.write(data)
+
+
+def _trim_and_filter_chunk(records, trim_qual_right_threshold,
+                           trim_qual_type, trim_qual_window, min_qual_mean,
+                           min_len, lc_method, lc_threshold):
+    # records holds a list of records per mate; the kept records of each
+    # mate are returned as FASTQ
+    blocks = [ReadBlock(mate_records) for mate_records in records]
+    keep = np.ones(len(blocks[0].records), dtype=bool)
+    for block in blocks:
+        trim_qual_right(block, trim_qual_right_threshold, trim_qual_type,
+                        trim_qual_window)
+        keep &= min_len_mask(block, min_len)
+        keep &= min_qual_mean_mask(block, min_qual_mean)
+        if lc_method is not None:
+            keep &= low_complexity_mask(block, lc_method, lc_threshold)
+    results = []
+    for block in blocks:
+        buf = io.BytesIO()
+        block.write(buf, keep)
+        results.append(buf.getvalue())
+    return results
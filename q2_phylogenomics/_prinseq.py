@@ -17,7 +17,13 @@ from q2_types.per_sample_sequences import (
     SingleLanePerSamplePairedEndFastqDirFmt,
 )
 
-from ._util import run_command, _gzip_compress, _gzip_decompress
+from ._util import (
+    run_command, run_with_fifos, run_in_parallel, write_bgzf_indexes,
+    _gzip_compress, _gzip_decompress)
+from ._native import trim_and_filter
+from ._derep import dereplicate
+from ._profile import Profile
+from ._scratch import plan_jobs, sample_cost, trim_scratch_bytes
 
 
 _prinseq_defaults = {
@@ -28,12 +34,21 @@ _prinseq_defaults = {
     'min_len': 70,
     'lc_method': 'dust',
     'lc_threshold': 3,
-    'derep': ['1', '4']
+    'derep': ['1', '4'],
+    'backend': 'prinseq',
+    # gigabytes
+    'derep_memory_limit': 4,
+    'stream': False,
+    'n_jobs': 1,
+    'n_threads': 1,
+    'bgzf_index_dir': None,
+    'profile_fp': None,
+    'scratch_dir': None,
 }
 
 
 def _run_prinseq(
-        f_read, r_read, trimmed_seqs,
+        f_read, r_read, output_dir,
         trim_qual_right=_prinseq_defaults['trim_qual_right'],
         trim_qual_type=_prinseq_defaults['trim_qual_type'],
         trim_qual_window=_prinseq_defaults['trim_qual_window'],
@@ -42,15 +57,63 @@ def _run_prinseq(
         lc_method=_prinseq_defaults['lc_method'],
         lc_threshold=_prinseq_defaults['lc_threshold'],
         derep=_prinseq_defaults['derep'],
+        backend=_prinseq_defaults['backend'],
+        derep_memory_limit=_prinseq_defaults['derep_memory_limit'],
+        stream=_prinseq_defaults['stream'],
+        bgzf=False,
+        sample_id=None,
+        scratch_dir=None,
+        n_threads=_prinseq_defaults['n_threads'],
         ):
-    derep = ''.join(derep)
+    """Trim and filter one sample.
+
+    Intermediate files are written to a temporary directory within
+    ``scratch_dir``, or the default temporary directory. Returns the rows of
+    a Profile of the resources used to process it, labelled with
+    ``sample_id``.
+    """
+    profile = Profile()
+    reads = [f_read] if r_read is None else [f_read, r_read]
+    out_fps = [str(output_dir / os.path.basename(fp)) for fp in reads]
     # prinseq-lite only accepts unzipped fastq
-    temp_dir = tempfile.mkdtemp(prefix='a-place-to-put-unzipped-fastqs-')
-    f_out = '{0}/{1}.fastq'.format(temp_dir, os.path.basename(f_read))
-    _gzip_decompress(f_read, f_out)
-    if r_read is not None:
-        r_out = '{0}/{1}.fastq'.format(temp_dir, os.path.basename(r_read))
-        _gzip_decompress(r_read, r_out)
+    temp_dir = tempfile.mkdtemp(prefix='a-place-to-put-unzipped-fastqs-',
+                                dir=scratch_dir)
+    try:
+        _trim(reads, out_fps, temp_dir, profile, sample_id, trim_qual_right,
+              trim_qual_type, trim_qual_window, min_qual_mean, min_len,
+              lc_method, lc_threshold, derep, backend, derep_memory_limit,
+              stream, n_threads, bgzf)
+    finally:
+        shutil.rmtree(temp_dir)
+    return profile.rows
+
+
+def _trim(reads, out_fps, temp_dir, profile, sample_id, trim_qual_right,
+          trim_qual_type, trim_qual_window, min_qual_mean, min_len,
+          lc_method, lc_threshold, derep, backend, derep_memory_limit,
+          stream, n_threads, bgzf, compressed=True):
+    """Trim and filter the gzipped ``reads`` of one sample into ``out_fps``.
+
+    The outputs are gzipped, or left uncompressed if not ``compressed``.
+    ``temp_dir`` holds intermediate files, and the stages run are added to
+    ``profile``.
+    """
+    derep = ''.join(derep)
+    in_fps = ['{0}/{1}.fastq'.format(temp_dir, os.path.basename(fp))
+              for fp in reads]
+
+    if backend == 'native':
+        # dereplication needs all of the filtered reads, so they are written
+        # out uncompressed before being dereplicated into the output
+        with profile.stage(sample_id, 'trim and filter', reads, in_fps):
+            trim_and_filter(*_pair(reads), *_pair(in_fps), trim_qual_right,
+                            trim_qual_type, trim_qual_window, min_qual_mean,
+                            min_len, lc_method, lc_threshold, n_threads)
+        with profile.stage(sample_id, 'dereplicate', in_fps, out_fps):
+            dereplicate(in_fps, out_fps, derep,
+                        derep_memory_limit * 1024 ** 3, temp_dir, n_threads,
+                        bgzf, compressed)
+        return
 
     outname = temp_dir + '/outfile'
 
@@ -66,26 +129,59 @@ def _run_prinseq(
         '-derep', str(derep),
         '-out_good', outname,
         '-out_bad', 'null',
-        '-fastq', f_out,
+        '-fastq', in_fps[0],
     ]
 
-    if r_read is not None:
-        cmd += ['-fastq2', r_out]
-
-    run_command(cmd)
+    if len(reads) == 2:
+        cmd += ['-fastq2', in_fps[1]]
 
-    # copy prinseq output to its new home
     # prinseq has its own output path naming scheme, so rename to keep Q2 happy
-    if r_read is not None:
-        r_read = str(trimmed_seqs.path / os.path.basename(r_read))
-        _gzip_compress(outname + '_2.fastq', r_read)
-        # if using paired-end data, adjust the trimmed forward read filepath.
-        # For details see prinseq-lite manual -out_good option.
-        outname += '_1'
-    f_read = str(trimmed_seqs.path / os.path.basename(f_read))
-    _gzip_compress(outname + '.fastq', f_read)
+    # if using paired-end data, the forward reads are suffixed with _1. For
+    # details see prinseq-lite manual -out_good option.
+    goods = ([outname + '.fastq'] if len(reads) == 1
+             else [outname + '_1.fastq', outname + '_2.fastq'])
+    log = []
+
+    if stream:
+        inputs = dict(zip(in_fps, reads))
+        outputs = dict(zip(goods, out_fps)) if compressed else {}
+        # (de)compression happens while prinseq-lite runs, so it is all one
+        # stage, measured from the compressed files
+        run_with_fifos(cmd, inputs, outputs, threads=n_threads, bgzf=bgzf,
+                       log=log)
+        profile.add_commands(sample_id, log, reads,
+                             out_fps if compressed else goods)
+    else:
+        with profile.stage(sample_id, 'decompress', reads, in_fps):
+            for read, in_fp in zip(reads, in_fps):
+                _gzip_decompress(read, in_fp)
+        run_command(cmd, log=log)
+        profile.add_commands(sample_id, log, in_fps, goods)
+        if compressed:
+            # copy prinseq output to its new home
+            with profile.stage(sample_id, 'compress', goods, out_fps):
+                for good, out_fp in zip(goods, out_fps):
+                    _gzip_compress(good, out_fp, n_threads, bgzf)
+
+    if not compressed:
+        for good, out_fp in zip(goods, out_fps):
+            os.replace(good, out_fp)
+
 
-    shutil.rmtree(temp_dir)
+def _pair(fps):
+    # forward and reverse paths, the latter None for single-end reads
+    return fps[0], fps[1] if len(fps) == 2 else None
+
+
+def _write_profile(profiles, profile_fp):
+    profile = Profile()
+    for rows in profiles:
+        profile.extend(rows)
+    profile.write(profile_fp)
+
+
+def _output_fps(trimmed_sequences):
+    return sorted(str(fp) for fp in trimmed_sequences.path.glob('*.fastq.gz'))
 
 
 def prinseq_single(
@@ -97,15 +193,23 @@ def prinseq_single(
         min_len: int = _prinseq_defaults['min_len'],
         lc_method: str = _prinseq_defaults['lc_method'],
         lc_threshold: int = _prinseq_defaults['lc_threshold'],
-        derep: str = _prinseq_defaults['derep']) -> \
+        derep: str = _prinseq_defaults['derep'],
+        backend: str = _prinseq_defaults['backend'],
+        derep_memory_limit: int = _prinseq_defaults['derep_memory_limit'],
+        stream: bool = _prinseq_defaults['stream'],
+        n_jobs: int = _prinseq_defaults['n_jobs'],
+        n_threads: int = _prinseq_defaults['n_threads'],
+        bgzf_index_dir: str = _prinseq_defaults['bgzf_index_dir'],
+        profile_fp: str = _prinseq_defaults['profile_fp'],
+        scratch_dir: str = _prinseq_defaults['scratch_dir']) -> \
             CasavaOneEightSingleLanePerSampleDirFmt:
-    trimmed_sequences = CasavaOneEightSingleLanePerSampleDirFmt()
     df = demultiplexed_sequences.manifest.view(pd.DataFrame)
-    for _, fwd in df.itertuples():
-        _run_prinseq(fwd, None, trimmed_sequences, trim_qual_right,
-                     trim_qual_type, trim_qual_window, min_qual_mean, min_len,
-                     lc_method, lc_threshold, derep)
-    return trimmed_sequences
+    samples = [(sample_id, fwd, None) for sample_id, fwd in df.itertuples()]
+    return _prinseq_samples(samples, trim_qual_right, trim_qual_type,
+                            trim_qual_window, min_qual_mean, min_len,
+                            lc_method, lc_threshold, derep, backend,
+                            derep_memory_limit, stream, n_jobs, n_threads,
+                            bgzf_index_dir, profile_fp, scratch_dir)
 
 
 def prinseq_paired(
@@ -117,12 +221,53 @@ def prinseq_paired(
         min_len: int = _prinseq_defaults['min_len'],
         lc_method: str = _prinseq_defaults['lc_method'],
         lc_threshold: int = _prinseq_defaults['lc_threshold'],
-        derep: str = _prinseq_defaults['derep']) -> \
+        derep: str = _prinseq_defaults['derep'],
+        backend: str = _prinseq_defaults['backend'],
+        derep_memory_limit: int = _prinseq_defaults['derep_memory_limit'],
+        stream: bool = _prinseq_defaults['stream'],
+        n_jobs: int = _prinseq_defaults['n_jobs'],
+        n_threads: int = _prinseq_defaults['n_threads'],
+        bgzf_index_dir: str = _prinseq_defaults['bgzf_index_dir'],
+        profile_fp: str = _prinseq_defaults['profile_fp'],
+        scratch_dir: str = _prinseq_defaults['scratch_dir']) -> \
             CasavaOneEightSingleLanePerSampleDirFmt:
-    trimmed_sequences = CasavaOneEightSingleLanePerSampleDirFmt()
     df = demultiplexed_sequences.manifest.view(pd.DataFrame)
-    for _, fwd, rev in df.itertuples():
-        _run_prinseq(fwd, rev, trimmed_sequences, trim_qual_right,
-                     trim_qual_type, trim_qual_window, min_qual_mean, min_len,
-                     lc_method, lc_threshold, derep)
+    samples = list(df.itertuples())
+    return _prinseq_samples(samples, trim_qual_right, trim_qual_type,
+                            trim_qual_window, min_qual_mean, min_len,
+                            lc_method, lc_threshold, derep, backend,
+                            derep_memory_limit, stream, n_jobs, n_threads,
+                            bgzf_index_dir, profile_fp, scratch_dir)
+
+
+def _prinseq_samples(samples, trim_qual_right, trim_qual_type,
+                     trim_qual_window, min_qual_mean, min_len, lc_method,
+                     lc_threshold, derep, backend, derep_memory_limit, stream,
+                     n_jobs, n_threads, bgzf_index_dir, profile_fp,
+                     scratch_dir):
+    trimmed_sequences = CasavaOneEightSingleLanePerSampleDirFmt()
+    reads = [[fp for fp in sample[1:] if fp is not None]
+             for sample in samples]
+    n_jobs = plan_jobs(
+        [trim_scratch_bytes(sample_reads, backend, stream, derep)
+         for sample_reads in reads], n_jobs, scratch_dir)
+    # each sample is written to its own file, so the outputs do not depend
+    # on the order in which the samples finish
+    jobs = [(fwd, rev, trimmed_sequences.path, trim_qual_right,
+             trim_qual_type, trim_qual_window, min_qual_mean, min_len,
+             lc_method, lc_threshold, derep, backend, derep_memory_limit,
+             stream, bgzf_index_dir is not None, sample_id, scratch_dir)
+            for sample_id, fwd, rev in samples]
+    # the n_threads of each of the n_jobs running samples are pooled and
+    # shared out as samples start
+    profiles = run_in_parallel(
+        _run_prinseq, jobs, n_jobs, processes=True,
+        costs=[sample_cost(sample_reads) for sample_reads in reads],
+        n_threads=n_threads * n_jobs,
+        names=['Sample %s' % sample[0] for sample in samples])
+    if bgzf_index_dir is not None:
+        write_bgzf_indexes(_output_fps(trimmed_sequences), bgzf_index_dir,
+                           n_jobs)
+    if profile_fp is not None:
+        _write_profile(profiles, profile_fp)
     return trimmed_sequences
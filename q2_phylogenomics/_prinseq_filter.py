@@ -0,0 +1,180 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+from q2_types.bowtie2 import Bowtie2IndexDirFmt
+from q2_types.per_sample_sequences import (
+    CasavaOneEightSingleLanePerSampleDirFmt,
+    SingleLanePerSampleSingleEndFastqDirFmt,
+    SingleLanePerSamplePairedEndFastqDirFmt,
+)
+
+from ._filter import (
+    _filter_defaults, _bowtie2_filter, _input_fps, _output_fps, _warm_index,
+    _STATS_COLUMNS)
+from ._prinseq import _prinseq_defaults, _pair, _trim, _write_profile
+from ._profile import Profile
+from ._scratch import plan_jobs, sample_cost, trim_scratch_bytes
+from ._util import run_in_parallel, write_bgzf_indexes
+
+
+def prinseq_filter_single(
+        demultiplexed_sequences: SingleLanePerSampleSingleEndFastqDirFmt,
+        database: Bowtie2IndexDirFmt,
+        trim_qual_right: int = _prinseq_defaults['trim_qual_right'],
+        trim_qual_type: str = _prinseq_defaults['trim_qual_type'],
+        trim_qual_window: int = _prinseq_defaults['trim_qual_window'],
+        min_qual_mean: int = _prinseq_defaults['min_qual_mean'],
+        min_len: int = _prinseq_defaults['min_len'],
+        lc_method: str = _prinseq_defaults['lc_method'],
+        lc_threshold: int = _prinseq_defaults['lc_threshold'],
+        derep: str = _prinseq_defaults['derep'],
+        backend: str = _prinseq_defaults['backend'],
+        derep_memory_limit: int = _prinseq_defaults['derep_memory_limit'],
+        stream: bool = _prinseq_defaults['stream'],
+        n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs'],
+        mode: str = _filter_defaults['mode'],
+        sensitivity: str = _filter_defaults['sensitivity'],
+        ref_gap_open_penalty: str = _filter_defaults['ref_gap_open_penalty'],
+        ref_gap_ext_penalty: str = _filter_defaults['ref_gap_ext_penalty'],
+        exclude_seqs: bool = _filter_defaults['exclude_seqs'],
+        memory_map_index: bool = _filter_defaults['memory_map_index'],
+        bgzf_index_dir: str = _filter_defaults['bgzf_index_dir'],
+        profile_fp: str = _filter_defaults['profile_fp'],
+        scratch_dir: str = _prinseq_defaults['scratch_dir']) -> \
+            (CasavaOneEightSingleLanePerSampleDirFmt, pd.DataFrame):
+    df = demultiplexed_sequences.manifest.view(pd.DataFrame)
+    samples = [(sample_id, fwd, None) for sample_id, fwd in df.itertuples()]
+    return _prinseq_filter_samples(
+        samples, database, trim_qual_right, trim_qual_type, trim_qual_window,
+        min_qual_mean, min_len, lc_method, lc_threshold, derep, backend,
+        derep_memory_limit, stream, n_threads, n_jobs, mode, sensitivity,
+        ref_gap_open_penalty, ref_gap_ext_penalty, exclude_seqs,
+        memory_map_index, bgzf_index_dir, profile_fp, scratch_dir)
+
+
+def prinseq_filter_paired(
+        demultiplexed_sequences: SingleLanePerSamplePairedEndFastqDirFmt,
+        database: Bowtie2IndexDirFmt,
+        trim_qual_right: int = _prinseq_defaults['trim_qual_right'],
+        trim_qual_type: str = _prinseq_defaults['trim_qual_type'],
+        trim_qual_window: int = _prinseq_defaults['trim_qual_window'],
+        min_qual_mean: int = _prinseq_defaults['min_qual_mean'],
+        min_len: int = _prinseq_defaults['min_len'],
+        lc_method: str = _prinseq_defaults['lc_method'],
+        lc_threshold: int = _prinseq_defaults['lc_threshold'],
+        derep: str = _prinseq_defaults['derep'],
+        backend: str = _prinseq_defaults['backend'],
+        derep_memory_limit: int = _prinseq_defaults['derep_memory_limit'],
+        stream: bool = _prinseq_defaults['stream'],
+        n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs'],
+        mode: str = _filter_defaults['mode'],
+        sensitivity: str = _filter_defaults['sensitivity'],
+        ref_gap_open_penalty: str = _filter_defaults['ref_gap_open_penalty'],
+        ref_gap_ext_penalty: str = _filter_defaults['ref_gap_ext_penalty'],
+        exclude_seqs: bool = _filter_defaults['exclude_seqs'],
+        memory_map_index: bool = _filter_defaults['memory_map_index'],
+        bgzf_index_dir: str = _filter_defaults['bgzf_index_dir'],
+        profile_fp: str = _filter_defaults['profile_fp'],
+        scratch_dir: str = _prinseq_defaults['scratch_dir']) -> \
+            (CasavaOneEightSingleLanePerSampleDirFmt, pd.DataFrame):
+    df = demultiplexed_sequences.manifest.view(pd.DataFrame)
+    # plain tuples, as the namedtuples of itertuples cannot be pickled
+    samples = [tuple(sample) for sample in df.itertuples()]
+    return _prinseq_filter_samples(
+        samples, database, trim_qual_right, trim_qual_type, trim_qual_window,
+        min_qual_mean, min_len, lc_method, lc_threshold, derep, backend,
+        derep_memory_limit, stream, n_threads, n_jobs, mode, sensitivity,
+        ref_gap_open_penalty, ref_gap_ext_penalty, exclude_seqs,
+        memory_map_index, bgzf_index_dir, profile_fp, scratch_dir)
+
+
+def _prinseq_filter_samples(samples, database, trim_qual_right,
+                            trim_qual_type, trim_qual_window, min_qual_mean,
+                            min_len, lc_method, lc_threshold, derep, backend,
+                            derep_memory_limit, stream, n_threads, n_jobs,
+                            mode, sensitivity, ref_gap_open_penalty,
+                            ref_gap_ext_penalty, exclude_seqs,
+                            memory_map_index, bgzf_index_dir, profile_fp,
+                            scratch_dir):
+    bgzf = bgzf_index_dir is not None
+    filtered_seqs = CasavaOneEightSingleLanePerSampleDirFmt()
+    index = str(database.path / database.get_basename())
+    n_jobs = plan_jobs(
+        [trim_scratch_bytes([fp for fp in sample[1:] if fp is not None],
+                            backend, stream, derep, compressed=False)
+         for sample in samples], n_jobs, scratch_dir)
+    jobs = [(sample, _output_fps(filtered_seqs, sample), index,
+             (trim_qual_right, trim_qual_type, trim_qual_window,
+              min_qual_mean, min_len, lc_method, lc_threshold, derep,
+              backend, derep_memory_limit, stream),
+             mode, sensitivity, ref_gap_open_penalty,
+             ref_gap_ext_penalty, exclude_seqs, memory_map_index, bgzf,
+             scratch_dir)
+            for sample in samples]
+    if memory_map_index and jobs:
+        _warm_index(database.path)
+    results = run_in_parallel(
+        _prinseq_filter_sample, jobs, n_jobs, processes=True,
+        costs=[sample_cost(_input_fps(sample)) for sample in samples],
+        n_threads=n_threads,
+        names=['Sample %s' % sample[0] for sample in samples])
+
+    if bgzf:
+        write_bgzf_indexes(
+            [fp for sample in samples
+             for fp in _output_fps(filtered_seqs, sample)],
+            bgzf_index_dir, n_jobs)
+    if profile_fp is not None:
+        _write_profile([rows for _, rows in results], profile_fp)
+
+    stats = pd.DataFrame(
+        [sample_stats for sample_stats, _ in results],
+        index=pd.Index([sample[0] for sample in samples], name='sample-id'),
+        columns=_STATS_COLUMNS)
+    return filtered_seqs, stats
+
+
+def _prinseq_filter_sample(sample, outputs, index, trim_params, mode,
+                           sensitivity, ref_gap_open_penalty,
+                           ref_gap_ext_penalty, exclude_seqs,
+                           memory_map_index, bgzf, scratch_dir,
+                           n_threads=_filter_defaults['n_threads']):
+    """Trim and filter one sample, then filter it against ``index``.
+
+    The trimmed reads are handed to bowtie2 uncompressed in a temporary
+    directory within ``scratch_dir``, so only the final outputs are ever
+    compressed. Returns the sample's filter stats and the rows of a Profile
+    of the resources used.
+    """
+    sample_id, *reads = sample
+    reads = [fp for fp in reads if fp is not None]
+    profile = Profile()
+    temp_dir = tempfile.mkdtemp(prefix='q2-prinseq-filter-', dir=scratch_dir)
+    try:
+        trimmed = [os.path.join(temp_dir, 'trimmed-%d.fastq' % i)
+                   for i in range(len(reads))]
+        _trim(reads, trimmed, temp_dir, profile, sample_id, *trim_params,
+              n_threads, bgzf, compressed=False)
+        log = []
+        stats = _bowtie2_filter(*_pair(trimmed), outputs, index,
+                                n_threads, mode, sensitivity,
+                                ref_gap_open_penalty, ref_gap_ext_penalty,
+                                exclude_seqs, memory_map_index, bgzf=bgzf,
+                                log=log)
+        profile.add_commands(sample_id, log, trimmed, outputs)
+    finally:
+        shutil.rmtree(temp_dir)
+    return stats, profile.rows
@@ -0,0 +1,102 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import os
+import resource
+import threading
+import time
+
+import pandas as pd
+
+from ._util import _MAXRSS_UNIT
+
+
+COLUMNS = ['sample-id', 'stage', 'wall time (s)', 'cpu time (s)',
+           'max rss (bytes)', 'bytes in', 'bytes out']
+
+
+class Profile:
+    """Resources used by each stage of processing each sample.
+
+    Stages are either external commands, recorded from the CommandStats
+    logged while running them, or steps that run in this process, which are
+    timed with ``stage``. The CPU time of the latter is that used by the
+    whole process during the stage, including any worker processes it
+    started and waited for, so stages must not overlap within a process.
+    Their peak memory is the high-water mark of this process alone, which
+    is not reset between stages. Rows can be added from several threads at
+    once.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def add(self, sample_id, stage, wall_time, cpu_time, max_rss,
+            bytes_in=None, bytes_out=None):
+        with self._lock:
+            self.rows.append((sample_id, stage, wall_time, cpu_time, max_rss,
+                              bytes_in, bytes_out))
+
+    def add_commands(self, sample_id, log, in_fps=(), out_fps=()):
+        """Add a row per command in ``log``.
+
+        The sizes of ``in_fps`` are attributed to the first command, and
+        those of ``out_fps`` to the last, as for the ends of a pipeline.
+        """
+        for i, stats in enumerate(log):
+            self.add(sample_id, _stage_name(stats.cmd), stats.wall_time,
+                     stats.cpu_time, stats.max_rss,
+                     _size(in_fps) if i == 0 else None,
+                     _size(out_fps) if i == len(log) - 1 else None)
+
+    @contextlib.contextmanager
+    def stage(self, sample_id, stage, in_fps=(), out_fps=()):
+        """Time the body of the with statement as a stage of ``sample_id``.
+
+        The sizes of ``in_fps`` and ``out_fps`` are recorded once the body
+        has finished.
+        """
+        start, start_cpu = time.monotonic(), _cpu_time()
+        yield
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.add(sample_id, stage, time.monotonic() - start,
+                 _cpu_time() - start_cpu, max_rss * _MAXRSS_UNIT,
+                 _size(in_fps), _size(out_fps))
+
+    def extend(self, rows):
+        with self._lock:
+            self.rows.extend(rows)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows, columns=COLUMNS)
+
+    def write(self, fp):
+        self.to_dataframe().to_csv(fp, sep='\t', index=False)
+
+
+def _cpu_time():
+    # of this process and the child processes that it has waited for
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+        resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _stage_name(cmd):
+    # e.g. bowtie2, prinseq-lite.pl or samtools view
+    name = os.path.basename(cmd[0])
+    if len(cmd) > 1 and cmd[1].isalpha():
+        name += ' ' + cmd[1]
+    return name
+
+
+def _size(fps):
+    if not fps:
+        return None
+    return sum(os.path.getsize(fp) for fp in fps if os.path.exists(fp))
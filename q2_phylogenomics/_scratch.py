@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import zlib
+
+from ._derep import _ENTRY, _derep_types
+
+
+# compressed bytes read from the start of each file to estimate its
+# uncompressed size
+SAMPLE_SIZE = 1024 * 1024
+
+# fraction of the free scratch space that samples are planned to fill, to
+# leave room for error in the estimates and for other users of the disk
+HEADROOM = 0.9
+
+
+def uncompressed_size(fp, sample_size=SAMPLE_SIZE):
+    """Estimate the uncompressed size and number of records of a gzipped
+    FASTQ file.
+
+    The compression ratio and record size are measured over the first
+    ``sample_size`` compressed bytes and extrapolated to the whole file.
+    """
+    size = os.path.getsize(fp)
+    consumed = produced = lines = 0
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(fp, 'rb') as fh:
+        while consumed < sample_size:
+            chunk = decompressor.unconsumed_tail or fh.read(
+                min(65536, sample_size - consumed))
+            if not chunk:
+                break
+            data = decompressor.decompress(chunk, 65536)
+            consumed += len(chunk) - len(decompressor.unconsumed_tail)
+            produced += len(data)
+            lines += data.count(b'\n')
+            if decompressor.eof:
+                # the start of the next gzip member, e.g. of a BGZF block
+                tail = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                if tail:
+                    consumed -= len(tail)
+                    fh.seek(consumed)
+    if not consumed:
+        return 0, 0
+    ratio = size / consumed
+    return int(produced * ratio), int(lines / 4 * ratio)
+
+
+def sample_cost(reads):
+    """Estimate the relative cost of processing the gzipped FASTQ files
+    ``reads``, for ordering samples largest first.
+
+    Trimming and alignment take time in proportion to the number of reads,
+    which the compressed size tracks closely enough to order samples that
+    were compressed the same way, without reading any of them.
+    """
+    return sum(os.path.getsize(fp) for fp in reads)
+
+
+def trim_scratch_bytes(reads, backend, stream, derep, compressed=True):
+    """Estimate the peak scratch space used to trim one sample.
+
+    ``reads`` are the sample's gzipped FASTQ files, and the other arguments
+    are as for _trim in _prinseq. Trimming only ever removes reads, so the
+    uncompressed size of the input bounds that of each intermediate copy.
+    """
+    sizes = [uncompressed_size(fp) for fp in reads]
+    total = sum(size for size, _ in sizes)
+    if backend == 'native':
+        # the trimmed reads, and the hashes that dereplication spills: one
+        # per read, or per pair, and another of its reverse complement
+        n_types = 2 if _derep_types(derep) & {'4', '5'} else 1
+        _, n_reads = sizes[0]
+        spilled = (n_reads * n_types * _ENTRY.itemsize
+                   if _derep_types(derep) else 0)
+        return total + spilled + (0 if compressed else total)
+    if stream:
+        # only uncompressed outputs are written to disk
+        return 0 if compressed else total
+    # the decompressed inputs and prinseq-lite's outputs
+    return 2 * total
+
+
+def cascade_scratch_bytes(reads, exclude_seqs):
+    """Estimate the peak scratch space used to filter one sample against
+    index shards in turn (see _bowtie2_filter_cascade).
+    """
+    compressed = sum(os.path.getsize(fp) for fp in reads)
+    # the reads passed to a shard, and those left over for the next one
+    peak = 2 * compressed
+    if not exclude_seqs and len(reads) == 1:
+        # the reads that aligned to the shard, before they are appended to
+        # the output
+        peak += compressed
+    return peak
+
+
+def plan_jobs(estimates, n_jobs, scratch_dir=None):
+    """Limit ``n_jobs`` to the samples that fit in the free scratch space.
+
+    ``estimates`` are the peak scratch bytes of each sample. The largest
+    ``n_jobs`` samples are assumed to run at once, so n_jobs is reduced
+    until they fit, and a ValueError is raised if even the largest sample
+    would not fit on its own, or if ``scratch_dir`` is not a directory.
+    """
+    if scratch_dir is None:
+        scratch_dir = tempfile.gettempdir()
+    elif not os.path.isdir(scratch_dir):
+        raise ValueError('The scratch directory %s does not exist or is not '
+                         'a directory.' % scratch_dir)
+    peaks = sorted(estimates, reverse=True)
+    if not peaks or not peaks[0]:
+        return n_jobs
+    free = shutil.disk_usage(scratch_dir).free
+    budget = free * HEADROOM
+    if peaks[0] > budget:
+        raise ValueError(
+            'Processing the largest sample needs an estimated %s of scratch '
+            'space, but only %s is free in %s. Choose a location with more '
+            'free space with scratch_dir.' % (
+                _format_bytes(peaks[0]), _format_bytes(free), scratch_dir))
+    planned = n_jobs
+    while planned > 1 and sum(peaks[:planned]) > budget:
+        planned -= 1
+    if planned < n_jobs:
+        print('Processing %d samples concurrently needs an estimated %s of '
+              'scratch space, but only %s is free in %s. Processing %d at a '
+              'time instead.' % (n_jobs, _format_bytes(sum(peaks[:n_jobs])),
+                                 _format_bytes(free), scratch_dir, planned))
+    return planned
+
+
+def _format_bytes(n_bytes):
+    if n_bytes < 1024:
+        return '%d bytes' % n_bytes
+    for unit in ['KiB', 'MiB', 'GiB', 'TiB']:
+        n_bytes /= 1024
+        if n_bytes < 1024 or unit == 'TiB':
+            return '%.1f %s' % (n_bytes, unit)
@@ -0,0 +1,150 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import heapq
+import os
+import tempfile
+
+import pandas as pd
+
+from q2_types.feature_data import DNAFASTAFormat
+from q2_types.per_sample_sequences import (
+    CasavaOneEightSingleLanePerSampleDirFmt,
+    SingleLanePerSampleSingleEndFastqDirFmt,
+    SingleLanePerSamplePairedEndFastqDirFmt,
+)
+
+from ._format import Bowtie2ShardedIndexDirFmt
+from ._filter import _filter_defaults, _filter_samples, _split_threads
+from ._util import run_command, run_in_parallel
+
+
+_sharded_defaults = {
+    'n_shards': 2,
+}
+
+
+def bowtie2_build_sharded(
+        sequences: DNAFASTAFormat,
+        n_shards: int = _sharded_defaults['n_shards'],
+        n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs']) -> \
+            Bowtie2ShardedIndexDirFmt:
+    database = Bowtie2ShardedIndexDirFmt()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shard_fps = [os.path.join(temp_dir, 'shard-%d.fasta' % i)
+                     for i in range(n_shards)]
+        n_shards = _split_fasta(str(sequences), shard_fps)
+
+        threads_per_job = _split_threads(n_threads, n_jobs)
+        jobs = []
+        for i, shard_fp in enumerate(shard_fps[:n_shards]):
+            jobs.append((['bowtie2-build', '--threads', str(threads_per_job),
+                          shard_fp, str(database.path / ('shard-%d' % i))],))
+        run_in_parallel(run_command, jobs, n_jobs,
+                        names=['Shard %d' % i for i in range(n_shards)])
+    return database
+
+
+def _split_fasta(fasta_fp, shard_fps):
+    """Split a FASTA file into shards of roughly equal total sequence length.
+
+    Records are assigned largest first to the shard with the least sequence
+    so far, and copied in their original order. Returns the number of
+    shards written, which is smaller than ``len(shard_fps)`` if there are
+    fewer records than shards.
+    """
+    # byte offset, byte length and sequence length of every record
+    records = []
+    with open(fasta_fp, 'rb') as fh:
+        offset = 0
+        for line in fh:
+            if line.startswith(b'>'):
+                if records:
+                    records[-1][1] = offset - records[-1][0]
+                records.append([offset, None, 0])
+            elif records:
+                records[-1][2] += len(line.strip())
+            offset += len(line)
+        if records:
+            records[-1][1] = offset - records[-1][0]
+
+    n_shards = min(len(shard_fps), len(records))
+    shards = [(0, i) for i in range(n_shards)]
+    assignments = [None] * len(records)
+    for record in sorted(range(len(records)),
+                         key=lambda r: records[r][2], reverse=True):
+        size, shard = heapq.heappop(shards)
+        assignments[record] = shard
+        heapq.heappush(shards, (size + records[record][2], shard))
+
+    outputs = [open(fp, 'wb') for fp in shard_fps[:n_shards]]
+    try:
+        with open(fasta_fp, 'rb') as fh:
+            for (offset, length, _), shard in zip(records, assignments):
+                fh.seek(offset)
+                outputs[shard].write(fh.read(length))
+    finally:
+        for output in outputs:
+            output.close()
+    return n_shards
+
+
+def filter_single_sharded(
+        demultiplexed_sequences: SingleLanePerSampleSingleEndFastqDirFmt,
+        database: Bowtie2ShardedIndexDirFmt,
+        n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs'],
+        mode: str = _filter_defaults['mode'],
+        sensitivity: str = _filter_defaults['sensitivity'],
+        ref_gap_open_penalty: str = _filter_defaults['ref_gap_open_penalty'],
+        ref_gap_ext_penalty: str = _filter_defaults['ref_gap_ext_penalty'],
+        exclude_seqs: bool = _filter_defaults['exclude_seqs'],
+        memory_map_index: bool = _filter_defaults['memory_map_index'],
+        checkpoint_dir: str = _filter_defaults['checkpoint_dir'],
+        bgzf_index_dir: str = _filter_defaults['bgzf_index_dir'],
+        profile_fp: str = _filter_defaults['profile_fp'],
+        scratch_dir: str = _filter_defaults['scratch_dir']) -> \
+            (CasavaOneEightSingleLanePerSampleDirFmt, pd.DataFrame):
+    df = demultiplexed_sequences.manifest.view(pd.DataFrame)
+    samples = [(sample_id, fwd, None) for sample_id, fwd in df.itertuples()]
+    return _filter_samples(samples, database.path, _shard_indexes(database),
+                           n_threads, n_jobs, mode, sensitivity,
+                           ref_gap_open_penalty, ref_gap_ext_penalty,
+                           exclude_seqs, memory_map_index, 1, checkpoint_dir,
+                           bgzf_index_dir, profile_fp, scratch_dir)
+
+
+def filter_paired_sharded(
+        demultiplexed_sequences: SingleLanePerSamplePairedEndFastqDirFmt,
+        database: Bowtie2ShardedIndexDirFmt,
+        n_threads: int = _filter_defaults['n_threads'],
+        n_jobs: int = _filter_defaults['n_jobs'],
+        mode: str = _filter_defaults['mode'],
+        sensitivity: str = _filter_defaults['sensitivity'],
+        ref_gap_open_penalty: str = _filter_defaults['ref_gap_open_penalty'],
+        ref_gap_ext_penalty: str = _filter_defaults['ref_gap_ext_penalty'],
+        exclude_seqs: bool = _filter_defaults['exclude_seqs'],
+        memory_map_index: bool = _filter_defaults['memory_map_index'],
+        checkpoint_dir: str = _filter_defaults['checkpoint_dir'],
+        bgzf_index_dir: str = _filter_defaults['bgzf_index_dir'],
+        profile_fp: str = _filter_defaults['profile_fp'],
+        scratch_dir: str = _filter_defaults['scratch_dir']) -> \
+            (CasavaOneEightSingleLanePerSampleDirFmt, pd.DataFrame):
+    df = demultiplexed_sequences.manifest.view(pd.DataFrame)
+    samples = list(df.itertuples())
+    return _filter_samples(samples, database.path, _shard_indexes(database),
+                           n_threads, n_jobs, mode, sensitivity,
+                           ref_gap_open_penalty, ref_gap_ext_penalty,
+                           exclude_seqs, memory_map_index, 1, checkpoint_dir,
+                           bgzf_index_dir, profile_fp, scratch_dir)
+
+
+def _shard_indexes(database):
+    return [str(database.path / basename)
+            for basename in database.get_basenames()]
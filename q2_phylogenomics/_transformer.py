@@ -0,0 +1,37 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import pandas as pd
+import qiime2
+
+from .plugin_setup import plugin
+from ._format import Bowtie2StatsFormat
+
+
+@plugin.register_transformer
+def _1(ff: Bowtie2StatsFormat) -> qiime2.Metadata:
+    return qiime2.Metadata.load(str(ff))
+
+
+@plugin.register_transformer
+def _2(obj: qiime2.Metadata) -> Bowtie2StatsFormat:
+    ff = Bowtie2StatsFormat()
+    obj.save(str(ff))
+    return ff
+
+
+@plugin.register_transformer
+def _3(ff: Bowtie2StatsFormat) -> pd.DataFrame:
+    return qiime2.Metadata.load(str(ff)).to_dataframe()
+
+
+@plugin.register_transformer
+def _4(obj: pd.DataFrame) -> Bowtie2StatsFormat:
+    ff = Bowtie2StatsFormat()
+    qiime2.Metadata(obj).save(str(ff))
+    return ff
@@ -0,0 +1,17 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2.plugin import SemanticType
+
+from q2_types.sample_data import SampleData
+
+
+Bowtie2Stats = SemanticType('Bowtie2Stats',
+                            variant_of=SampleData.field['type'])
+
+Bowtie2ShardedIndex = SemanticType('Bowtie2ShardedIndex')
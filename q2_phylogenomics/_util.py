@@ -7,12 +7,46 @@
 # ----------------------------------------------------------------------------
 
 
+import collections
+import errno
+import io
+import itertools
+import os
+import signal
 import subprocess
-import gzip
+import sys
+import concurrent.futures
+import threading
+import time
 import shutil
 
+from ._bgzf import INDEX_EXT, write_index
+from ._codec import open_gzip, compress, decompress
 
-def run_command(cmd, verbose=True):
+
+# ru_maxrss is reported in kilobytes on Linux, but in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+_FIFO_CHUNK_SIZE = 1024 * 1024
+_NEXT_FIFO_SUFFIX = '.next'
+# seconds
+_FIFO_RELEASE_INTERVAL = 0.05
+
+
+# Resources used by one external command: the command, its exit status,
+# wall-clock and CPU (user + system) time in seconds, its peak resident
+# memory in bytes, and its stderr if that was captured.
+CommandStats = collections.namedtuple('CommandStats', [
+    'cmd', 'returncode', 'wall_time', 'cpu_time', 'max_rss', 'stderr'])
+
+
+def run_command(cmd, verbose=True, capture_stderr=False, timeout=None,
+                log=None):
+    """Run a command, raising a CalledProcessError if it fails.
+
+    With ``capture_stderr``, its stderr is echoed as it arrives and also
+    returned. See run_pipeline for ``timeout`` and ``log``.
+    """
     print('Running external command line application. This may print '
           'messages to stdout and/or stderr.')
     print('The commands to be run are below. These commands cannot '
@@ -20,16 +54,382 @@ def run_command(cmd, verbose=True):
           'no longer exist.')
     print('\nCommand:', end=' ')
     print(' '.join(cmd), end='\n\n')
-    subprocess.run(cmd, check=True)
+    stderrs = _run([cmd], None, None, capture_stderr, timeout, log)
+    if capture_stderr:
+        return stderrs[0]
+
+
+def run_pipeline(cmds, verbose=True, feed=None, consume=None,
+                 capture_stderr=False, timeout=None, log=None):
+    """Run commands connected stdout-to-stdin, like a shell pipeline.
+
+    Nothing is buffered on disk between the stages. If given, ``feed`` is
+    called from a separate thread with the first command's stdin, and
+    ``consume`` is called with the last command's stdout; otherwise those
+    streams are inherited. With ``capture_stderr``, the stderr of each
+    command is echoed as usual and also returned, as a list in command
+    order. A CalledProcessError is raised for the first command in the chain
+    that exits with a non-zero status.
+
+    If the commands have not all finished after ``timeout`` seconds, they
+    are killed and a TimeoutExpired is raised. If ``log`` is given, a
+    CommandStats for each command is appended to it, whether or not the
+    commands succeed.
+    """
+    print('Running external command line applications. These may print '
+          'messages to stdout and/or stderr.')
+    print('The commands to be run are below. These commands cannot '
+          'be manually re-run as they will depend on temporary files that '
+          'no longer exist.')
+    print('\nCommand:', end=' ')
+    print(' | '.join(' '.join(cmd) for cmd in cmds), end='\n\n')
+    stderrs = _run(cmds, feed, consume, capture_stderr, timeout, log)
+    if capture_stderr:
+        return stderrs
+
+
+def _run(cmds, feed, consume, capture_stderr, timeout, log):
+    procs = []
+    stderrs = []
+    tees = []
+    upstream = subprocess.PIPE if feed is not None else None
+    stderr = subprocess.PIPE if capture_stderr else None
+    start = time.monotonic()
+    try:
+        for i, cmd in enumerate(cmds):
+            last = i == len(cmds) - 1
+            stdout = (subprocess.PIPE if not last or consume is not None
+                      else None)
+            proc = subprocess.Popen(cmd, stdin=upstream, stdout=stdout,
+                                    stderr=stderr)
+            if i > 0:
+                # drop our copy so the producer sees SIGPIPE if the consumer
+                # dies
+                upstream.close()
+            upstream = proc.stdout
+            procs.append(proc)
+            if capture_stderr:
+                stderrs.append([])
+                tees.append(threading.Thread(
+                    target=_tee_stderr, args=(proc.stderr, stderrs[-1])))
+                tees[-1].start()
+    except BaseException:
+        # e.g. a command that is not installed: the commands already started
+        # are stopped, rather than left running with nothing to read from
+        # or write to them
+        _kill(procs)
+        for proc in procs:
+            for stream in (proc.stdin, proc.stdout):
+                if stream is not None:
+                    stream.close()
+            _reap(proc)
+        for tee in tees:
+            tee.join()
+        raise
+
+    timed_out = threading.Event()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill, args=(procs, timed_out))
+        timer.start()
+
+    feed_errors = []
+    if feed is not None:
+        feeder = threading.Thread(
+            target=_feed_pipe, args=(feed, procs[0].stdin, feed_errors))
+        feeder.start()
+
+    try:
+        if consume is not None:
+            with procs[-1].stdout as fh:
+                consume(fh)
+    except Exception:
+        _kill(procs)
+        raise
+    finally:
+        usages = [_reap(proc) for proc in procs]
+        if timer is not None:
+            timer.cancel()
+        if feed is not None:
+            feeder.join()
+        for tee in tees:
+            tee.join()
+        stderrs = [''.join(lines) for lines in stderrs]
+        if log is not None:
+            for i, (cmd, proc, (end, rusage)) in enumerate(
+                    zip(cmds, procs, usages)):
+                log.append(CommandStats(
+                    cmd, proc.returncode, end - start,
+                    rusage.ru_utime + rusage.ru_stime,
+                    rusage.ru_maxrss * _MAXRSS_UNIT,
+                    stderrs[i] if stderrs else None))
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmds[0] if len(cmds) == 1 else cmds,
+                                        timeout)
+    for i, (cmd, proc) in enumerate(zip(cmds, procs)):
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(
+                proc.returncode, cmd, stderr=stderrs[i] if stderrs else None)
+    if feed_errors:
+        raise feed_errors[0]
+    return stderrs
+
+
+def _kill(procs, killed=None):
+    if killed is not None:
+        killed.set()
+    for proc in procs:
+        # signalled directly, as Popen.kill would first reap a command that
+        # has already exited, leaving _reap nothing to wait for
+        if proc.returncode is None:
+            try:
+                os.kill(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def _reap(proc):
+    # wait for proc with wait4, which also reports the resources it used;
+    # returns when it finished and its rusage
+    _, status, rusage = os.wait4(proc.pid, 0)
+    end = time.monotonic()
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return end, rusage
+
+
+def _tee_stderr(stream, lines):
+    with stream:
+        for line in io.TextIOWrapper(stream, errors='replace'):
+            sys.stderr.write(line)
+            lines.append(line)
+
+
+def _feed_pipe(feed, fh, errors):
+    try:
+        feed(fh)
+    except BrokenPipeError:
+        # the command exited early; its return code explains why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            fh.close()
+        except BrokenPipeError:
+            pass
+
+
+def run_with_fifos(cmd, inputs, outputs, verbose=True, threads=1,
+                   bgzf=False, timeout=None, log=None):
+    """Run a command that reads and writes gzipped files through FIFOs.
+
+    ``inputs`` maps paths that ``cmd`` reads to the gzipped files to
+    decompress into them, and ``outputs`` maps paths that ``cmd`` writes to
+    the gzipped files to compress them into. Named pipes are created at the
+    mapped paths and the (de)compression happens in threads while ``cmd``
+    runs, so no uncompressed copy is ever written to disk. Inputs are
+    supplied in full each time ``cmd`` opens them: every open gets a FIFO
+    of its own (see _feed_fifo). ``threads`` and ``bgzf``
+    are passed on to open_gzip for the outputs, and ``timeout`` and ``log``
+    to run_command.
+    """
+    for fifo in [*inputs, *outputs]:
+        os.mkfifo(fifo)
+
+    done = threading.Event()
+    errors = []
+    feeders = {fifo: threading.Thread(target=_guard, args=(
+                   _feed_fifo, (fifo, gz_fp, done), errors))
+               for fifo, gz_fp in inputs.items()}
+    drainers = [threading.Thread(target=_guard, args=(
+                    _drain_fifo, (fifo, gz_fp, threads, bgzf), errors))
+                for fifo, gz_fp in outputs.items()]
+    for worker in [*feeders.values(), *drainers]:
+        worker.start()
+
+    try:
+        run_command(cmd, verbose=verbose, timeout=timeout, log=log)
+    finally:
+        done.set()
+        for fifo in outputs:
+            _close_fifo(fifo)
+        for worker in drainers:
+            worker.join()
+        for fifo, worker in feeders.items():
+            # a feeder may open the FIFO again after it is released, e.g.
+            # once the exited command's pipe breaks, so keep releasing it
+            while worker.is_alive():
+                _release_fifo(fifo)
+                worker.join(_FIFO_RELEASE_INTERVAL)
+    if errors:
+        raise errors[0]
+
+
+def _guard(func, args, errors):
+    try:
+        func(*args)
+    except Exception as e:
+        errors.append(e)
+
+
+def _feed_fifo(fifo, gz_fp, done):
+    while True:
+        # blocks until the command opens the fifo, or _release_fifo does
+        fd = os.open(fifo, os.O_WRONLY)
+        if done.is_set():
+            os.close(fd)
+            return
+        # Put a new FIFO in place for the next open before writing anything,
+        # so that a reader that reopens the path after reading gets its own
+        # copy of the input, however long it keeps this one open.
+        os.mkfifo(fifo + _NEXT_FIFO_SUFFIX)
+        os.replace(fifo + _NEXT_FIFO_SUFFIX, fifo)
+        with open_gzip(gz_fp, 'rb') as src:
+            try:
+                with open(fd, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, _FIFO_CHUNK_SIZE)
+            except BrokenPipeError:
+                # the reader stopped early, e.g., after sniffing the format
+                pass
+
+
+def _release_fifo(fifo):
+    # release a writer waiting for the command to open a fifo; the path
+    # always exists, as _feed_fifo replaces it atomically
+    os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+
+
+def _drain_fifo(fifo, gz_fp, threads, bgzf):
+    # blocks until the command opens the fifo, or _close_fifo does
+    with open(fifo, 'rb') as src, \
+            open_gzip(gz_fp, 'wb', threads=threads, bgzf=bgzf) as dst:
+        shutil.copyfileobj(src, dst, _FIFO_CHUNK_SIZE)
+
+
+def _close_fifo(fifo):
+    # release a reader still waiting on a fifo that the command never opened
+    try:
+        os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            raise
+
+
+def run_in_parallel(func, jobs, n_jobs=1, processes=False, costs=None,
+                    n_threads=None, names=None):
+    """Call ``func(*args)`` for every ``args`` in ``jobs``.
+
+    Up to ``n_jobs`` calls run at once in a thread pool; the work done by
+    each call is expected to happen in external processes, so threads are
+    sufficient. With ``processes``, a process pool is used instead, for work
+    done in Python; ``func``, ``jobs`` and the results must then be
+    picklable. Results are returned in the order of ``jobs``. The first
+    exception raised cancels all jobs that have not started yet. Once the
+    running jobs have finished, a ValueError naming every job that failed,
+    in the order of ``jobs``, is raised from the first of their exceptions.
+    Jobs are named by ``names`` (e.g. their sample IDs), if given.
+
+    ``costs`` estimate the work in each job, and the jobs are started in
+    decreasing order of cost, so that a large job is not left to run on its
+    own at the end. With ``n_threads``, func is also passed an
+    ``n_threads`` keyword: the threads that are free when jobs start are
+    shared between them in proportion to their costs (or equally, without
+    costs), so large jobs get more threads, and jobs that start once fewer
+    remain than can run at once get those freed by the jobs that finished.
+    A job that starts is always given at least one thread, so no more than
+    ``n_threads`` jobs run at once, and the threads given to the running
+    jobs never add up to more than ``n_threads``.
+    """
+    if names is None:
+        names = ['Job %d' % (i + 1) for i in range(len(jobs))]
+    if n_jobs == 1:
+        kwargs = {} if n_threads is None else {'n_threads': n_threads}
+        results = []
+        for name, args in zip(names, jobs):
+            try:
+                results.append(func(*args, **kwargs))
+            except Exception as e:
+                _raise_failures([(name, e)])
+        return results
+
+    order = list(range(len(jobs)))
+    if costs is not None:
+        order.sort(key=lambda i: costs[i], reverse=True)
+    weights = costs if costs is not None else [1] * len(jobs)
+    pending = collections.deque(order)
+    results = [None] * len(jobs)
+    running = {}
+    free = n_threads
+    errors = []
+    executor = (concurrent.futures.ProcessPoolExecutor if processes
+                else concurrent.futures.ThreadPoolExecutor)
+    with executor(max_workers=n_jobs) as pool:
+        while pending or running:
+            while (pending and len(running) < n_jobs and not errors and
+                   (n_threads is None or free > 0)):
+                i = pending.popleft()
+                kwargs = {}
+                if n_threads is not None:
+                    # this job and those that start alongside it, each of
+                    # which needs a thread of its own
+                    starting = [i, *itertools.islice(
+                        pending, min(n_jobs - len(running), free) - 1)]
+                    total = sum(weights[j] for j in starting)
+                    share = (free * weights[i] // total if total
+                             else free // len(starting))
+                    kwargs['n_threads'] = max(1, share)
+                    free -= kwargs['n_threads']
+                running[pool.submit(func, *jobs[i], **kwargs)] = (
+                    i, kwargs.get('n_threads', 0))
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i, threads = running.pop(future)
+                if n_threads is not None:
+                    free += threads
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    errors.append((i, e))
+    if errors:
+        _raise_failures([(names[i], e) for i, e in sorted(
+            errors, key=lambda error: error[0])])
+    return results
+
+
+def _raise_failures(failures):
+    # failures are (name, exception) pairs
+    raise ValueError('\n'.join(
+        '%s failed with %s: %s' % (name, type(e).__name__, e)
+        for name, e in failures)) from failures[0][1]
+
+
+def write_bgzf_indexes(fps, index_dir, n_jobs=1):
+    """Write the record index of each BGZF file in ``fps`` to index_dir."""
+    os.makedirs(index_dir, exist_ok=True)
+    jobs = [(fp, os.path.join(index_dir, os.path.basename(fp) + INDEX_EXT))
+            for fp in fps]
+    run_in_parallel(write_index, jobs, n_jobs,
+                    names=[os.path.basename(fp) for fp in fps])
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g., src and dst are on different filesystems
+        shutil.copy2(src, dst)
 
 
-def _gzip_compress(input_fp, output_fp):
-    with open(input_fp, 'rb') as temp_in:
-        with gzip.open(output_fp, 'wb') as temp_out:
-            shutil.copyfileobj(temp_in, temp_out)
+def _gzip_compress(input_fp, output_fp, threads=1, bgzf=False):
+    compress(input_fp, output_fp, threads=threads, bgzf=bgzf)
 
 
 def _gzip_decompress(input_fp, output_fp):
-    with gzip.open(input_fp, 'rt') as temp_in:
-        with open(output_fp, 'w') as temp_out:
-            shutil.copyfileobj(temp_in, temp_out)
+    decompress(input_fp, output_fp)
@@ -6,6 +6,8 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import importlib
+
 from qiime2.plugin import (
     Choices,
     Plugin,
@@ -26,7 +28,15 @@ from q2_types.per_sample_sequences import (
 import q2_phylogenomics
 import q2_phylogenomics._prinseq
 import q2_phylogenomics._filter
+import q2_phylogenomics._sharded
+import q2_phylogenomics._prinseq_filter
 from q2_types.bowtie2 import Bowtie2Index
+from q2_phylogenomics._format import (
+    Bowtie2StatsFormat,
+    Bowtie2StatsDirFmt,
+    Bowtie2ShardedIndexDirFmt,
+)
+from q2_phylogenomics._type import Bowtie2Stats, Bowtie2ShardedIndex
 
 
 citations = Citations.load('citations.bib', package='q2_phylogenomics')
@@ -40,6 +50,45 @@ plugin = Plugin(
     short_description='A QIIME 2 plugin for phylogenomics analyses.',
 )
 
+plugin.register_formats(Bowtie2StatsFormat, Bowtie2StatsDirFmt,
+                        Bowtie2ShardedIndexDirFmt)
+plugin.register_semantic_types(Bowtie2Stats, Bowtie2ShardedIndex)
+plugin.register_semantic_type_to_format(
+    SampleData[Bowtie2Stats], artifact_format=Bowtie2StatsDirFmt)
+plugin.register_semantic_type_to_format(
+    Bowtie2ShardedIndex, artifact_format=Bowtie2ShardedIndexDirFmt)
+
+_bgzf_index_dir_description = (
+    'Directory in which to write a record index of each output file. If '
+    'given, the output files are compressed in BGZF, a form of gzip made of '
+    'independent blocks, which can be read by any gzip reader. Together with '
+    'the index, which lists the offset of the first read that starts in '
+    'each block, this allows the files to be split and read in parallel. '
+    'Indexes are named after their output file, with .fqi appended.')
+
+_profile_fp_description = (
+    'Path of a file to which a tab-separated table of the resources used to '
+    'process each sample is written. There is a row for each stage of '
+    'processing a sample: every external command run, and steps such as '
+    '(de)compression that run within QIIME 2. Each row reports the wall '
+    'time, CPU time, peak memory and, where known, the number of bytes read '
+    'and written by the stage. For steps run within QIIME 2, the CPU time '
+    'includes that of any worker processes, but the peak memory is that of '
+    'the process running the sample so far: it is not reset between '
+    'stages, or between the samples processed by one worker when n_jobs is '
+    'more than 1, and excludes the worker processes. By default no table '
+    'is written.')
+
+_scratch_dir_description = (
+    'Directory in which to write temporary files, such as uncompressed '
+    'copies of the reads. A fast local disk or tmpfs is best. The directory '
+    'must already exist. Defaults to the system temporary directory (see '
+    'TMPDIR). Before any sample is processed, the scratch space each sample '
+    'needs is estimated from the sizes of its reads. The action fails '
+    'straight away if the largest sample would not fit in the free space, '
+    'and processes fewer samples concurrently than n_jobs if that many '
+    'would not fit.')
+
 prinseq_input = {'demultiplexed_sequences': 'The sequences to be trimmed.'}
 prinseq_output = {'trimmed_sequences': 'The resulting trimmed sequences.'}
 
@@ -51,7 +100,15 @@ prinseq_parameters = {
     'min_len': Int % Range(1, None),
     'lc_method': Str % Choices(['dust', 'entropy']),
     'lc_threshold': Int % Range(0, 100),
-    'derep': List[Str % Choices(list('12345'))]}
+    'derep': List[Str % Choices(list('12345'))],
+    'backend': Str % Choices(['prinseq', 'native']),
+    'derep_memory_limit': Int % Range(1, None),
+    'stream': Bool,
+    'n_jobs': Int % Range(1, None),
+    'n_threads': Int % Range(1, None),
+    'bgzf_index_dir': Str,
+    'profile_fp': Str,
+    'scratch_dir': Str}
 
 prinseq_parameter_descriptions = {
     'trim_qual_right': 'Trim sequence by quality score from the 3\'-end with '
@@ -74,7 +131,46 @@ prinseq_parameter_descriptions = {
              'as these are subsets of the other option.\n\n1 (exact '
              'duplicate), 2 (5\' duplicate), 3 (3\' duplicate), 4 (reverse '
              'complement exact duplicate), 5 (reverse complement 5\'/3\' '
-             'duplicate).'
+             'duplicate). With the native backend, paired-end reads are '
+             'compared as pairs: a pair is only removed if both of its '
+             'mates are duplicates of the mates of the same pair.',
+    'backend': 'Implementation to use. With native, trimming, filtering '
+               'and dereplication are performed by this plugin on blocks of '
+               'reads at a time, which is considerably faster than '
+               'prinseq-lite and uses bounded memory. Low complexity scores '
+               'use the same windows and scale as prinseq-lite, and the '
+               'output for single-end reads is the same as prinseq-lite\'s. '
+               'See derep for how paired-end reads are dereplicated.',
+    'derep_memory_limit': 'Approximate memory, in gigabytes, that the native '
+                          'backend may use to dereplicate each sample. Read '
+                          'hashes beyond this are spilled to disk. Ignored '
+                          'by the prinseq backend.',
+    'stream': 'Connect prinseq-lite to the input and output reads through '
+              'named pipes, decompressing and compressing them while it '
+              'runs, rather than writing uncompressed copies of them to '
+              'temporary files. Ignored by the native backend.',
+    'n_jobs': 'Number of samples to trim concurrently, each in a separate '
+              'process. The largest samples (by compressed size) are '
+              'started first.',
+    'n_threads': 'Number of processes used to trim and filter a sample '
+                 'with the native backend, on average. The n_threads '
+                 'processes of each of the n_jobs concurrent samples are '
+                 'pooled, and those that are free as samples start are '
+                 'shared between them in proportion to their compressed '
+                 'size, so a large sample may use more than n_threads '
+                 'processes, and samples started once fewer than n_jobs '
+                 'are left also use those of the samples that have '
+                 'finished. Reads are split into blocks that are processed '
+                 'concurrently and written out in their original order, '
+                 'and dereplication is applied to all of the sample\'s '
+                 'reads afterwards, so the output is the same for any '
+                 'number of processes. A sample\'s processes are also the '
+                 'threads used to compress its output, if python-isal is '
+                 'installed or bgzf_index_dir is given; otherwise it is '
+                 'compressed in a single thread.',
+    'bgzf_index_dir': _bgzf_index_dir_description,
+    'profile_fp': _profile_fp_description,
+    'scratch_dir': _scratch_dir_description,
 }
 
 plugin.methods.register_function(
@@ -108,20 +204,41 @@ plugin.methods.register_function(
 
 filter_input = {'demultiplexed_sequences': 'The sequences to be trimmed.',
                 'database': 'Bowtie2 indexed database.'}
-filter_output = {'filtered_sequences': 'The resulting filtered sequences.'}
+filter_output = {
+    'filtered_sequences': 'The resulting filtered sequences.',
+    'filter_stats': 'Per-sample counts of input reads (read pairs for '
+                    'paired-end data), how often they aligned to the '
+                    'reference, and how many were retained. Alignment '
+                    'counts for paired-end data are for concordant '
+                    'alignments, and are not available for samples aligned '
+                    'in batches (see batch_size).'}
 
 filter_parameters = {
     'n_threads': Int % Range(1, None),
+    'n_jobs': Int % Range(1, None),
     'mode': Str % Choices(['local', 'global']),
     'sensitivity': Str % Choices([
         'very-fast', 'fast', 'sensitive', 'very-sensitive']),
     'ref_gap_open_penalty': Int % Range(1, None),
     'ref_gap_ext_penalty': Int % Range(1, None),
     'exclude_seqs': Bool,
+    'memory_map_index': Bool,
+    'batch_size': Int % Range(1, None),
+    'checkpoint_dir': Str,
+    'bgzf_index_dir': Str,
+    'profile_fp': Str,
 }
 
 filter_parameter_descriptions = {
-    'n_threads': 'Number of alignment threads to launch.',
+    'n_threads': 'Total number of threads to launch. When samples are '
+                 'processed concurrently, the threads that are free as '
+                 'samples start are shared between them in proportion to '
+                 'their compressed size, so samples started once fewer than '
+                 'n_jobs are left also get the threads of those that have '
+                 'finished. Every sample needs at least one thread, so no '
+                 'more than n_threads samples are processed at once.',
+    'n_jobs': 'Number of samples to filter concurrently. The largest '
+              'samples (by compressed size) are started first.',
     'mode': 'Bowtie2 alignment settings. See bowtie2 manual for more details.',
     'sensitivity': 'Bowtie2 alignment sensitivity. See bowtie2 manual for '
                    'details.',
@@ -129,7 +246,23 @@ filter_parameter_descriptions = {
     'ref_gap_ext_penalty': 'Reference gap extend penalty.',
     'exclude_seqs': 'Exclude sequences that align to reference. Set this '
                     'option to False to exclude sequences that do not align '
-                    'to the reference database.'
+                    'to the reference database.',
+    'memory_map_index': 'Use memory-mapped I/O to load the index, so that '
+                        'samples filtered concurrently (see n_jobs) share a '
+                        'single copy of it in memory. The index is read into '
+                        'the page cache once before alignment starts.',
+    'batch_size': 'Number of samples to align together in a single bowtie2 '
+                  'run. Batching avoids loading the index once per sample, '
+                  'which dominates run time for many small samples. The '
+                  'reads kept for each sample are not affected.',
+    'checkpoint_dir': 'Directory in which to persist the results of each '
+                      'sample as soon as it has been filtered. If a run is '
+                      'interrupted, re-running it with the same inputs, '
+                      'parameters and checkpoint directory skips the samples '
+                      'that had already completed. By default no checkpoints '
+                      'are written.',
+    'bgzf_index_dir': _bgzf_index_dir_description,
+    'profile_fp': _profile_fp_description,
 }
 
 filter_citations = [citations['langmead2012fast'],
@@ -148,7 +281,8 @@ plugin.methods.register_function(
     inputs={'demultiplexed_sequences': SampleData[SequencesWithQuality],
             'database': Bowtie2Index},
     parameters=filter_parameters,
-    outputs=[('filtered_sequences', SampleData[SequencesWithQuality])],
+    outputs=[('filtered_sequences', SampleData[SequencesWithQuality]),
+             ('filter_stats', SampleData[Bowtie2Stats])],
     input_descriptions=filter_input,
     parameter_descriptions=filter_parameter_descriptions,
     output_descriptions=filter_output,
@@ -164,7 +298,8 @@ plugin.methods.register_function(
         'database': Bowtie2Index},
     parameters=filter_parameters,
     outputs=[
-        ('filtered_sequences', SampleData[PairedEndSequencesWithQuality])],
+        ('filtered_sequences', SampleData[PairedEndSequencesWithQuality]),
+        ('filter_stats', SampleData[Bowtie2Stats])],
     input_descriptions=filter_input,
     parameter_descriptions=filter_parameter_descriptions,
     output_descriptions=filter_output,
@@ -176,13 +311,188 @@ plugin.methods.register_function(
 plugin.methods.register_function(
     function=q2_phylogenomics._filter.bowtie2_build,
     inputs={'sequences': FeatureData[Sequence]},
-    parameters={'n_threads': Int % Range(1, None)},
+    parameters={'n_threads': Int % Range(1, None),
+                'cache_dir': Str,
+                'cache_size_limit': Int % Range(1, None)},
     outputs=[('database', Bowtie2Index)],
     input_descriptions={
         'sequences': 'Reference sequences used to build bowtie2 index.'},
-    parameter_descriptions={'n_threads': 'Number of threads to launch'},
+    parameter_descriptions={
+        'n_threads': 'Number of threads to launch',
+        'cache_dir': 'Directory in which to cache built indexes. If an index '
+                     'has already been built from identical reference '
+                     'sequences with the same version of bowtie2, it is '
+                     'reused from this directory instead of being rebuilt. '
+                     'By default indexes are not cached.',
+        'cache_size_limit': 'Maximum total size of the index cache, in '
+                            'gigabytes. The least recently used indexes are '
+                            'removed once the limit is exceeded.'},
     output_descriptions={'database': 'Bowtie2 index.'},
     name='Build bowtie2 index from reference sequences.',
     description='Build bowtie2 index from reference sequences.',
     citations=[citations['langmead2012fast']]
 )
+
+prinseq_filter_parameters = {
+    **{k: v for k, v in prinseq_parameters.items()
+       if k not in ('n_jobs', 'n_threads')},
+    **{k: v for k, v in filter_parameters.items()
+       if k not in ('batch_size', 'checkpoint_dir')}}
+prinseq_filter_parameter_descriptions = {
+    **{k: v for k, v in prinseq_parameter_descriptions.items()
+       if k not in ('n_jobs', 'n_threads')},
+    **{k: v for k, v in filter_parameter_descriptions.items()
+       if k not in ('batch_size', 'checkpoint_dir')}}
+prinseq_filter_parameter_descriptions['n_threads'] = (
+    'Total number of threads to launch. When samples are processed '
+    'concurrently, the threads that are free as samples start are shared '
+    'between them in proportion to their compressed size, so samples '
+    'started once fewer than n_jobs are left also get the threads of those '
+    'that have finished. Every sample needs at least one thread, so no more '
+    'than n_threads samples are processed at once. Each sample\'s share is '
+    'used both by bowtie2 and, with the native backend, to trim and filter '
+    'its reads (see prinseq_single).')
+prinseq_filter_parameter_descriptions['n_jobs'] = (
+    'Number of samples to trim and filter concurrently, each in a separate '
+    'process. The largest samples (by compressed size) are started first.')
+
+prinseq_filter_output = {
+    **filter_output,
+    'filter_stats': 'Per-sample counts of the reads (read pairs for '
+                    'paired-end data) that passed trimming and were aligned '
+                    'to the reference, how often they aligned, and how many '
+                    'were retained. Alignment counts for paired-end data are '
+                    'for concordant alignments.'}
+
+prinseq_filter_description = (
+    'Trim and filter demultiplexed sequences by quality with PRINSEQ, then '
+    'filter out (or keep) those that align to a reference database with '
+    'bowtie2 and samtools, as prinseq_single or prinseq_paired followed by '
+    'filter_single or filter_paired would. Each sample is processed from '
+    'start to finish on its own: its trimmed reads are handed straight to '
+    'bowtie2 through a temporary uncompressed file, rather than being '
+    'compressed and saved as an intermediate artifact, and only the final '
+    'filtered reads are written out.')
+
+plugin.methods.register_function(
+    function=q2_phylogenomics._prinseq_filter.prinseq_filter_single,
+    inputs={'demultiplexed_sequences': SampleData[SequencesWithQuality],
+            'database': Bowtie2Index},
+    parameters=prinseq_filter_parameters,
+    outputs=[('filtered_sequences', SampleData[SequencesWithQuality]),
+             ('filter_stats', SampleData[Bowtie2Stats])],
+    input_descriptions=filter_input,
+    parameter_descriptions=prinseq_filter_parameter_descriptions,
+    output_descriptions=prinseq_filter_output,
+    name='Trim and filter single-end sequences with PRINSEQ, then filter '
+         'them by alignment to reference database.',
+    description=prinseq_filter_description,
+    citations=[citations['schmieder_prinseq'], *filter_citations]
+)
+
+plugin.methods.register_function(
+    function=q2_phylogenomics._prinseq_filter.prinseq_filter_paired,
+    inputs={
+        'demultiplexed_sequences': SampleData[PairedEndSequencesWithQuality],
+        'database': Bowtie2Index},
+    parameters=prinseq_filter_parameters,
+    outputs=[
+        ('filtered_sequences', SampleData[PairedEndSequencesWithQuality]),
+        ('filter_stats', SampleData[Bowtie2Stats])],
+    input_descriptions=filter_input,
+    parameter_descriptions=prinseq_filter_parameter_descriptions,
+    output_descriptions=prinseq_filter_output,
+    name='Trim and filter paired-end sequences with PRINSEQ, then filter '
+         'them by alignment to reference database.',
+    description=prinseq_filter_description,
+    citations=[citations['schmieder_prinseq'], *filter_citations]
+)
+
+sharded_filter_parameters = {
+    k: v for k, v in filter_parameters.items() if k != 'batch_size'}
+sharded_filter_parameters['scratch_dir'] = Str
+sharded_filter_parameter_descriptions = {
+    k: v for k, v in filter_parameter_descriptions.items()
+    if k != 'batch_size'}
+sharded_filter_parameter_descriptions['scratch_dir'] = (
+    _scratch_dir_description)
+sharded_filter_parameter_descriptions['memory_map_index'] = (
+    'Use memory-mapped I/O to load the index shards, so that samples '
+    'filtered concurrently (see n_jobs) share a single copy of each shard in '
+    'memory. The shards are read into the page cache once before alignment '
+    'starts.')
+
+sharded_filter_description = (
+    'Filter out (or keep) sequences that align to a sharded reference '
+    'database, using bowtie2 and samtools. Each sample is aligned to the '
+    'shards in turn, and only reads that did not align to one shard are '
+    'aligned to the next. The same reads are kept as when filtering against '
+    'an unsharded index of the same reference: when keeping aligned '
+    'paired-end reads (exclude_seqs is False), a pair is kept once both of '
+    'its mates have aligned, even if to different shards. Alignment counts '
+    'are not reported in the filter stats.')
+
+plugin.methods.register_function(
+    function=q2_phylogenomics._sharded.filter_single_sharded,
+    inputs={'demultiplexed_sequences': SampleData[SequencesWithQuality],
+            'database': Bowtie2ShardedIndex},
+    parameters=sharded_filter_parameters,
+    outputs=[('filtered_sequences', SampleData[SequencesWithQuality]),
+             ('filter_stats', SampleData[Bowtie2Stats])],
+    input_descriptions={**filter_input,
+                        'database': 'Sharded bowtie2 indexed database.'},
+    parameter_descriptions=sharded_filter_parameter_descriptions,
+    output_descriptions=filter_output,
+    name='Filter single-end sequences by alignment to sharded reference '
+         'database.',
+    description=sharded_filter_description,
+    citations=filter_citations
+)
+
+plugin.methods.register_function(
+    function=q2_phylogenomics._sharded.filter_paired_sharded,
+    inputs={
+        'demultiplexed_sequences': SampleData[PairedEndSequencesWithQuality],
+        'database': Bowtie2ShardedIndex},
+    parameters=sharded_filter_parameters,
+    outputs=[
+        ('filtered_sequences', SampleData[PairedEndSequencesWithQuality]),
+        ('filter_stats', SampleData[Bowtie2Stats])],
+    input_descriptions={**filter_input,
+                        'database': 'Sharded bowtie2 indexed database.'},
+    parameter_descriptions=sharded_filter_parameter_descriptions,
+    output_descriptions=filter_output,
+    name='Filter paired-end sequences by alignment to sharded reference '
+         'database.',
+    description=sharded_filter_description,
+    citations=filter_citations
+)
+
+plugin.methods.register_function(
+    function=q2_phylogenomics._sharded.bowtie2_build_sharded,
+    inputs={'sequences': FeatureData[Sequence]},
+    parameters={'n_shards': Int % Range(1, None),
+                'n_threads': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None)},
+    outputs=[('database', Bowtie2ShardedIndex)],
+    input_descriptions={
+        'sequences': 'Reference sequences used to build bowtie2 index.'},
+    parameter_descriptions={
+        'n_shards': 'Number of shards to split the reference sequences into. '
+                    'Sequences are distributed so that the shards are of '
+                    'similar total length.',
+        'n_threads': 'Total number of threads to launch. When shards are '
+                     'built concurrently, these are divided evenly between '
+                     'them.',
+        'n_jobs': 'Number of shards to build concurrently.'},
+    output_descriptions={'database': 'Sharded bowtie2 index.'},
+    name='Build sharded bowtie2 index from reference sequences.',
+    description='Build a bowtie2 index from reference sequences, split into '
+                'several independently built shards. Building shards '
+                'requires less memory than building a single index and can '
+                'be done in parallel, which makes this suited to very large '
+                'references.',
+    citations=[citations['langmead2012fast']]
+)
+
+importlib.import_module('q2_phylogenomics._transformer')
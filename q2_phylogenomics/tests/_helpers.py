@@ -0,0 +1,50 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+
+from q2_types.per_sample_sequences import FastqGzFormat
+
+from q2_phylogenomics._bgzf import INDEX_EXT, read_index, iter_records
+
+
+def assert_same_reads(test, exp_art, obs_art, view_type, index_dir=None):
+    """Assert that two artifacts hold the same reads in the same files.
+
+    With ``index_dir``, each observed file must also be indexed there (see
+    assert_bgzf_indexed).
+    """
+    exp_seqs = list(exp_art.view(view_type).sequences.iter_views(
+        FastqGzFormat))
+    obs_seqs = list(obs_art.view(view_type).sequences.iter_views(
+        FastqGzFormat))
+    test.assertEqual([str(fp) for fp, _ in obs_seqs],
+                     [str(fp) for fp, _ in exp_seqs])
+    for (_, exp_fp), (_, obs_fp) in zip(exp_seqs, obs_seqs):
+        with gzip.open(str(exp_fp), 'rt') as exp_fh, \
+                gzip.open(str(obs_fp), 'rt') as obs_fh:
+            test.assertEqual(obs_fh.read(), exp_fh.read())
+        if index_dir is not None:
+            assert_bgzf_indexed(test, obs_fp, index_dir)
+
+
+def assert_bgzf_indexed(test, fp, index_dir):
+    # every entry of the index must point at the record it numbers, and the
+    # records between entries must follow on from it
+    fp = str(fp)
+    index = read_index(
+        os.path.join(index_dir, os.path.basename(fp) + INDEX_EXT))
+    with gzip.open(fp, 'rb') as fh:
+        records = list(zip(*[fh] * 4))
+    test.assertEqual(index[:1], [(0, 0)] if records else [])
+    for (record, offset), (next_record, _) in zip(
+            index, index[1:] + [(len(records), None)]):
+        test.assertEqual(
+            list(iter_records(fp, offset, next_record - record)),
+            records[record:next_record])
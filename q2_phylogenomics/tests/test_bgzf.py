@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from q2_phylogenomics import _bgzf
+from q2_phylogenomics._bgzf import (
+    BgzfWriter,
+    write_index,
+    read_index,
+    iter_records,
+)
+
+
+def _records(n, length):
+    return [(b'@r%d\n' % i, b'ACGT' * length + b'\n', b'+\n',
+             b'IIII' * length + b'\n') for i in range(n)]
+
+
+class TestBgzf(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fp = os.path.join(self.temp_dir.name, 'reads.fastq.gz')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, records, threads=1):
+        with BgzfWriter(self.fp, threads=threads) as fh:
+            for record in records:
+                fh.writelines(record)
+
+    def _check_index(self, records):
+        write_index(self.fp)
+        index = read_index(self.fp + _bgzf.INDEX_EXT)
+        self.assertEqual(index[0], (0, 0))
+        self.assertGreater(len(index), 1)
+        for (record, offset), (next_record, _) in zip(
+                index, index[1:] + [(len(records), None)]):
+            self.assertEqual(
+                list(iter_records(self.fp, offset, next_record - record)),
+                records[record:next_record])
+
+    def test_gzip_compatible(self):
+        records = _records(1000, 25)
+        self._write(records)
+        with gzip.open(self.fp, 'rb') as fh:
+            self.assertEqual(fh.read(),
+                             b''.join(b''.join(r) for r in records))
+
+    def test_threads(self):
+        records = _records(5000, 25)
+        self._write(records)
+        with open(self.fp, 'rb') as fh:
+            exp = fh.read()
+        self._write(records, threads=4)
+        with open(self.fp, 'rb') as fh:
+            self.assertEqual(fh.read(), exp)
+
+    def test_index(self):
+        records = _records(5000, 25)
+        self._write(records)
+        self._check_index(records)
+
+    def test_index_records_span_blocks(self):
+        records = _records(500, 25)
+        with unittest.mock.patch.object(_bgzf, 'BLOCK_DATA_SIZE', 150):
+            self._write(records)
+        self._check_index(records)
+
+    def test_index_blocks_not_record_aligned(self):
+        # e.g., as written by bgzip
+        records = _records(500, 25)
+        data = b''.join(b''.join(r) for r in records)
+        with open(self.fp, 'wb') as fh:
+            for i in range(0, len(data), 997):
+                fh.write(_bgzf._compress_block(data[i:i + 997], 6))
+            fh.write(_bgzf._EOF)
+        self._check_index(records)
+
+    def test_not_bgzf(self):
+        with gzip.open(self.fp, 'wb') as fh:
+            fh.write(b''.join(_records(1, 1)[0]))
+        with self.assertRaisesRegex(ValueError, 'not BGZF'):
+            write_index(self.fp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+
+from q2_phylogenomics._checkpoint import Checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp_dir.name, 'checkpoints')
+        self.input_fp = self._write('in', 'sample1_R1.fastq.gz', b'reads')
+        self.output_fp = self._write('out', 'sample1_R1.fastq.gz', b'kept')
+        self.restore_fp = os.path.join(self.temp_dir.name, 'restored',
+                                       'sample1_R1.fastq.gz')
+        os.makedirs(os.path.dirname(self.restore_fp))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, dirname, name, content):
+        os.makedirs(os.path.join(self.temp_dir.name, dirname), exist_ok=True)
+        fp = os.path.join(self.temp_dir.name, dirname, name)
+        with open(fp, 'wb') as fh:
+            fh.write(content)
+        return fp
+
+    def test_save_and_restore(self):
+        Checkpoint(self.root, {'a': 1}).save(
+            'sample/1', [self.input_fp], [self.output_fp], {'retained': 1})
+
+        obs = Checkpoint(self.root, {'a': 1}).restore(
+            'sample/1', [self.input_fp], [self.restore_fp])
+
+        self.assertEqual(obs, {'retained': 1})
+        with open(self.restore_fp, 'rb') as fh:
+            self.assertEqual(fh.read(), b'kept')
+
+    def test_no_checkpoint(self):
+        obs = Checkpoint(self.root, {'a': 1}).restore(
+            'sample1', [self.input_fp], [self.restore_fp])
+        self.assertIsNone(obs)
+
+    def test_changed_params(self):
+        Checkpoint(self.root, {'a': 1}).save(
+            'sample1', [self.input_fp], [self.output_fp], {})
+        obs = Checkpoint(self.root, {'a': 2}).restore(
+            'sample1', [self.input_fp], [self.restore_fp])
+        self.assertIsNone(obs)
+        self.assertFalse(os.path.exists(self.restore_fp))
+
+    def test_changed_input(self):
+        Checkpoint(self.root, {'a': 1}).save(
+            'sample1', [self.input_fp], [self.output_fp], {})
+        self._write('in', 'sample1_R1.fastq.gz', b'more reads')
+        obs = Checkpoint(self.root, {'a': 1}).restore(
+            'sample1', [self.input_fp], [self.restore_fp])
+        self.assertIsNone(obs)
+
+    def test_changed_input_same_size(self):
+        Checkpoint(self.root, {'a': 1}).save(
+            'sample1', [self.input_fp], [self.output_fp], {})
+        self._write('in', 'sample1_R1.fastq.gz', b'sdaer')
+        obs = Checkpoint(self.root, {'a': 1}).restore(
+            'sample1', [self.input_fp], [self.restore_fp])
+        self.assertIsNone(obs)
+
+    def test_corrupt_output(self):
+        checkpoint = Checkpoint(self.root, {'a': 1})
+        checkpoint.save('sample1', [self.input_fp], [self.output_fp], {})
+        saved_fp = os.path.join(self.root, 'sample1', 'sample1_R1.fastq.gz')
+        os.remove(saved_fp)
+        with open(saved_fp, 'wb') as fh:
+            fh.write(b'truncated')
+        obs = checkpoint.restore(
+            'sample1', [self.input_fp], [self.restore_fp])
+        self.assertIsNone(obs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from q2_phylogenomics import _codec
+from q2_phylogenomics._codec import open_gzip, compress, decompress
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.data = b''.join(b'@r%d\nACGT\n+\nIIII\n' % i
+                             for i in range(1000))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def _round_trip(self, threads=1):
+        with open(self._path('in.fastq'), 'wb') as fh:
+            fh.write(self.data)
+        compress(self._path('in.fastq'), self._path('out.fastq.gz'),
+                 threads=threads)
+        # the output is readable by any gzip implementation
+        with gzip.open(self._path('out.fastq.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        decompress(self._path('out.fastq.gz'), self._path('out.fastq'))
+        with open(self._path('out.fastq'), 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_round_trip(self):
+        self._round_trip()
+
+    def test_round_trip_threads(self):
+        self._round_trip(threads=2)
+
+    def test_round_trip_stdlib(self):
+        with unittest.mock.patch.object(_codec, 'igzip', None):
+            self._round_trip(threads=2)
+
+    def test_round_trip_unthreaded_isal(self):
+        # isal before 1.4 has no igzip_threaded, so threads are ignored
+        with unittest.mock.patch.object(_codec, 'igzip_threaded', None):
+            self._round_trip(threads=2)
+
+    def test_append(self):
+        with open_gzip(self._path('out.fastq.gz'), 'wb') as fh:
+            fh.write(b'a')
+        with open_gzip(self._path('out.fastq.gz'), 'ab') as fh:
+            fh.write(b'b')
+        with open_gzip(self._path('out.fastq.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'ab')
+
+    def test_text_mode(self):
+        with self.assertRaisesRegex(ValueError, 'binary mode'):
+            open_gzip(self._path('out.fastq.gz'), 'rt')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from q2_phylogenomics._derep import (
+    dereplicate, _duplicates, _derep_types, _inverse)
+
+
+SEQS = [
+    'ACGTTGCA',   # 0
+    'ACGTTGCA',   # 1 exact duplicate of 0
+    'TGCAACGT',   # 2 reverse complement of 0
+    'ACGTT',      # 3 5' end of 0
+    'TTGCA',      # 4 3' end of 0
+    'AACGT',      # 5 reverse complement of 4, the 3' end of 2
+    'GGGCCATN',   # 6 unique
+    'ACGTTGCA',   # 7 exact duplicate of 0
+]
+
+
+class TestInverse(unittest.TestCase):
+    def test_inverse(self):
+        for a in (1, 3, 0x9e3779b97f4a7c15, 2 ** 64 - 1):
+            self.assertEqual(a * _inverse(a) % 2 ** 64, 1)
+
+
+class TestDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fp = self._write('reads.fastq', SEQS)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, name, seqs):
+        fp = os.path.join(self.temp_dir.name, name)
+        with open(fp, 'w') as fh:
+            for i, seq in enumerate(seqs):
+                fh.write('@r%d\n%s\n+\n%s\n' % (i, seq, 'I' * len(seq)))
+        return fp
+
+    def assertDuplicates(self, derep, exp):
+        types = _derep_types(derep)
+        for max_bytes in (1024 ** 3, 1):
+            obs = _duplicates([self.fp], types, max_bytes,
+                              self.temp_dir.name)
+            np.testing.assert_array_equal(np.flatnonzero(obs), exp)
+        # spilled partitions are cleaned up
+        self.assertEqual(os.listdir(self.temp_dir.name), ['reads.fastq'])
+
+    def test_exact(self):
+        self.assertDuplicates('1', [1, 7])
+
+    def test_5_prime(self):
+        self.assertDuplicates('2', [1, 3, 7])
+
+    def test_3_prime(self):
+        self.assertDuplicates('3', [1, 4, 5, 7])
+
+    def test_reverse_complement(self):
+        # 5 is also the reverse complement of 3, and 7 that of 2
+        self.assertDuplicates('4', [2, 5, 7])
+
+    def test_reverse_complement_5_3_prime(self):
+        # 3 and 4 are the reverse complements of the 3' and 5' ends of 2, and
+        # 5 is that of the 5' end of 0
+        self.assertDuplicates('5', [2, 3, 4, 5, 7])
+
+    def test_all(self):
+        self.assertDuplicates('12345', [1, 2, 3, 4, 5, 7])
+
+    def test_none(self):
+        self.assertDuplicates('', [])
+
+
+class TestDereplicate(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, name, seqs):
+        fp = os.path.join(self.temp_dir.name, name)
+        with open(fp, 'w') as fh:
+            for i, seq in enumerate(seqs):
+                fh.write('@r%d\n%s\n+\n%s\n' % (i, seq, 'I' * len(seq)))
+        return fp
+
+    def _read_ids(self, fp):
+        with gzip.open(fp, 'rt') as fh:
+            return fh.readlines()[::4]
+
+    def _dereplicate_pairs(self, f_seqs, r_seqs, derep):
+        f_read = self._write('f.fastq', f_seqs)
+        r_read = self._write('r.fastq', r_seqs)
+        f_out = os.path.join(self.temp_dir.name, 'f.fastq.gz')
+        r_out = os.path.join(self.temp_dir.name, 'r.fastq.gz')
+
+        obs = []
+        # with the hashes held in memory, and spilled to disk
+        for max_bytes in (1024 ** 3, 1):
+            dereplicate([f_read, r_read], [f_out, r_out], derep, max_bytes,
+                        self.temp_dir.name)
+            ids = self._read_ids(f_out)
+            self.assertEqual(self._read_ids(r_out), ids)
+            obs.append(ids)
+        self.assertEqual(obs[0], obs[1])
+        return obs[0]
+
+    def test_paired_exact(self):
+        # only r1 duplicates both mates of an earlier pair; r2 and r3 share
+        # one mate with r0 and are kept
+        obs = self._dereplicate_pairs(
+            ['AAAACCCC', 'AAAACCCC', 'AAAACCCC', 'GGGGTTTT'],
+            ['ACACACAC', 'ACACACAC', 'GTGTGTGT', 'ACACACAC'], '1')
+        self.assertEqual(obs, ['@r0\n', '@r2\n', '@r3\n'])
+
+    def test_paired_reverse_complement(self):
+        # both mates of r1 are the reverse complements of those of r0
+        obs = self._dereplicate_pairs(
+            ['AAAACCCC', 'GGGGTTTT', 'GGGGTTTT'],
+            ['ACACACAC', 'GTGTGTGT', 'ACACACAC'], '4')
+        self.assertEqual(obs, ['@r0\n', '@r2\n'])
+
+    def test_paired_5_prime(self):
+        # r1 is at the 5' end of both mates of r0, but only the forward
+        # mate of r2 is
+        obs = self._dereplicate_pairs(
+            ['AAAACCCC', 'AAAA', 'AAAAC'],
+            ['ACACACAC', 'ACACAC', 'GTGT'], '2')
+        self.assertEqual(obs, ['@r0\n', '@r2\n'])
+
+    def test_paired_3_prime_one_mate_longer(self):
+        # the reverse mate of r1 is the same as that of r0, and its forward
+        # mate is the 3' end of r0's
+        obs = self._dereplicate_pairs(
+            ['AAAACCCC', 'CCCC'], ['ACACACAC', 'ACACACAC'], '3')
+        self.assertEqual(obs, ['@r0\n'])
+
+    def test_no_derep(self):
+        f_read = self._write('f.fastq', ['AAAACCCC', 'AAAACCCC'])
+        f_out = os.path.join(self.temp_dir.name, 'f.fastq.gz')
+
+        dereplicate([f_read], [f_out], '', 1024 ** 3, self.temp_dir.name)
+
+        self.assertEqual(self._read_ids(f_out), ['@r0\n', '@r1\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,8 +8,12 @@
 
 import gzip
 import itertools
+import os
+import tempfile
 import unittest
 
+import pandas as pd
+
 from q2_types.per_sample_sequences import (
     SingleLanePerSampleSingleEndFastqDirFmt,
     SingleLanePerSamplePairedEndFastqDirFmt,
@@ -18,6 +22,9 @@ from q2_types.per_sample_sequences import (
 from qiime2 import Artifact
 from qiime2.plugin.testing import TestPluginBase
 
+from q2_phylogenomics._filter import _parse_bowtie2_summary, _sam_to_fastq
+from q2_phylogenomics.tests._helpers import assert_same_reads
+
 
 class TestBowtie2Build(TestPluginBase):
     package = 'q2_phylogenomics.tests'
@@ -46,7 +53,7 @@ class TestFilterSingle(TestPluginBase):
             self.get_data_path('sars2-indexed.qza'))
 
     def test_filter_single_exclude_seqs(self):
-        obs_art, = self.plugin.methods['filter_single'](
+        obs_art, _ = self.plugin.methods['filter_single'](
             self.demuxed_art, self.indexed_genome, exclude_seqs=True)
         obs = obs_art.view(SingleLanePerSampleSingleEndFastqDirFmt)
         obs_seqs = obs.sequences.iter_views(FastqGzFormat)
@@ -61,7 +68,7 @@ class TestFilterSingle(TestPluginBase):
                     self.assertTrue(obs_id in seq_id_that_does_not_map)
 
     def test_filter_single_keep_seqs(self):
-        obs_art, = self.plugin.methods['filter_single'](
+        obs_art, _ = self.plugin.methods['filter_single'](
             self.demuxed_art, self.indexed_genome, exclude_seqs=False)
         obs = obs_art.view(SingleLanePerSampleSingleEndFastqDirFmt)
         obs_seqs = obs.sequences.iter_views(FastqGzFormat)
@@ -75,6 +82,81 @@ class TestFilterSingle(TestPluginBase):
                     self.assertTrue(obs_id in seq_ids_that_map)
                     self.assertTrue(obs_id not in seq_id_that_does_not_map)
 
+    def test_filter_single_concurrent_samples(self):
+        obs_art, _ = self.plugin.methods['filter_single'](
+            self.demuxed_art, self.indexed_genome, exclude_seqs=True,
+            n_threads=2, n_jobs=2)
+        obs = obs_art.view(SingleLanePerSampleSingleEndFastqDirFmt)
+        obs_seqs = obs.sequences.iter_views(FastqGzFormat)
+        for _, obs_fp in obs_seqs:
+            with gzip.open(str(obs_fp), 'rt') as obs_fh:
+                for records in itertools.zip_longest(*[obs_fh] * 4):
+                    (obs_seq_h, obs_seq, _, obs_qual) = records
+                    obs_id = obs_seq_h.strip('@/012\n')
+                    self.assertTrue(obs_id not in seq_ids_that_map)
+                    self.assertTrue(obs_id in seq_id_that_does_not_map)
+
+    def test_filter_single_stats(self):
+        _, stats_art = self.plugin.methods['filter_single'](
+            self.demuxed_art, self.indexed_genome, exclude_seqs=True)
+        stats = stats_art.view(pd.DataFrame)
+        self.assertEqual(list(stats.columns),
+                         ['input', 'aligned 0 times', 'aligned exactly 1 time',
+                          'aligned >1 times', 'retained'])
+        pd.testing.assert_series_equal(
+            stats['retained'], stats['aligned 0 times'], check_names=False)
+        pd.testing.assert_series_equal(
+            stats['input'],
+            stats['aligned 0 times'] + stats['aligned exactly 1 time'] +
+            stats['aligned >1 times'], check_names=False)
+
+    def test_filter_single_bgzf_index_dir(self):
+        exp_art, _ = self.plugin.methods['filter_single'](
+            self.demuxed_art, self.indexed_genome, exclude_seqs=False)
+        with tempfile.TemporaryDirectory() as index_dir:
+            obs_art, _ = self.plugin.methods['filter_single'](
+                self.demuxed_art, self.indexed_genome, exclude_seqs=False,
+                bgzf_index_dir=index_dir)
+            assert_same_reads(
+                self, exp_art, obs_art,
+                SingleLanePerSampleSingleEndFastqDirFmt, index_dir)
+
+    def test_filter_single_batched(self):
+        for exclude_seqs in (True, False):
+            exp_art, _ = self.plugin.methods['filter_single'](
+                self.demuxed_art, self.indexed_genome,
+                exclude_seqs=exclude_seqs)
+            obs_art, _ = self.plugin.methods['filter_single'](
+                self.demuxed_art, self.indexed_genome,
+                exclude_seqs=exclude_seqs, batch_size=2)
+            assert_same_reads(
+                self, exp_art, obs_art,
+                SingleLanePerSampleSingleEndFastqDirFmt)
+
+    def test_filter_single_profile_fp(self):
+        sample_ids = list(self.demuxed_art.view(pd.DataFrame).index)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_fp = os.path.join(temp_dir, 'profile.tsv')
+            self.plugin.methods['filter_single'](
+                self.demuxed_art, self.indexed_genome, profile_fp=profile_fp)
+            profile = pd.read_csv(profile_fp, sep='\t',
+                                  dtype={'sample-id': str})
+        # bowtie2 writes the filtered reads itself
+        self.assertEqual(list(profile['sample-id']), sample_ids)
+        self.assertEqual(list(profile['stage']), ['bowtie2'] * len(sample_ids))
+        self.assertTrue((profile['bytes in'] > 0).all())
+        self.assertTrue((profile['bytes out'] > 0).all())
+
+    def test_filter_single_memory_map_index(self):
+        exp_art, exp_stats_art = self.plugin.methods['filter_single'](
+            self.demuxed_art, self.indexed_genome)
+        obs_art, obs_stats_art = self.plugin.methods['filter_single'](
+            self.demuxed_art, self.indexed_genome, memory_map_index=True)
+        assert_same_reads(
+            self, exp_art, obs_art, SingleLanePerSampleSingleEndFastqDirFmt)
+        pd.testing.assert_frame_equal(obs_stats_art.view(pd.DataFrame),
+                                      exp_stats_art.view(pd.DataFrame))
+
 
 class TestFilterPaired(TestPluginBase):
     package = 'q2_phylogenomics.tests'
@@ -87,7 +169,7 @@ class TestFilterPaired(TestPluginBase):
             self.get_data_path('sars2-indexed.qza'))
 
     def test_filter_single_exclude_seqs(self):
-        obs_art, = self.plugin.methods['filter_paired'](
+        obs_art, _ = self.plugin.methods['filter_paired'](
             self.demuxed_art, self.indexed_genome, exclude_seqs=True)
         obs = obs_art.view(SingleLanePerSamplePairedEndFastqDirFmt)
         obs_seqs = obs.sequences.iter_views(FastqGzFormat)
@@ -102,7 +184,7 @@ class TestFilterPaired(TestPluginBase):
                     self.assertTrue(obs_id in seq_id_that_does_not_map)
 
     def test_filter_single_keep_seqs(self):
-        obs_art, = self.plugin.methods['filter_paired'](
+        obs_art, _ = self.plugin.methods['filter_paired'](
             self.demuxed_art, self.indexed_genome, exclude_seqs=False)
         obs = obs_art.view(SingleLanePerSamplePairedEndFastqDirFmt)
         obs_seqs = obs.sequences.iter_views(FastqGzFormat)
@@ -116,6 +198,112 @@ class TestFilterPaired(TestPluginBase):
                     self.assertTrue(obs_id in seq_ids_that_map)
                     self.assertTrue(obs_id not in seq_id_that_does_not_map)
 
+    def test_filter_paired_batched(self):
+        # the same reads are kept, and written the same way, as when each
+        # sample is filtered on its own
+        for exclude_seqs in (True, False):
+            exp_art, exp_stats = self.plugin.methods['filter_paired'](
+                self.demuxed_art, self.indexed_genome,
+                exclude_seqs=exclude_seqs)
+            obs_art, obs_stats = self.plugin.methods['filter_paired'](
+                self.demuxed_art, self.indexed_genome,
+                exclude_seqs=exclude_seqs, batch_size=2)
+            assert_same_reads(
+                self, exp_art, obs_art,
+                SingleLanePerSamplePairedEndFastqDirFmt)
+            exp_stats = exp_stats.view(pd.DataFrame)
+            obs_stats = obs_stats.view(pd.DataFrame)
+            pd.testing.assert_frame_equal(
+                obs_stats[['input', 'retained']],
+                exp_stats[['input', 'retained']])
+
+    def test_filter_paired_bgzf_index_dir(self):
+        exp_art, _ = self.plugin.methods['filter_paired'](
+            self.demuxed_art, self.indexed_genome, exclude_seqs=False)
+        with tempfile.TemporaryDirectory() as index_dir:
+            obs_art, _ = self.plugin.methods['filter_paired'](
+                self.demuxed_art, self.indexed_genome, exclude_seqs=False,
+                bgzf_index_dir=index_dir)
+            assert_same_reads(
+                self, exp_art, obs_art,
+                SingleLanePerSamplePairedEndFastqDirFmt, index_dir)
+
+    def test_filter_paired_profile_fp(self):
+        sample_ids = list(self.demuxed_art.view(pd.DataFrame).index)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_fp = os.path.join(temp_dir, 'profile.tsv')
+            self.plugin.methods['filter_paired'](
+                self.demuxed_art, self.indexed_genome, profile_fp=profile_fp)
+            profile = pd.read_csv(profile_fp, sep='\t',
+                                  dtype={'sample-id': str})
+        # a row per command of each sample's pipeline, with the sizes of
+        # the sample's reads and of the filtered reads at its ends
+        self.assertEqual(list(profile['sample-id']),
+                         [sample_id for sample_id in sample_ids
+                          for _ in range(3)])
+        self.assertEqual(
+            list(profile['stage']),
+            ['bowtie2', 'samtools view', 'samtools fastq'] * len(sample_ids))
+        self.assertTrue((profile['bytes in'].iloc[::3] > 0).all())
+        self.assertTrue((profile['bytes out'].iloc[2::3] > 0).all())
+
+    def test_filter_paired_memory_map_index(self):
+        exp_art, exp_stats_art = self.plugin.methods['filter_paired'](
+            self.demuxed_art, self.indexed_genome)
+        obs_art, obs_stats_art = self.plugin.methods['filter_paired'](
+            self.demuxed_art, self.indexed_genome, memory_map_index=True)
+        assert_same_reads(
+            self, exp_art, obs_art, SingleLanePerSamplePairedEndFastqDirFmt)
+        pd.testing.assert_frame_equal(obs_stats_art.view(pd.DataFrame),
+                                      exp_stats_art.view(pd.DataFrame))
+
+
+class TestParseBowtie2Summary(unittest.TestCase):
+    def test_single(self):
+        summary = ('10000 reads; of these:\n'
+                   '  10000 (100.00%) were unpaired; of these:\n'
+                   '    596 (5.96%) aligned 0 times\n'
+                   '    9284 (92.84%) aligned exactly 1 time\n'
+                   '    120 (1.20%) aligned >1 times\n'
+                   '94.04% overall alignment rate\n')
+        self.assertEqual(_parse_bowtie2_summary(summary),
+                         {'input': 10000, 'aligned 0 times': 596,
+                          'aligned exactly 1 time': 9284,
+                          'aligned >1 times': 120})
+
+    def test_paired(self):
+        summary = ('1000 reads; of these:\n'
+                   '  1000 (100.00%) were paired; of these:\n'
+                   '    65 (6.50%) aligned concordantly 0 times\n'
+                   '    882 (88.20%) aligned concordantly exactly 1 time\n'
+                   '    53 (5.30%) aligned concordantly >1 times\n'
+                   '    ----\n'
+                   '    65 pairs aligned 0 times concordantly or '
+                   'discordantly; of these:\n'
+                   '      130 mates make up the pairs; of these:\n'
+                   '        66 (50.77%) aligned 0 times\n'
+                   '        63 (48.46%) aligned exactly 1 time\n'
+                   '        1 (0.77%) aligned >1 times\n'
+                   '96.70% overall alignment rate\n')
+        self.assertEqual(_parse_bowtie2_summary(summary),
+                         {'input': 1000, 'aligned 0 times': 65,
+                          'aligned exactly 1 time': 882,
+                          'aligned >1 times': 53})
+
+
+class TestSamToFastq(unittest.TestCase):
+    def test_forward(self):
+        alignment = (b'r1\t77\t*\t0\t0\t*\t*\t0\t0\tACGTN\tABCDE\t'
+                     b'YT:Z:UP\n')
+        self.assertEqual(_sam_to_fastq(alignment),
+                         (b'@r1\n', b'ACGTN\n', b'+\n', b'ABCDE\n'))
+
+    def test_reverse(self):
+        # reverse-strand alignments hold the reverse complement of the read
+        alignment = b'r1\t16\tref\t1\t42\t5M\t*\t0\t0\tAACGN\tABCDE\n'
+        self.assertEqual(_sam_to_fastq(alignment),
+                         (b'@r1\n', b'NCGTT\n', b'+\n', b'EDCBA\n'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,67 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+
+from q2_phylogenomics._index_cache import IndexCache
+
+
+class TestIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp_dir.name, 'cache')
+        self.seqs_fp = os.path.join(self.temp_dir.name, 'seqs.fasta')
+        with open(self.seqs_fp, 'w') as fh:
+            fh.write('>s1\nACGT\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _index_dir(self, size):
+        index_dir = tempfile.mkdtemp(dir=self.temp_dir.name)
+        with open(os.path.join(index_dir, 'db.1.bt2'), 'wb') as fh:
+            fh.write(b'x' * size)
+        return index_dir
+
+    def test_key_depends_on_content_and_params(self):
+        cache = IndexCache(self.root)
+        key = cache.key(self.seqs_fp, {'version': '1'})
+        self.assertEqual(key, cache.key(self.seqs_fp, {'version': '1'}))
+        self.assertNotEqual(key, cache.key(self.seqs_fp, {'version': '2'}))
+        with open(self.seqs_fp, 'a') as fh:
+            fh.write('>s2\nTTTT\n')
+        self.assertNotEqual(key, cache.key(self.seqs_fp, {'version': '1'}))
+
+    def test_store_and_fetch(self):
+        cache = IndexCache(self.root)
+        dest = tempfile.mkdtemp(dir=self.temp_dir.name)
+        self.assertFalse(cache.fetch('abc', dest))
+
+        cache.store('abc', self._index_dir(10))
+        self.assertTrue(cache.fetch('abc', dest))
+        with open(os.path.join(dest, 'db.1.bt2'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'x' * 10)
+
+    def test_evicts_least_recently_used(self):
+        cache = IndexCache(self.root, max_bytes=25)
+        cache.store('used', self._index_dir(10))
+        cache.store('old', self._index_dir(10))
+        os.utime(os.path.join(self.root, 'used'), (0, 0))
+        os.utime(os.path.join(self.root, 'old'), (1, 1))
+        # a hit makes 'used' the most recently used entry
+        cache.fetch('used', tempfile.mkdtemp(dir=self.temp_dir.name))
+
+        cache.store('new', self._index_dir(10))
+
+        self.assertEqual(sorted(os.listdir(self.root)), ['new', 'used'])
+
+
+if __name__ == '__main__':
+    unittest.main()
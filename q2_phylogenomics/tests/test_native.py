@@ -0,0 +1,195 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+
+from q2_phylogenomics._native import (
+    ReadBlock,
+    trim_qual_right,
+    min_len_mask,
+    min_qual_mean_mask,
+    low_complexity_scores,
+    low_complexity_mask,
+    trim_and_filter,
+)
+
+
+def _record(name, quals, seq=None):
+    seq = b'A' * len(quals) if seq is None else seq
+    return (b'@%s\n' % name, seq + b'\n', b'+\n',
+            bytes(q + 33 for q in quals) + b'\n')
+
+
+class TestTrimQualRight(unittest.TestCase):
+    def setUp(self):
+        self.block = ReadBlock([
+            _record(b'r1', [30, 30, 30, 30, 10, 30, 10, 10]),
+            _record(b'r2', [10, 10, 10]),
+            _record(b'r3', [40, 40]),
+        ])
+
+    def test_quals(self):
+        np.testing.assert_array_equal(self.block.lengths, [8, 3, 2])
+        np.testing.assert_array_equal(self.block.quals[2], [40, 40] + [0] * 6)
+
+    def test_min_window_1(self):
+        trim_qual_right(self.block, 20, 'min', 1)
+        np.testing.assert_array_equal(self.block.lengths, [6, 0, 2])
+
+    def test_min(self):
+        trim_qual_right(self.block, 20, 'min', 3)
+        np.testing.assert_array_equal(self.block.lengths, [4, 0, 2])
+
+    def test_max(self):
+        trim_qual_right(self.block, 20, 'max', 3)
+        np.testing.assert_array_equal(self.block.lengths, [8, 0, 2])
+
+    def test_mean(self):
+        # the last window to reach a mean of 20 is (30, 10, 30)
+        trim_qual_right(self.block, 20, 'mean', 3)
+        np.testing.assert_array_equal(self.block.lengths, [6, 0, 2])
+
+    def test_sum(self):
+        trim_qual_right(self.block, 60, 'sum', 3)
+        np.testing.assert_array_equal(self.block.lengths, [6, 0, 2])
+
+
+class TestFilters(unittest.TestCase):
+    def test_min_len(self):
+        block = ReadBlock([_record(b'r1', [30] * 5), _record(b'r2', [30])])
+        np.testing.assert_array_equal(min_len_mask(block, 2), [True, False])
+
+    def test_min_qual_mean_uses_trimmed_length(self):
+        block = ReadBlock([_record(b'r1', [30, 30, 2, 2]),
+                           _record(b'r2', [10, 10])])
+        np.testing.assert_array_equal(
+            min_qual_mean_mask(block, 20), [False, False])
+        block.lengths[0] = 2
+        np.testing.assert_array_equal(
+            min_qual_mean_mask(block, 20), [True, False])
+
+
+class TestLowComplexity(unittest.TestCase):
+    def setUp(self):
+        # single windows of a homopolymer, a short repeat, a random sequence
+        # and a read too short to score
+        seqs = [b'A' * 64, b'ACGT' * 16,
+                b'CCGTAATGCCTTTCCCTAACAGAGTTTTTCGAACTCGTGTTGTCGAGCGACGGAATTAG'
+                b'ATCAG', b'AC']
+        self.block = ReadBlock([_record(b'r', [30] * len(seq), seq)
+                                for seq in seqs])
+
+    def test_dust(self):
+        obs = low_complexity_scores(self.block, 'dust')
+        # homopolymers score 100 and the dust score of ACGT repeats is set
+        # by four words repeated 15 or 16 times
+        self.assertAlmostEqual(obs[0], 100)
+        self.assertAlmostEqual(obs[1], (2 * 15 * 14 + 2 * 16 * 15) / 2 / 61 *
+                               100 / 31)
+        self.assertLess(obs[2], obs[1])
+        self.assertEqual(obs[3], 0)
+
+    def test_entropy(self):
+        obs = low_complexity_scores(self.block, 'entropy')
+        self.assertAlmostEqual(obs[0], 0)
+        # close to that of four equally frequent words
+        self.assertAlmostEqual(obs[1], np.log(4) / np.log(62) * 100,
+                               delta=0.1)
+        self.assertGreater(obs[2], obs[1])
+        self.assertEqual(obs[3], 0)
+
+    def test_windows_of_long_reads(self):
+        # a 130 base read is scored over windows at 0, 32, 64 and 96, the
+        # last of which is the 34 bases to the end of the read. The first
+        # and third are homopolymers, the second is half A and half C, with
+        # 30 words of each and two spanning the boundary, and the last is a
+        # homopolymer with 32 words.
+        seq = b'A' * 64 + b'C' * 66
+        block = ReadBlock([_record(b'r', [30] * len(seq), seq)])
+        obs, = low_complexity_scores(block, 'dust')
+        self.assertAlmostEqual(
+            obs, (100 + 2 * 30 * 29 / 2 / 61 * 100 / 31 + 100 +
+                  32 * 31 / 2 / 31 * 100 / 31) / 4)
+        obs, = low_complexity_scores(block, 'entropy')
+        freqs = np.array([30, 1, 1, 30]) / 62
+        self.assertAlmostEqual(
+            obs, -(freqs * np.log(freqs)).sum() / np.log(62) * 100 / 4)
+
+    def test_uses_trimmed_length(self):
+        self.block.lengths[0] = 2
+        obs = low_complexity_scores(self.block, 'dust')
+        self.assertEqual(obs[0], 0)
+
+    def test_mask(self):
+        np.testing.assert_array_equal(
+            low_complexity_mask(self.block, 'dust', 7),
+            [False, False, True, True])
+        np.testing.assert_array_equal(
+            low_complexity_mask(self.block, 'entropy', 70),
+            [False, False, True, False])
+
+
+class TestTrimAndFilter(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, name, records):
+        fp = os.path.join(self.temp_dir.name, name)
+        with gzip.open(fp, 'wb') as fh:
+            for record in records:
+                fh.writelines(record)
+        return fp
+
+    def _read(self, fp):
+        with open(fp, 'rb') as fh:
+            return fh.read()
+
+    def test_paired_drops_both_mates(self):
+        f_read = self._write('f.fastq.gz', [
+            _record(b'r1', [30] * 6 + [2, 2]),
+            _record(b'r2', [30] * 8)])
+        r_read = self._write('r.fastq.gz', [
+            _record(b'r1', [30] * 8),
+            _record(b'r2', [30, 30, 2, 2, 2, 2, 2, 2])])
+        f_out = os.path.join(self.temp_dir.name, 'f.fastq')
+        r_out = os.path.join(self.temp_dir.name, 'r.fastq')
+
+        trim_and_filter(f_read, r_read, f_out, r_out, 20, 'min', 1, 20, 5)
+
+        self.assertEqual(self._read(f_out),
+                         b'@r1\nAAAAAA\n+\n??????\n')
+        self.assertEqual(self._read(r_out),
+                         b'@r1\nAAAAAAAA\n+\n????????\n')
+
+    def test_n_workers_keeps_order(self):
+        records = [_record(b'r%d' % i, [30] * 6 + [2] * (i % 3))
+                   for i in range(10)]
+        f_read = self._write('f.fastq.gz', records)
+        exp_out = os.path.join(self.temp_dir.name, 'exp.fastq')
+        obs_out = os.path.join(self.temp_dir.name, 'obs.fastq')
+
+        with unittest.mock.patch('q2_phylogenomics._native.BLOCK_SIZE', 3):
+            trim_and_filter(f_read, None, exp_out, None, 20, 'min', 1, 20, 5)
+            trim_and_filter(f_read, None, obs_out, None, 20, 'min', 1, 20, 5,
+                            n_workers=2)
+
+        self.assertEqual(self._read(obs_out), self._read(exp_out))
+        self.assertEqual(self._read(obs_out).count(b'@r'), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
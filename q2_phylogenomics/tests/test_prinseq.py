@@ -8,8 +8,13 @@
 
 import gzip
 import itertools
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
+import pandas as pd
 from q2_types.per_sample_sequences import (
     SingleLanePerSampleSingleEndFastqDirFmt,
     SingleLanePerSamplePairedEndFastqDirFmt,
@@ -18,6 +23,9 @@ from q2_types.per_sample_sequences import (
 from qiime2 import Artifact
 from qiime2.plugin.testing import TestPluginBase
 
+from q2_phylogenomics.tests._helpers import (
+    assert_same_reads, assert_bgzf_indexed)
+
 
 class TestPrinseqSingle(TestPluginBase):
     package = 'q2_phylogenomics.tests'
@@ -40,6 +48,89 @@ class TestPrinseqSingle(TestPluginBase):
                     # Make sure prinseq trimmed the sequences, too
                     self.assertTrue(len(obs_seq) == len(obs_qual))
 
+    def test_native_backend(self):
+        # with matched settings, the native backend writes exactly what
+        # prinseq-lite does
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        for lc_method, lc_threshold in [('dust', 7), ('entropy', 70)]:
+            with self.subTest(lc_method=lc_method):
+                exp_art, = self.plugin.methods['prinseq_single'](
+                    demuxed_art, lc_method=lc_method,
+                    lc_threshold=lc_threshold)
+                obs_art, = self.plugin.methods['prinseq_single'](
+                    demuxed_art, backend='native', lc_method=lc_method,
+                    lc_threshold=lc_threshold)
+                assert_same_reads(
+                    self, exp_art, obs_art,
+                    SingleLanePerSampleSingleEndFastqDirFmt)
+
+    def test_stream(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        exp_art, = self.plugin.methods['prinseq_single'](demuxed_art)
+        obs_art, = self.plugin.methods['prinseq_single'](
+            demuxed_art, stream=True)
+        assert_same_reads(
+            self, exp_art, obs_art, SingleLanePerSampleSingleEndFastqDirFmt)
+
+    def test_n_jobs(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        exp_art, = self.plugin.methods['prinseq_single'](demuxed_art)
+        obs_art, = self.plugin.methods['prinseq_single'](
+            demuxed_art, n_jobs=2)
+        assert_same_reads(
+            self, exp_art, obs_art, SingleLanePerSampleSingleEndFastqDirFmt)
+
+    def test_bgzf_index_dir(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        with tempfile.TemporaryDirectory() as index_dir:
+            obs_art, = self.plugin.methods['prinseq_single'](
+                demuxed_art, backend='native', bgzf_index_dir=index_dir)
+            obs = obs_art.view(SingleLanePerSampleSingleEndFastqDirFmt)
+            for _, obs_fp in obs.sequences.iter_views(FastqGzFormat):
+                assert_bgzf_indexed(self, obs_fp, index_dir)
+
+    def test_stream_bgzf_index_dir(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        exp_art, = self.plugin.methods['prinseq_single'](demuxed_art)
+        with tempfile.TemporaryDirectory() as index_dir:
+            obs_art, = self.plugin.methods['prinseq_single'](
+                demuxed_art, stream=True, bgzf_index_dir=index_dir)
+            assert_same_reads(
+                self, exp_art, obs_art,
+                SingleLanePerSampleSingleEndFastqDirFmt, index_dir)
+
+    def test_profile_fp(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        n_samples = len(demuxed_art.view(pd.DataFrame))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_fp = os.path.join(temp_dir, 'profile.tsv')
+            self.plugin.methods['prinseq_single'](
+                demuxed_art, backend='native', profile_fp=profile_fp)
+            profile = pd.read_csv(profile_fp, sep='\t')
+        self.assertEqual(
+            list(profile['stage']),
+            ['trim and filter', 'dereplicate'] * n_samples)
+        self.assertTrue((profile['bytes in'] > 0).all())
+
+    def test_scratch_dir(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        exp_art, = self.plugin.methods['prinseq_single'](demuxed_art)
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            obs_art, = self.plugin.methods['prinseq_single'](
+                demuxed_art, scratch_dir=scratch_dir)
+            # temporary files are cleaned up
+            self.assertEqual(os.listdir(scratch_dir), [])
+        assert_same_reads(
+            self, exp_art, obs_art, SingleLanePerSampleSingleEndFastqDirFmt)
+
+    def test_scratch_dir_too_small(self):
+        demuxed_art = Artifact.load(self.get_data_path('single-end.qza'))
+        usage = shutil.disk_usage(tempfile.gettempdir())
+        with mock.patch('q2_phylogenomics._scratch.shutil.disk_usage',
+                        return_value=usage._replace(free=0)):
+            with self.assertRaisesRegex(ValueError, 'scratch space'):
+                self.plugin.methods['prinseq_single'](demuxed_art)
+
 
 class TestPrinseqPaired(TestPluginBase):
     package = 'q2_phylogenomics.tests'
@@ -63,6 +154,24 @@ class TestPrinseqPaired(TestPluginBase):
                     # Make sure prinseq trimmed the sequences, too
                     self.assertTrue(len(obs_seq) == len(obs_qual))
 
+    def test_stream(self):
+        demuxed_art = Artifact.load(self.get_data_path('paired-end.qza'))
+        exp_art, = self.plugin.methods['prinseq_paired'](demuxed_art)
+        obs_art, = self.plugin.methods['prinseq_paired'](
+            demuxed_art, stream=True)
+        assert_same_reads(
+            self, exp_art, obs_art, SingleLanePerSamplePairedEndFastqDirFmt)
+
+    def test_stream_bgzf_index_dir(self):
+        demuxed_art = Artifact.load(self.get_data_path('paired-end.qza'))
+        exp_art, = self.plugin.methods['prinseq_paired'](demuxed_art)
+        with tempfile.TemporaryDirectory() as index_dir:
+            obs_art, = self.plugin.methods['prinseq_paired'](
+                demuxed_art, stream=True, bgzf_index_dir=index_dir)
+            assert_same_reads(
+                self, exp_art, obs_art,
+                SingleLanePerSamplePairedEndFastqDirFmt, index_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
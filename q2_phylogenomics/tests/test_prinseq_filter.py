@@ -0,0 +1,73 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import unittest
+
+import pandas as pd
+from q2_types.per_sample_sequences import (
+    SingleLanePerSampleSingleEndFastqDirFmt,
+    SingleLanePerSamplePairedEndFastqDirFmt,
+    FastqGzFormat,
+)
+from qiime2 import Artifact
+from qiime2.plugin.testing import TestPluginBase
+
+
+class TestPrinseqFilter(TestPluginBase):
+    package = 'q2_phylogenomics.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.indexed_genome = Artifact.load(
+            self.get_data_path('sars2-indexed.qza'))
+
+    def _read_sets(self, art, view_type):
+        # the reads of each output file, as a set of records
+        reads = []
+        for _, fp in art.view(view_type).sequences.iter_views(FastqGzFormat):
+            with gzip.open(str(fp), 'rt') as fh:
+                reads.append(set(zip(*[fh] * 4)))
+        return reads
+
+    def _assert_same_as_separate(self, layout, **kwargs):
+        # the fused action keeps the same reads as prinseq then filter
+        view_type = {
+            'single': SingleLanePerSampleSingleEndFastqDirFmt,
+            'paired': SingleLanePerSamplePairedEndFastqDirFmt}[layout]
+        demuxed_art = Artifact.load(self.get_data_path(
+            '%s-end.qza' % layout))
+        trim_kwargs = {k: v for k, v in kwargs.items() if k == 'backend'}
+
+        trimmed_art, = self.plugin.methods['prinseq_' + layout](
+            demuxed_art, **trim_kwargs)
+        exp_art, exp_stats = self.plugin.methods['filter_' + layout](
+            trimmed_art, self.indexed_genome)
+        obs_art, obs_stats = self.plugin.methods['prinseq_filter_' + layout](
+            demuxed_art, self.indexed_genome, **kwargs)
+
+        self.assertEqual(self._read_sets(obs_art, view_type),
+                         self._read_sets(exp_art, view_type))
+        pd.testing.assert_frame_equal(obs_stats.view(pd.DataFrame),
+                                      exp_stats.view(pd.DataFrame))
+
+    def test_single(self):
+        self._assert_same_as_separate('single')
+
+    def test_paired(self):
+        self._assert_same_as_separate('paired')
+
+    def test_native_backend(self):
+        self._assert_same_as_separate('single', backend='native')
+
+    def test_concurrent_samples(self):
+        self._assert_same_as_separate('paired', n_jobs=2, n_threads=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
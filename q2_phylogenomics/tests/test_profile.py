@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+from q2_phylogenomics._profile import Profile, COLUMNS
+from q2_phylogenomics._util import run_pipeline
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.in_fp = os.path.join(self.temp_dir.name, 'in.txt')
+        self.out_fp = os.path.join(self.temp_dir.name, 'out.txt')
+        with open(self.in_fp, 'w') as fh:
+            fh.write('x' * 100)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_stage(self):
+        profile = Profile()
+        with profile.stage('s1', 'copy', [self.in_fp], [self.out_fp]):
+            with open(self.in_fp) as src, open(self.out_fp, 'w') as dst:
+                dst.write(src.read() * 2)
+        (sample_id, stage, wall_time, cpu_time, max_rss, bytes_in,
+         bytes_out), = profile.rows
+        self.assertEqual((sample_id, stage, bytes_in, bytes_out),
+                         ('s1', 'copy', 100, 200))
+        self.assertGreaterEqual(wall_time, 0)
+        self.assertGreaterEqual(cpu_time, 0)
+        self.assertGreater(max_rss, 0)
+
+    def test_stage_cpu_time_of_children(self):
+        profile = Profile()
+        with profile.stage('s1', 'spin'):
+            run_pipeline([[sys.executable, '-c',
+                           'import time\n'
+                           'start = time.process_time()\n'
+                           'while time.process_time() - start < 0.2:\n'
+                           '    pass']])
+        (_, _, _, cpu_time, *_), = profile.rows
+        self.assertGreaterEqual(cpu_time, 0.2)
+
+    def test_add_commands(self):
+        log = []
+        run_pipeline([[sys.executable, '-c', 'print(1)'],
+                      ['cat']], log=log)
+        profile = Profile()
+        profile.add_commands('s1', log, [self.in_fp], [self.in_fp])
+        df = profile.to_dataframe()
+        self.assertEqual(list(df.columns), COLUMNS)
+        self.assertEqual(list(df['stage']),
+                         [os.path.basename(sys.executable), 'cat'])
+        self.assertEqual(list(df['bytes in'].fillna(-1)), [100, -1])
+        self.assertEqual(list(df['bytes out'].fillna(-1)), [-1, 100])
+
+    def test_write(self):
+        profile = Profile()
+        profile.add('s1', 'stage', 1.5, 1.0, 1024)
+        profile.write(self.out_fp)
+        df = pd.read_csv(self.out_fp, sep='\t')
+        self.assertEqual(list(df.columns), COLUMNS)
+        self.assertEqual(df.loc[0, 'wall time (s)'], 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
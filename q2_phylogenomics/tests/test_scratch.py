@@ -0,0 +1,155 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import contextlib
+import gzip
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from q2_phylogenomics._bgzf import BgzfWriter
+from q2_phylogenomics._scratch import (
+    uncompressed_size, sample_cost, trim_scratch_bytes, cascade_scratch_bytes,
+    plan_jobs)
+
+
+DiskUsage = collections.namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+def _fastq(n_records):
+    return b''.join(b'@r%d\nACGTTGCAAC%s\n+\nIIIIIIIIII%s\n' % (
+        i, b'GT' * (i % 7), b'II' * (i % 7)) for i in range(n_records))
+
+
+class TestUncompressedSize(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fp = os.path.join(self.temp_dir.name, 'reads.fastq.gz')
+        self.data = _fastq(20000)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_whole_file(self):
+        with gzip.open(self.fp, 'wb') as fh:
+            fh.write(self.data)
+        self.assertEqual(uncompressed_size(self.fp),
+                         (len(self.data), 20000))
+
+    def test_extrapolated(self):
+        with gzip.open(self.fp, 'wb') as fh:
+            fh.write(self.data)
+        size, n_records = uncompressed_size(self.fp, sample_size=4096)
+        self.assertAlmostEqual(size / len(self.data), 1, delta=0.1)
+        self.assertAlmostEqual(n_records / 20000, 1, delta=0.1)
+
+    def test_multiple_members(self):
+        with BgzfWriter(self.fp) as fh:
+            fh.write(self.data)
+        self.assertEqual(uncompressed_size(self.fp),
+                         (len(self.data), 20000))
+
+    def test_empty(self):
+        with gzip.open(self.fp, 'wb'):
+            pass
+        self.assertEqual(uncompressed_size(self.fp), (0, 0))
+
+
+class TestScratchBytes(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.data = _fastq(1000)
+        self.reads = []
+        for name in ['fwd.fastq.gz', 'rev.fastq.gz']:
+            fp = os.path.join(self.temp_dir.name, name)
+            with gzip.open(fp, 'wb') as fh:
+                fh.write(self.data)
+            self.reads.append(fp)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_prinseq(self):
+        size = len(self.data)
+        self.assertEqual(
+            trim_scratch_bytes(self.reads, 'prinseq', False, '14'), 4 * size)
+        self.assertEqual(
+            trim_scratch_bytes(self.reads, 'prinseq', True, '14'), 0)
+        self.assertEqual(
+            trim_scratch_bytes(self.reads, 'prinseq', True, '14',
+                               compressed=False), 2 * size)
+
+    def test_native(self):
+        size = len(self.data)
+        without_derep = trim_scratch_bytes(self.reads, 'native', False, '')
+        self.assertEqual(without_derep, 2 * size)
+        exact = trim_scratch_bytes(self.reads, 'native', False, '1')
+        reverse = trim_scratch_bytes(self.reads, 'native', False, '14')
+        self.assertGreater(exact, without_derep)
+        self.assertEqual(reverse - without_derep,
+                         2 * (exact - without_derep))
+        self.assertEqual(
+            trim_scratch_bytes(self.reads, 'native', False, '',
+                               compressed=False), 4 * size)
+
+    def test_sample_cost(self):
+        self.assertEqual(sample_cost(self.reads),
+                         sum(os.path.getsize(fp) for fp in self.reads))
+        self.assertLess(sample_cost(self.reads[:1]), sample_cost(self.reads))
+
+    def test_cascade(self):
+        compressed = sum(os.path.getsize(fp) for fp in self.reads)
+        self.assertEqual(cascade_scratch_bytes(self.reads, True),
+                         2 * compressed)
+        self.assertEqual(cascade_scratch_bytes(self.reads[:1], False),
+                         3 * os.path.getsize(self.reads[0]))
+        self.assertEqual(cascade_scratch_bytes(self.reads, False),
+                         2 * compressed)
+
+
+class TestPlanJobs(unittest.TestCase):
+    def _plan(self, estimates, n_jobs, free):
+        with mock.patch('q2_phylogenomics._scratch.shutil.disk_usage',
+                        return_value=DiskUsage(free, 0, free)), \
+                contextlib.redirect_stdout(io.StringIO()) as stdout:
+            planned = plan_jobs(estimates, n_jobs, tempfile.gettempdir())
+        return planned, stdout.getvalue()
+
+    def test_fits(self):
+        self.assertEqual(self._plan([10, 20, 30], 3, 100), (3, ''))
+
+    def test_throttled(self):
+        planned, message = self._plan([40, 10, 30, 20], 4, 80)
+        # the two largest samples fit in 90% of the free space
+        self.assertEqual(planned, 2)
+        self.assertIn('Processing 2 at a time', message)
+
+    def test_refused(self):
+        with self.assertRaisesRegex(ValueError, 'only 100 bytes is free'):
+            self._plan([95, 10], 2, 100)
+
+    def test_no_scratch_needed(self):
+        self.assertEqual(self._plan([0, 0], 2, 0), (2, ''))
+
+    def test_missing_scratch_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            scratch_dir = os.path.join(temp_dir, 'scratch')
+            # checked even when no scratch space is needed
+            with self.assertRaisesRegex(ValueError, 'does not exist'):
+                plan_jobs([0], 1, scratch_dir)
+            with open(scratch_dir, 'w'):
+                pass
+            with self.assertRaisesRegex(ValueError, 'is not a directory'):
+                plan_jobs([10], 1, scratch_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from q2_types.feature_data import DNAFASTAFormat
+from q2_types.per_sample_sequences import (
+    SingleLanePerSampleSingleEndFastqDirFmt,
+    SingleLanePerSamplePairedEndFastqDirFmt,
+    FastqGzFormat,
+)
+from qiime2 import Artifact
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_phylogenomics._format import Bowtie2ShardedIndexDirFmt
+from q2_phylogenomics._sharded import _split_fasta
+
+
+class TestSplitFasta(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fasta_fp = os.path.join(self.temp_dir.name, 'ref.fasta')
+        with open(self.fasta_fp, 'w') as fh:
+            fh.write('>a\nAAAAAAAAAA\nAAAAAAAAAA\n>b\nCCCCC\n'
+                     '>c\nGGGGGGGGGGGGGGG\n>d\nTTTTT\n')
+        self.shard_fps = [os.path.join(self.temp_dir.name, 'shard-%d' % i)
+                          for i in range(3)]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _read(self, fp):
+        with open(fp) as fh:
+            return fh.read()
+
+    def test_balanced(self):
+        self.assertEqual(_split_fasta(self.fasta_fp, self.shard_fps), 3)
+        self.assertEqual(self._read(self.shard_fps[0]),
+                         '>a\nAAAAAAAAAA\nAAAAAAAAAA\n')
+        self.assertEqual(self._read(self.shard_fps[1]),
+                         '>c\nGGGGGGGGGGGGGGG\n')
+        # smaller records fill up the smallest shard, in their input order
+        self.assertEqual(self._read(self.shard_fps[2]),
+                         '>b\nCCCCC\n>d\nTTTTT\n')
+
+    def test_more_shards_than_records(self):
+        shard_fps = [os.path.join(self.temp_dir.name, 'shard-%d' % i)
+                     for i in range(6)]
+        self.assertEqual(_split_fasta(self.fasta_fp, shard_fps), 4)
+        self.assertFalse(os.path.exists(shard_fps[4]))
+
+
+class TestFilterSharded(TestPluginBase):
+    package = 'q2_phylogenomics.tests'
+
+    def setUp(self):
+        super().setUp()
+        # a multi-record reference, so that the shards are not empty and
+        # reads align to different shards
+        genome = Artifact.load(self.get_data_path('sars2-genome.qza'))
+        with open(str(genome.view(DNAFASTAFormat))) as fh:
+            seq = ''.join(line.strip() for line in fh
+                          if not line.startswith('>'))
+        size = len(seq) // 4 + 1
+        fasta_fp = os.path.join(self.temp_dir.name, 'reference.fasta')
+        with open(fasta_fp, 'w') as fh:
+            for i in range(4):
+                fh.write('>part%d\n%s\n' % (i, seq[i * size:(i + 1) * size]))
+        reference = Artifact.import_data('FeatureData[Sequence]', fasta_fp)
+
+        self.indexed, = self.plugin.methods['bowtie2_build'](reference)
+        self.sharded, = self.plugin.methods['bowtie2_build_sharded'](
+            reference, n_shards=2)
+        self.assertEqual(
+            self.sharded.view(Bowtie2ShardedIndexDirFmt).get_basenames(),
+            ['shard-0', 'shard-1'])
+
+    def _read_ids(self, art, view_type):
+        # the read IDs of each output file
+        ids = []
+        for _, fp in art.view(view_type).sequences.iter_views(FastqGzFormat):
+            with gzip.open(str(fp), 'rt') as fh:
+                ids.append({header.strip('@/012\n')
+                            for header, *_ in zip(*[fh] * 4)})
+        return ids
+
+    def _assert_same_as_unsharded(self, layout, exclude_seqs):
+        view_type = {
+            'single': SingleLanePerSampleSingleEndFastqDirFmt,
+            'paired': SingleLanePerSamplePairedEndFastqDirFmt}[layout]
+        demuxed_art = Artifact.load(self.get_data_path(
+            '%s-end.qza' % layout))
+
+        exp_art, exp_stats = self.plugin.methods['filter_' + layout](
+            demuxed_art, self.indexed, exclude_seqs=exclude_seqs)
+        obs_art, obs_stats = self.plugin.methods[
+            'filter_%s_sharded' % layout](
+                demuxed_art, self.sharded, exclude_seqs=exclude_seqs)
+
+        self.assertEqual(self._read_ids(obs_art, view_type),
+                         self._read_ids(exp_art, view_type))
+        exp_stats = exp_stats.view(pd.DataFrame)
+        obs_stats = obs_stats.view(pd.DataFrame)
+        for column in ['input', 'retained']:
+            self.assertEqual(list(obs_stats[column]),
+                             list(exp_stats[column]))
+
+    def test_single_exclude(self):
+        self._assert_same_as_unsharded('single', True)
+
+    def test_single_keep(self):
+        self._assert_same_as_unsharded('single', False)
+
+    def test_paired_exclude(self):
+        self._assert_same_as_unsharded('paired', True)
+
+    def test_paired_keep(self):
+        self._assert_same_as_unsharded('paired', False)
+
+
+if __name__ == '__main__':
+    unittest.main()
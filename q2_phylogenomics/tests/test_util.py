@@ -0,0 +1,294 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from q2_phylogenomics._util import (
+    run_command, run_pipeline, run_with_fifos, run_in_parallel)
+
+
+def _python(code):
+    return [sys.executable, '-c', code]
+
+
+class TestRunCommand(unittest.TestCase):
+    def test_log(self):
+        log = []
+        stderr = run_command(
+            _python('import sys; x = bytearray(50 * 2 ** 20); '
+                    'sys.stderr.write("done\\n")'),
+            capture_stderr=True, log=log)
+        self.assertEqual(stderr, 'done\n')
+        stats, = log
+        self.assertEqual(stats.returncode, 0)
+        self.assertEqual(stats.stderr, 'done\n')
+        self.assertGreater(stats.wall_time, 0)
+        self.assertGreaterEqual(stats.cpu_time, 0)
+        self.assertGreater(stats.max_rss, 50 * 2 ** 20)
+
+    def test_failure_is_logged(self):
+        log = []
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            run_command(_python('import sys; sys.exit(3)'), log=log)
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(log[0].returncode, 3)
+        self.assertIsNone(log[0].stderr)
+
+    def test_timeout(self):
+        log = []
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_command(_python('import time; time.sleep(60)'), timeout=0.5,
+                        log=log)
+        self.assertLess(log[0].wall_time, 30)
+        self.assertLess(log[0].returncode, 0)
+
+
+class TestRunPipeline(unittest.TestCase):
+    def test_log(self):
+        log = []
+        out = []
+        cmds = [_python('print("a\\nb")'),
+                _python('import sys; sys.stdout.write(sys.stdin.read() * 2)')]
+        run_pipeline(cmds, consume=lambda fh: out.append(fh.read()), log=log)
+        self.assertEqual(out, [b'a\nb\na\nb\n'])
+        self.assertEqual([stats.returncode for stats in log], [0, 0])
+        self.assertEqual([stats.cmd for stats in log], cmds)
+
+    def test_consume_error_after_exit(self):
+        # the first command has exited, but not been reaped, when the
+        # pipeline is killed
+        def consume(fh):
+            time.sleep(0.5)
+            raise ValueError('consume failed')
+
+        with self.assertRaisesRegex(ValueError, 'consume failed'):
+            run_pipeline([['true'], ['cat']], consume=consume)
+
+    def test_command_not_found(self):
+        started = []
+        popen = subprocess.Popen
+
+        def record(*args, **kwargs):
+            proc = popen(*args, **kwargs)
+            started.append(proc)
+            return proc
+
+        # the commands started before the one that cannot be are killed,
+        # reaped and disconnected
+        with mock.patch('subprocess.Popen', side_effect=record):
+            with self.assertRaises(FileNotFoundError):
+                run_pipeline([['sleep', '30'], ['no-such-tool']],
+                             capture_stderr=True)
+        sleep, = started
+        self.assertEqual(sleep.returncode, -signal.SIGKILL)
+        self.assertTrue(sleep.stdout.closed)
+        self.assertTrue(sleep.stderr.closed)
+
+    def test_timeout_after_exit(self):
+        # as above, but killed by the timeout while consume blocks
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_pipeline([['true'], _python('import time; time.sleep(60)')],
+                         consume=lambda fh: fh.read(), timeout=0.5)
+
+
+class TestRunWithFifos(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def test_reread_and_unused_output(self):
+        with gzip.open(self._path('in.gz'), 'wb') as fh:
+            fh.write(b'@r\nACGT\n+\nIIII\n' * 10000)
+        run_with_fifos(
+            ['sh', '-c', 'cat "$0" "$0" > "$1"', self._path('in.fastq'),
+             self._path('out.fastq')],
+            {self._path('in.fastq'): self._path('in.gz')},
+            {self._path('out.fastq'): self._path('out.gz'),
+             self._path('unused.fastq'): self._path('unused.gz')},
+            threads=2)
+        with gzip.open(self._path('out.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'@r\nACGT\n+\nIIII\n' * 20000)
+        with gzip.open(self._path('unused.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'')
+
+    def test_multiple_opens(self):
+        # a reader that sniffs the input, then reads it in full twice; after
+        # the first full read, it lingers and reads on to make sure it is
+        # at the end, as a file would be
+        data = b'@r\nACGT\n+\nIIII\n' * 1000
+        with gzip.open(self._path('in.gz'), 'wb') as fh:
+            fh.write(data)
+        reader = (
+            'import sys, time\n'
+            'with open(sys.argv[1], "rb") as fh:\n'
+            '    first = fh.readline()\n'
+            'with open(sys.argv[1], "rb") as fh:\n'
+            '    second = fh.read()\n'
+            '    time.sleep(0.5)\n'
+            '    second += fh.read()\n'
+            'with open(sys.argv[1], "rb") as fh:\n'
+            '    third = fh.read()\n'
+            'with open(sys.argv[2], "wb") as fh:\n'
+            '    fh.write(first + second + third)\n')
+        run_with_fifos(
+            [*_python(reader), self._path('in.fastq'),
+             self._path('out.fastq')],
+            {self._path('in.fastq'): self._path('in.gz')},
+            {self._path('out.fastq'): self._path('out.gz')})
+        with gzip.open(self._path('out.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'@r\n' + data + data)
+
+
+class TestRunInParallel(unittest.TestCase):
+    def test_largest_first(self):
+        started = []
+        # the two largest jobs can only get past this together, so the
+        # smaller ones cannot start until both have
+        barrier = threading.Barrier(2, timeout=30)
+
+        def job(name):
+            started.append(name)
+            if name in 'bd':
+                barrier.wait()
+            return name.upper()
+
+        obs = run_in_parallel(job, [('a',), ('b',), ('c',), ('d',)], 2,
+                              costs=[1, 4, 2, 3])
+        self.assertEqual(obs, ['A', 'B', 'C', 'D'])
+        self.assertEqual(set(started[:2]), {'b', 'd'})
+
+    def test_threads_weighted_by_cost(self):
+        obs = run_in_parallel(lambda name, n_threads: n_threads,
+                              [('a',), ('b',)], 4, costs=[1, 3], n_threads=8)
+        self.assertEqual(obs, [2, 6])
+
+    def test_threads_shared_equally(self):
+        # with more slots than jobs, the jobs share all of the threads
+        obs = run_in_parallel(lambda name, n_threads: n_threads,
+                              [('a',), ('b',)], 4, n_threads=8)
+        self.assertEqual(obs, [4, 4])
+
+    def test_threads_freed(self):
+        release = threading.Event()
+
+        def job(name, n_threads):
+            if name == 'a':
+                release.wait(30)
+            elif name == 'c':
+                release.set()
+            return n_threads
+
+        # b finishes while a is still running, so c starts with b's threads
+        obs = run_in_parallel(job, [('a',), ('b',), ('c',)], 2,
+                              costs=[3, 2, 1], n_threads=10)
+        self.assertEqual(obs, [6, 4, 4])
+
+    def test_at_least_one_thread(self):
+        release = threading.Event()
+
+        def job(name, n_threads):
+            if name == 'b':
+                release.wait(30)
+            elif name == 'c':
+                release.set()
+            return n_threads
+
+        # c waits for a to finish, and b is still running when it starts
+        obs = run_in_parallel(job, [('a',), ('b',), ('c',)], 3, n_threads=2)
+        self.assertEqual(obs, [1, 1, 1])
+
+    def test_no_more_threads_than_given(self):
+        lock = threading.Lock()
+        in_use = []
+        peak = []
+
+        def job(name, n_threads):
+            with lock:
+                in_use.append(n_threads)
+                peak.append(sum(in_use))
+            time.sleep(0.1)
+            with lock:
+                in_use.remove(n_threads)
+            return n_threads
+
+        # fewer threads than jobs that could run at once: the third job
+        # waits for a thread rather than being given one more than exist
+        run_in_parallel(job, [('a',), ('b',), ('c',)], 3, n_threads=2)
+        self.assertEqual(max(peak), 2)
+
+        # a large job's share leaves too few threads for the jobs starting
+        # alongside it to have one each
+        peak.clear()
+        obs = run_in_parallel(job, [('a',), ('b',), ('c',)], 3,
+                              costs=[100, 1, 1], n_threads=3)
+        self.assertEqual(obs[:2], [2, 1])
+        self.assertEqual(max(peak), 3)
+
+    def test_serial(self):
+        obs = run_in_parallel(lambda name, n_threads: n_threads,
+                              [('a',), ('b',)], 1, costs=[1, 2], n_threads=3)
+        self.assertEqual(obs, [3, 3])
+
+    def test_failure(self):
+        def job(name):
+            if name == 'b':
+                raise ValueError(name)
+            return name
+
+        with self.assertRaisesRegex(ValueError, 'b') as cm:
+            run_in_parallel(job, [('a',), ('b',), ('c',)], 2)
+        self.assertEqual(str(cm.exception), 'Job 2 failed with ValueError: b')
+        self.assertEqual(str(cm.exception.__cause__), 'b')
+
+    def test_failures_in_job_order(self):
+        # c fails first, but every failure is reported in the order of jobs
+        failed = threading.Event()
+
+        def job(name):
+            if name == 'a':
+                self.assertTrue(failed.wait(timeout=30))
+                raise ValueError('a went wrong')
+            if name == 'c':
+                failed.set()
+                raise OSError('c went wrong')
+            return name
+
+        with self.assertRaises(ValueError) as cm:
+            run_in_parallel(job, [('a',), ('b',), ('c',)], 3,
+                            names=['Sample a', 'Sample b', 'Sample c'])
+        self.assertEqual(str(cm.exception),
+                         'Sample a failed with ValueError: a went wrong\n'
+                         'Sample c failed with OSError: c went wrong')
+        self.assertEqual(str(cm.exception.__cause__), 'a went wrong')
+
+    def test_serial_failure(self):
+        def job(name):
+            raise OSError(name)
+
+        with self.assertRaisesRegex(ValueError,
+                                    '^Sample a failed with OSError: a$'):
+            run_in_parallel(job, [('a',), ('b',)], 1,
+                            names=['Sample a', 'Sample b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
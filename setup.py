@@ -16,7 +16,7 @@ setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
     license='BSD-3-Clause',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     author="Nicholas Bokulich",
     author_email="nbokulich@gmail.com",
     description="Phylogenomics toolkit and pipelines.",